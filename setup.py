@@ -22,8 +22,8 @@ from setuptools import setup, find_packages
 from string import Template
 
 
-if sys.hexversion < 0x30400f0:
-    print('Mailman requires at least Python 3.4')
+if sys.hexversion < 0x30501f0:
+    print('Mailman requires at least Python 3.5.1')
     sys.exit(1)
 
 
@@ -102,7 +102,7 @@ case second `m'.  Any other spelling is incorrect.""",
         'mock',
         'nose2',
         'passlib',
-        'sqlalchemy',
+        'sqlalchemy>=1.2',
         'zope.component',
         'zope.configuration',
         'zope.event',
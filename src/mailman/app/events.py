@@ -23,7 +23,7 @@ __all__ = [
 
 
 from mailman.app import (
-    domain, membership, moderator, registrar, subscriptions)
+    domain, listindex, membership, moderator, registrar, subscriptions)
 from mailman.core import i18n, switchboard
 from mailman.languages import manager as language_manager
 from mailman.styles import manager as style_manager
@@ -38,6 +38,8 @@ def initialize():
         domain.handle_DomainDeletingEvent,
         i18n.handle_ConfigurationUpdatedEvent,
         language_manager.handle_ConfigurationUpdatedEvent,
+        listindex.handle_ListCreatedEvent,
+        listindex.handle_ListDeletedEvent,
         membership.handle_SubscriptionEvent,
         moderator.handle_ListDeletingEvent,
         passwords.handle_ConfigurationUpdatedEvent,
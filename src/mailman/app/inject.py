@@ -31,7 +31,8 @@ from mailman.utilities.email import add_message_hash
 
 
 
-def inject_message(mlist, msg, recipients=None, switchboard=None, **kws):
+def inject_message(mlist, msg, recipients=None, switchboard=None,
+                   priority=None, **kws):
     """Inject a message into a queue.
 
     If the message does not have a Message-ID header, one is added.  An
@@ -47,6 +48,9 @@ def inject_message(mlist, msg, recipients=None, switchboard=None, **kws):
     :param switchboard: Optional name of switchboard to inject this message
         into.  If not given, the 'in' switchboard is used.
     :type switchboard: string
+    :param priority: Optional priority lane of the message, i.e. 'high',
+        'normal' or 'low'.  If not given, the message is in the normal lane.
+    :type priority: string
     :param kws: Additional values for the message metadata.
     :type kws: dictionary
     :return: filebase of enqueued message
@@ -62,7 +66,7 @@ def inject_message(mlist, msg, recipients=None, switchboard=None, **kws):
     # Ditto for Date: as required by RFC 2822.
     if 'date' not in msg:
         msg['Date'] = formatdate(localtime=True)
-    msg.original_size = len(msg.as_string())
+    msg.original_size = len(msg.flattened())
     msgdata = dict(
         listid=mlist.list_id,
         original_size=msg.original_size,
@@ -70,11 +74,14 @@ def inject_message(mlist, msg, recipients=None, switchboard=None, **kws):
     msgdata.update(kws)
     if recipients is not None:
         msgdata['recipients'] = recipients
+    if priority is not None:
+        msgdata['priority'] = priority
     return config.switchboards[switchboard].enqueue(msg, **msgdata)
 
 
 
-def inject_text(mlist, text, recipients=None, switchboard=None, **kws):
+def inject_text(mlist, text, recipients=None, switchboard=None,
+                priority=None, **kws):
     """Turn text into a message and inject that into a queue.
 
     If the text does not have a Message-ID header, one is added.  An
@@ -91,10 +98,14 @@ def inject_text(mlist, text, recipients=None, switchboard=None, **kws):
     :param switchboard: Optional name of switchboard to inject this message
         into.  If not given, the 'in' switchboard is used.
     :type switchboard: string
+    :param priority: Optional priority lane of the message, i.e. 'high',
+        'normal' or 'low'.  If not given, the message is in the normal lane.
+    :type priority: string
     :param kws: Additional values for the message metadata.
     :type kws: dictionary
     :return: filebase of enqueued message
     :rtype: string
     """
     message = message_from_string(text, Message)
-    return inject_message(mlist, message, recipients, switchboard, **kws)
+    return inject_message(
+        mlist, message, recipients, switchboard, priority, **kws)
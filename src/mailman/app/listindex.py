@@ -0,0 +1,168 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""An in-process index of the mailing lists."""
+
+__all__ = [
+    'ListIndex',
+    'handle_ListCreatedEvent',
+    'handle_ListDeletedEvent',
+    ]
+
+
+import os
+import threading
+
+from mailman.config import config
+from mailman.interfaces.listmanager import (
+    IListIndex, IListManager, ListCreatedEvent, ListDeletedEvent)
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+from uuid import uuid4
+from zope.component import getUtility
+from zope.interface import implementer
+
+
+# The keys in the database session's info dictionary which record that the
+# set of mailing lists was changed in the current transaction, and which
+# mailing lists it created.
+CHANGED_KEY = 'mailman.list_index.changed'
+ADDED_KEY = 'mailman.list_index.added'
+
+
+
+
+def _list_id(fqdn_listname):
+    listname, at, hostname = fqdn_listname.lower().partition('@')
+    return '{0}.{1}'.format(listname, hostname)
+
+
+
+
+@implementer(IListIndex)
+class ListIndex:
+    """An implementation of the `IListIndex` interface.
+
+    Other processes learn about changes through a stamp file in the data
+    directory, which is replaced whenever a transaction that created or
+    deleted a mailing list commits.  A lookup costs one `stat()` of the stamp
+    file, and the index is reloaded only when the stamp file changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._list_ids = set()
+        self._stamp = None
+        self._loaded = False
+
+    @property
+    def _stamp_file(self):
+        return os.path.join(config.DATA_DIR, 'lists.stamp')
+
+    def _read_stamp(self):
+        try:
+            info = os.stat(self._stamp_file)
+        except FileNotFoundError:
+            return None
+        # The stamp file is replaced rather than rewritten, so the inode
+        # changes even if the file system's timestamps are coarse.
+        return info.st_ino, info.st_mtime_ns
+
+    def _check(self):
+        if not self._loaded or self._read_stamp() != self._stamp:
+            self.load()
+
+    def exists(self, list_id):
+        """See `IListIndex`."""
+        self._check()
+        return list_id in self._list_ids
+
+    def has_name(self, fqdn_listname):
+        """See `IListIndex`."""
+        return self.exists(_list_id(fqdn_listname))
+
+    def load(self):
+        """See `IListIndex`."""
+        with self._lock:
+            # Read the stamp before the database so that a change committed
+            # while we are loading causes another reload.
+            stamp = self._read_stamp()
+            self._list_ids = set(getUtility(IListManager).list_ids)
+            self._stamp = stamp
+            self._loaded = True
+
+    def invalidate(self):
+        """See `IListIndex`."""
+        with self._lock:
+            self._loaded = False
+            path = self._stamp_file
+            tmp_path = '{}.{}.tmp'.format(path, uuid4().hex)
+            with open(tmp_path, 'w') as fp:
+                print(uuid4().hex, file=fp)
+            os.replace(tmp_path, path)
+
+    def _add(self, list_id):
+        with self._lock:
+            self._list_ids.add(list_id)
+
+    def _discard(self, list_id):
+        with self._lock:
+            self._list_ids.discard(list_id)
+
+    def _forget(self):
+        with self._lock:
+            self._loaded = False
+
+
+
+
+def handle_ListCreatedEvent(event):
+    """Add a newly created mailing list to the index."""
+    if not isinstance(event, ListCreatedEvent):
+        return
+    # The mailing list is only added once its creation is committed, so that
+    # no mail is accepted for it if the transaction is rolled back.
+    info = config.db.store.info
+    info[CHANGED_KEY] = True
+    info.setdefault(ADDED_KEY, set()).add(event.mailing_list.list_id)
+
+
+def handle_ListDeletedEvent(event):
+    """Remove a deleted mailing list from the index."""
+    if not isinstance(event, ListDeletedEvent):
+        return
+    config.db.store.info[CHANGED_KEY] = True
+    getUtility(IListIndex)._discard(_list_id(event.fqdn_listname))
+
+
+@listens_for(Session, 'after_commit')
+def _after_commit(session):
+    # Only now can other processes see the change, so tell them to reload.
+    added = session.info.pop(ADDED_KEY, ())
+    if session.info.pop(CHANGED_KEY, False):
+        list_index = getUtility(IListIndex)
+        for list_id in added:
+            list_index._add(list_id)
+        list_index.invalidate()
+
+
+@listens_for(Session, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    # The change never happened, so our own index must be reloaded.
+    session.info.pop(ADDED_KEY, None)
+    if session.info.pop(CHANGED_KEY, False):
+        getUtility(IListIndex)._forget()
@@ -114,6 +114,16 @@ Nothing.
         self.assertEqual(items[0].msgdata['foo'], 'yes')
         self.assertEqual(items[0].msgdata['bar'], 'no')
 
+    def test_inject_message_with_priority(self):
+        # Injected messages are in the normal priority lane unless told
+        # otherwise.
+        inject_message(self.mlist, self.msg)
+        inject_message(self.mlist, self.msg, priority='high')
+        items = get_queue_messages('in')
+        self.assertEqual(
+            sorted(item.msgdata.get('priority', 'normal') for item in items),
+            ['high', 'normal'])
+
     def test_inject_message_id_hash(self):
         # When the injected message has a Message-ID header, the injected
         # message will also get an X-Message-ID-Hash header.
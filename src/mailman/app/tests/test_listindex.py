@@ -0,0 +1,111 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the in-process index of the mailing lists."""
+
+__all__ = [
+    'TestListIndex',
+    ]
+
+
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.app.listindex import ListIndex
+from mailman.config import config
+from mailman.database.transaction import transaction
+from mailman.interfaces.listmanager import IListIndex, IListManager
+from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+from zope.component import getUtility
+
+
+
+
+class TestListIndex(unittest.TestCase):
+    """Test the in-process index of the mailing lists."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._index = getUtility(IListIndex)
+        with transaction():
+            create_list('ant@example.com')
+
+    def test_exists(self):
+        self.assertTrue(self._index.exists('ant.example.com'))
+        self.assertFalse(self._index.exists('bee.example.com'))
+
+    def test_has_name(self):
+        self.assertTrue(self._index.has_name('ant@example.com'))
+        self.assertTrue(self._index.has_name('ANT@example.com'))
+        self.assertFalse(self._index.has_name('bee@example.com'))
+
+    def test_no_reload_without_changes(self):
+        # Once loaded, lookups don't touch the database.
+        self._index.exists('ant.example.com')
+        with patch.object(self._index, 'load') as load:
+            self.assertTrue(self._index.exists('ant.example.com'))
+            self.assertFalse(self._index.exists('bee.example.com'))
+        self.assertEqual(load.call_count, 0)
+
+    def test_created_list(self):
+        # The index learns about new mailing lists through the event, but
+        # only once the transaction is committed.
+        self._index.exists('ant.example.com')
+        getUtility(IListManager).create('bee@example.com')
+        self.assertFalse(self._index.exists('bee.example.com'))
+        config.db.commit()
+        self.assertTrue(self._index.exists('bee.example.com'))
+
+    def test_deleted_list(self):
+        list_manager = getUtility(IListManager)
+        self.assertTrue(self._index.exists('ant.example.com'))
+        with transaction():
+            list_manager.delete(list_manager.get('ant@example.com'))
+        self.assertFalse(self._index.exists('ant.example.com'))
+
+    def test_aborted_creation(self):
+        # When the transaction which created a mailing list is aborted, the
+        # mailing list isn't in the index either.
+        self._index.exists('ant.example.com')
+        getUtility(IListManager).create('bee@example.com')
+        self.assertFalse(self._index.exists('bee.example.com'))
+        config.db.abort()
+        self.assertFalse(self._index.exists('bee.example.com'))
+
+    def test_other_process(self):
+        # An index which did not see the events, as in another process,
+        # reloads when the change is committed.
+        other = ListIndex()
+        self.assertTrue(other.exists('ant.example.com'))
+        self.assertFalse(other.exists('bee.example.com'))
+        getUtility(IListManager).create('bee@example.com')
+        self.assertFalse(other.exists('bee.example.com'))
+        config.db.commit()
+        self.assertTrue(other.exists('bee.example.com'))
+
+    def test_invalidate(self):
+        # Invalidating the index makes every index reload, even without
+        # events, e.g. after the database was reset.
+        other = ListIndex()
+        self.assertTrue(other.exists('ant.example.com'))
+        config.db._reset()
+        self.assertTrue(other.exists('ant.example.com'))
+        self._index.invalidate()
+        self.assertFalse(other.exists('ant.example.com'))
+        self.assertFalse(self._index.exists('ant.example.com'))
@@ -0,0 +1,125 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Database commits per second with many processes writing at once.
+
+Every process runs the given number of small write transactions against
+the same database, as runner processes do, first with the default and then
+with tuned `[database]` settings.  A transaction which fails because the
+database is locked is counted and retried.
+"""
+
+__all__ = [
+    'main',
+    ]
+
+
+import time
+import multiprocessing
+
+from mailman.benchmarks.helpers import benchmark_parser, layers, report
+from mailman.config import config
+from mailman.testing.helpers import configuration
+from mailman.testing.layers import ConfigLayer
+from mailman.utilities.modules import call_name
+from sqlalchemy.exc import OperationalError
+
+
+SETTINGS = (
+    ('default', {}),
+    ('tuned', dict(pool_class='sqlalchemy.pool.QueuePool',
+                   sqlite_journal_mode='wal',
+                   sqlite_synchronous='normal',
+                   sqlite_busy_timeout='30s')),
+    )
+
+
+
+
+def _write(count, start, results):
+    # Runs in a forked process, with its own engine.
+    database = call_name(config.database['class'])
+    database.initialize()
+    start.wait()
+    commits = errors = 0
+    while commits < count:
+        try:
+            database.store.execute('SELECT count(*) FROM mailinglist')
+            database.store.execute(
+                'INSERT INTO bench_commits (stamp) VALUES (:stamp)',
+                dict(stamp=time.time()))
+            database.commit()
+            commits += 1
+        except OperationalError:
+            database.abort()
+            errors += 1
+    database.engine.dispose()
+    results.put(errors)
+
+
+def _run(processes, count):
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_write,
+                                       args=(count, start, results))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    # Give the processes time to connect.
+    time.sleep(0.5)
+    began = time.perf_counter()
+    start.set()
+    errors = sum(results.get() for worker in workers)
+    seconds = time.perf_counter() - began
+    for worker in workers:
+        worker.join()
+    return errors, seconds
+
+
+
+
+def main():
+    parser = benchmark_parser(__doc__.splitlines()[0])
+    parser.add_argument(
+        '--processes', default='1,10,30',
+        help='Comma separated numbers of writing processes to measure.')
+    args = parser.parse_args()
+    counts = [int(count) for count in args.processes.split(',')]
+    # The processes inherit the configuration of the test layer.
+    multiprocessing.set_start_method('fork')
+    rows = []
+    with layers(ConfigLayer):
+        config.db.store.execute(
+            'CREATE TABLE bench_commits (id INTEGER PRIMARY KEY, stamp REAL)')
+        config.db.commit()
+        for name, settings in SETTINGS:
+            with configuration('database', **settings):
+                for processes in counts:
+                    errors, seconds = _run(processes, args.count)
+                    commits = processes * args.count
+                    rows.append((name, processes, commits, errors, seconds,
+                                 commits / seconds))
+        config.db.store.execute('DROP TABLE bench_commits')
+        config.db.commit()
+    report('Database commits with concurrent writers',
+           ('settings', 'processes', 'commits', 'locked', 'seconds',
+            'commits/sec'),
+           rows)
+
+
+if __name__ == '__main__':
+    main()
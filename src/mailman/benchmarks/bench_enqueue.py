@@ -0,0 +1,82 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Enqueue throughput for each queue durability mode.
+
+The given number of messages is enqueued into a fresh queue directory with
+`strict`, `batched` and `relaxed` durability.  The time for batched mode
+includes the final sync of the last interval's files.
+"""
+
+__all__ = [
+    'main',
+    ]
+
+
+import shutil
+import tempfile
+
+from mailman.benchmarks.helpers import (
+    benchmark_parser, layers, report, timed)
+from mailman.core.switchboard import Switchboard
+from mailman.testing.helpers import specialized_message_from_string as mfs
+from mailman.testing.layers import ConfigLayer
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: Durability
+Message-ID: <durability>
+
+{}
+"""
+
+
+
+def main():
+    parser = benchmark_parser(__doc__.splitlines()[0])
+    parser.set_defaults(count=1000)
+    parser.add_argument(
+        '--sync-interval', type=float, default=0.1,
+        help='The sync interval in seconds for batched durability.')
+    args = parser.parse_args()
+    msg = mfs(MESSAGE.format('Lorem ipsum dolor sit amet.\n' * 100))
+    rows = []
+    with layers(ConfigLayer):
+        for durability in ('strict', 'batched', 'relaxed'):
+            queue_directory = tempfile.mkdtemp()
+            try:
+                switchboard = Switchboard(
+                    'bench', queue_directory, durability=durability,
+                    sync_interval=args.sync_interval)
+                results = {}
+                with timed(results, 'enqueue'):
+                    for i in range(args.count):
+                        switchboard.enqueue(msg, listid='test.example.com')
+                    switchboard.sync()
+                seconds = results['enqueue']
+                rows.append((durability, args.count, seconds,
+                             args.count / seconds))
+            finally:
+                shutil.rmtree(queue_directory)
+    report('Enqueue throughput by durability',
+           ('durability', 'messages', 'seconds', 'msgs/sec'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Flattening a message for every chunk of a bulk delivery.
+
+A multipart message with the given body size is flattened once for every
+chunk, plus once to log its size, as the bulk delivery agent used to do with
+`as_string()` and now does with the cached `flattened()`.
+"""
+
+__all__ = [
+    'main',
+    ]
+
+
+from email.mime.application import MIMEApplication
+from email.mime.text import MIMEText
+from mailman.benchmarks.helpers import (
+    benchmark_parser, layers, report, timed)
+from mailman.email.message import Message
+from mailman.testing.layers import ConfigLayer
+
+
+
+def _make_message(size):
+    msg = Message()
+    msg['From'] = 'anne@example.com'
+    msg['To'] = 'test@example.com'
+    msg['Subject'] = 'Flattening'
+    msg['Message-ID'] = '<flattening>'
+    msg.set_type('multipart/mixed')
+    msg.set_payload([])
+    msg.attach(MIMEText('Flattening.\n' * (size // 24)))
+    msg.attach(MIMEApplication(b'\x00' * (size // 2)))
+    return msg
+
+
+
+def main():
+    parser = benchmark_parser(__doc__.splitlines()[0])
+    parser.set_defaults(count=20)
+    parser.add_argument(
+        '--size', type=int, default=1000000,
+        help='The approximate body size in bytes.')
+    args = parser.parse_args()
+    rows = []
+    with layers(ConfigLayer):
+        for name, flatten in (
+                ('as_string', lambda msg: msg.as_string().encode('ascii')),
+                ('flattened', lambda msg: msg.flattened())):
+            msg = _make_message(args.size)
+            results = {}
+            with timed(results, 'time'):
+                for i in range(args.count + 1):
+                    flatten(msg)
+            rows.append((name, args.count, results['time']))
+    report('Flattening a {} byte message'.format(args.size),
+           ('method', 'chunks', 'seconds'), rows)
+
+
+if __name__ == '__main__':
+    main()
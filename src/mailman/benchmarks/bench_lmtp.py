@@ -0,0 +1,100 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Messages per second accepted by the LMTP runner at increasing concurrency.
+
+The LMTP runner is started as a subprocess, as in the test suite.  For every
+level of concurrency, that many clients send their share of the messages at
+the same time, each over its own LMTP session, and the messages per second
+the runner accepts into the incoming queue are reported.
+"""
+
+__all__ = [
+    'main',
+    ]
+
+
+import os
+import threading
+
+from mailman.app.lifecycle import create_list
+from mailman.benchmarks.helpers import (
+    benchmark_parser, layers, report, timed)
+from mailman.config import config
+from mailman.database.transaction import transaction
+from mailman.testing.helpers import get_lmtp_client
+from mailman.testing.layers import ConfigLayer, LMTPLayer
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: Load
+Message-ID: <load-{0}-{1}>
+
+Load.
+"""
+
+
+
+def send(client, count):
+    lmtp = get_lmtp_client(quiet=True)
+    try:
+        lmtp.lhlo('remote.example.org')
+        for i in range(count):
+            lmtp.sendmail('anne@example.com', ['test@example.com'],
+                          MESSAGE.format(client, i))
+    finally:
+        lmtp.quit()
+
+
+
+def main():
+    parser = benchmark_parser(__doc__.splitlines()[0])
+    parser.set_defaults(count=1000)
+    parser.add_argument(
+        '--concurrency', default='1,2,4,8,16,32',
+        help='The comma separated numbers of concurrent clients.')
+    args = parser.parse_args()
+    rows = []
+    with layers(ConfigLayer, LMTPLayer):
+        with transaction():
+            create_list('test@example.com')
+        queue_directory = config.switchboards['in'].queue_directory
+        for concurrency in (int(value)
+                            for value in args.concurrency.split(',')):
+            share = args.count // concurrency
+            clients = [threading.Thread(target=send, args=(client, share))
+                       for client in range(concurrency)]
+            results = {}
+            with timed(results, 'time'):
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+            accepted = len(config.switchboards['in'].files)
+            for filename in os.listdir(queue_directory):
+                os.remove(os.path.join(queue_directory, filename))
+            rows.append((concurrency, accepted,
+                         accepted / results['time'],
+                         results['time'] / accepted * 1000))
+    report('LMTP delivery of {} messages'.format(args.count),
+           ('clients', 'accepted', 'msgs/sec', 'ms/msg'), rows)
+
+
+if __name__ == '__main__':
+    main()
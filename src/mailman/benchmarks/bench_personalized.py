@@ -0,0 +1,119 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Personalized delivery from templates and by crafting every message.
+
+A plain text message with a personalized footer and To header is rendered
+for a growing number of list members, either by splicing the recipients'
+values into a template of the flattened message or by deep copying,
+decorating and flattening the message for every recipient.  Nothing is sent,
+but looking up the members' values in the database is included in the time.
+"""
+
+__all__ = [
+    'main',
+    ]
+
+
+import os
+import shutil
+import tempfile
+
+from mailman.app.lifecycle import create_list
+from mailman.benchmarks.helpers import (
+    benchmark_parser, layers, pushed_configuration, report, timed)
+from mailman.interfaces.mailinglist import Personalization
+from mailman.mta.deliver import Deliver
+from mailman.testing.helpers import (
+    specialized_message_from_string as mfs, subscribe)
+from mailman.testing.layers import ConfigLayer
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: Personalizing
+Message-ID: <personalizing>
+
+"""
+
+FOOTER = """\
+address: $user_address
+name   : $user_name
+options: $user_optionsurl
+"""
+
+
+
+class RenderingDeliver(Deliver):
+    def _deliver_to_recipients(self, mlist, msg, msgdata, recipients):
+        msg.flattened('\r\n')
+        return {}
+
+
+
+def main():
+    parser = benchmark_parser(__doc__.splitlines()[0])
+    parser.set_defaults(count=3)
+    parser.add_argument(
+        '--recipients', type=int, nargs='+', default=[10, 100, 500],
+        help='The numbers of recipients to deliver to.')
+    parser.add_argument(
+        '--size', type=int, default=100000,
+        help='The approximate body size in bytes.')
+    args = parser.parse_args()
+    template_dir = tempfile.mkdtemp()
+    path = os.path.join(template_dir, 'site', 'en', 'member-footer.txt')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fp:
+        fp.write(FOOTER)
+    rows = []
+    try:
+        with layers(ConfigLayer), pushed_configuration('templates', """
+                [paths.testing]
+                template_dir: {}
+                """.format(template_dir)):
+            mlist = create_list('test@example.com')
+            mlist.personalize = Personalization.full
+            mlist.footer_uri = 'mailman:///member-footer.txt'
+            msg = mfs(MESSAGE + 'Personalizing.\n' * (args.size // 15))
+            members = []
+            for count in sorted(args.recipients):
+                while len(members) < count:
+                    email = 'member{}@example.com'.format(len(members))
+                    subscribe(mlist, 'Member', email=email)
+                    members.append(email)
+                for templated in (True, False):
+                    agent = RenderingDeliver()
+                    if not templated:
+                        agent.slots.clear()
+                    results = {}
+                    with timed(results, 'time'):
+                        for i in range(args.count):
+                            agent.deliver(mlist, msg, dict(
+                                recipients=members[:count]))
+                    rows.append((
+                        'template' if templated else 'deepcopy', count,
+                        count * args.count / results['time']))
+    finally:
+        shutil.rmtree(template_dir)
+    report('Personalized delivery of a {} byte message'.format(args.size),
+           ('method', 'recipients', 'msgs/sec'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Queue hop cost of pickled versus raw queue file messages.
+
+A queue hop is what most runners do with a message: dequeue it, look at a
+header, add a header and enqueue it for the next runner.  Multipart messages
+with attachments of several sizes are run through the given number of hops,
+once with the message pickled as in version 1 queue files and once with the
+raw message bytes of version 2.  The size of the resulting queue file is
+reported as well.
+"""
+
+__all__ = [
+    'main',
+    ]
+
+
+import os
+import email
+import shutil
+import tempfile
+
+from mailman.benchmarks.helpers import (
+    benchmark_parser, layers, report, timed)
+from mailman.core.switchboard import Switchboard
+from mailman.email.message import Message
+from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: Attachment
+Message-ID: <attachment>
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain; charset="us-ascii"
+
+See the attachment.
+--BOUNDARY
+Content-Type: application/octet-stream
+Content-Transfer-Encoding: base64
+
+{}
+--BOUNDARY--
+"""
+
+# Attachment sizes in kilobytes.
+SIZES = (1, 10, 100, 1000)
+
+
+
+def _hops(switchboard, msg, count):
+    filebase = switchboard.enqueue(msg, listid='test.example.com')
+    for i in range(count):
+        msg, msgdata = switchboard.dequeue(filebase)
+        switchboard.finish(filebase)
+        msg.get('message-id')
+        msg['X-Hop'] = str(i)
+        filebase = switchboard.enqueue(msg, msgdata)
+    path = os.path.join(switchboard.queue_directory, filebase + '.pck')
+    return os.path.getsize(path)
+
+
+
+def main():
+    parser = benchmark_parser(__doc__.splitlines()[0])
+    args = parser.parse_args()
+    rows = []
+    with layers(ConfigLayer):
+        for size in SIZES:
+            # 57 bytes of data per 76 character base64 line.
+            lines = size * 1024 // 57 + 1
+            text = MESSAGE.format(
+                '\n'.join(['QUJD' * 19] * lines)).encode('ascii')
+            for format in ('pickle', 'raw'):
+                queue_directory = tempfile.mkdtemp()
+                try:
+                    switchboard = Switchboard(
+                        'bench', queue_directory, durability='relaxed')
+                    msg = email.message_from_bytes(text, Message)
+                    results = {}
+                    with timed(results, 'hops'):
+                        if format == 'pickle':
+                            with patch('mailman.core.switchboard._as_bytes',
+                                       return_value=None):
+                                filesize = _hops(switchboard, msg, args.count)
+                        else:
+                            filesize = _hops(switchboard, msg, args.count)
+                    seconds = results['hops']
+                    rows.append((size, format, filesize, args.count,
+                                 seconds, args.count / seconds))
+                finally:
+                    shutil.rmtree(queue_directory)
+    report('Queue hops by queue file format',
+           ('attachment KB', 'format', 'file bytes', 'hops', 'seconds',
+            'hops/sec'),
+           rows)
+
+
+if __name__ == '__main__':
+    main()
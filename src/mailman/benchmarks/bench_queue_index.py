@@ -0,0 +1,105 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Draining a deep queue with and without the incremental queue index.
+
+A queue directory is filled with the given number of files, which are then
+removed in batches the way a runner processes them.  Before each batch, the
+oldest files are picked either by listing and sorting the whole directory, or
+from the switchboard's in-memory index.
+"""
+
+__all__ = [
+    'main',
+    ]
+
+
+import os
+import time
+import shutil
+import tempfile
+
+from mailman.benchmarks.helpers import (
+    benchmark_parser, layers, report, timed)
+from mailman.core.runner import Runner
+from mailman.core.switchboard import Switchboard
+from mailman.testing.layers import ConfigLayer
+
+
+
+def fill(queue_directory, count):
+    """Create `count` (empty) queue files with unique, increasing times."""
+    now = time.time()
+    for i in range(count):
+        filebase = '{!r}+{:040x}'.format(now + i / 1000, i * 7919)
+        with open(os.path.join(queue_directory, filebase + '.pck'), 'wb'):
+            pass
+
+
+
+def drain(switchboard, pick):
+    """Remove all the files in the queue, in batches chosen by `pick`."""
+    batch_size = Runner.files_per_iteration
+    batches = 0
+    while True:
+        filebases = pick(switchboard, batch_size)
+        if len(filebases) == 0:
+            return batches
+        batches += 1
+        for filebase in filebases:
+            os.remove(os.path.join(
+                switchboard.queue_directory, filebase + '.pck'))
+
+
+
+
+def pick_listing(switchboard, count):
+    return switchboard.files[:count]
+
+
+
+
+def pick_index(switchboard, count):
+    return switchboard.next_files(count)
+
+
+
+def main():
+    parser = benchmark_parser(__doc__.splitlines()[0])
+    parser.set_defaults(count=20000)
+    args = parser.parse_args()
+    rows = []
+    with layers(ConfigLayer):
+        for name, pick in (('files', pick_listing),
+                           ('next_files', pick_index)):
+            queue_directory = tempfile.mkdtemp()
+            try:
+                fill(queue_directory, args.count)
+                switchboard = Switchboard('bench', queue_directory)
+                results = {}
+                with timed(results, 'drain'):
+                    batches = drain(switchboard, pick)
+                rows.append((name, args.count, batches, results['drain'],
+                             results['drain'] / batches))
+            finally:
+                shutil.rmtree(queue_directory)
+    report('Seconds to drain a queue in batches',
+           ('method', 'files', 'batches', 'total', 'per batch'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""End-to-end latency through the in, pipeline and out runners.
+
+Messages are injected one at a time into an idle system, and the time until
+each one reaches the SMTP server is measured, once with runners that sleep
+between queue scans and once with runners that wake up on notification.
+"""
+
+__all__ = [
+    'main',
+    ]
+
+
+import time
+import statistics
+
+from mailman.app.inject import inject_text
+from mailman.app.lifecycle import create_list
+from mailman.benchmarks.helpers import (
+    benchmark_parser, layers, pushed_configuration, report)
+from mailman.database.transaction import transaction
+from mailman.testing.helpers import TestableMaster, subscribe
+from mailman.testing.layers import ConfigLayer, SMTPLayer
+
+
+RUNNERS = ('in', 'pipeline', 'out')
+
+MESSAGE = """\
+From: aperson@example.com
+To: test@example.com
+Subject: Latency {0}
+Message-ID: <latency.{1}.{0}>
+
+Hello.
+"""
+
+
+
+def measure(mlist, wakeup, count):
+    """Return the per-message latencies for the given wakeup mode."""
+    overrides = ''.join(
+        '[runner.{}]\nwakeup: {}\n'.format(name, wakeup)
+        for name in RUNNERS)
+    latencies = []
+    with pushed_configuration('bench-' + wakeup, overrides):
+        master = TestableMaster()
+        master.start(*RUNNERS)
+        try:
+            # Give the runners a moment to settle into their idle loop.
+            time.sleep(2)
+            for i in range(count):
+                start = time.perf_counter()
+                inject_text(mlist, MESSAGE.format(i, wakeup))
+                SMTPLayer.smtpd.queue.get(timeout=60)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            master.stop()
+    return latencies
+
+
+
+def main():
+    parser = benchmark_parser(__doc__.splitlines()[0])
+    parser.set_defaults(count=20)
+    args = parser.parse_args()
+    rows = []
+    with layers(ConfigLayer, SMTPLayer):
+        with transaction():
+            mlist = create_list('test@example.com')
+            subscribe(mlist, 'Anne')
+        for wakeup in ('sleep', 'notify'):
+            latencies = measure(mlist, wakeup, args.count)
+            rows.append((wakeup, len(latencies),
+                         statistics.mean(latencies),
+                         statistics.median(latencies),
+                         max(latencies)))
+    report('Seconds from injection to SMTP delivery (3 hops)',
+           ('wakeup', 'messages', 'mean', 'median', 'max'), rows)
+
+
+if __name__ == '__main__':
+    main()
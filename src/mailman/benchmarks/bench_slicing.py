@@ -0,0 +1,112 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Slice balance and cache locality of message versus list slicing.
+
+Queue file names are generated for the given number of messages, spread
+over mailing lists with a Zipf distribution, so that a few lists get most of
+the traffic.  For each slicing mode, the names are assigned to slices as the
+runners would, and each slice's runner is given an LRU cache of list data.
+Reported are the busiest slice's share of the messages relative to a
+perfectly even split, the average number of lists each slice sees, and the
+cache hit rate.
+"""
+
+__all__ = [
+    'main',
+    ]
+
+
+import random
+
+from collections import OrderedDict
+from mailman.benchmarks.helpers import benchmark_parser, layers, report
+from mailman.core.switchboard import serialize, shamax
+from mailman.testing.helpers import specialized_message_from_string as mfs
+from mailman.testing.layers import ConfigLayer
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: Slicing
+Message-ID: <slicing>
+
+Slicing.
+"""
+
+
+
+def _hit_rate(list_ids, size):
+    cache = OrderedDict()
+    hits = 0
+    for list_id in list_ids:
+        if list_id in cache:
+            hits += 1
+            cache.move_to_end(list_id)
+        else:
+            cache[list_id] = True
+            if len(cache) > size:
+                cache.popitem(last=False)
+    return hits / max(1, len(list_ids))
+
+
+
+def main():
+    parser = benchmark_parser(__doc__.splitlines()[0])
+    parser.set_defaults(count=20000)
+    parser.add_argument(
+        '--lists', type=int, default=500,
+        help='The number of mailing lists.')
+    parser.add_argument(
+        '--slices', type=int, default=8,
+        help='The number of runner slices; a power of 2.')
+    parser.add_argument(
+        '--cache-size', type=int, default=32,
+        help='The number of lists each runner caches.')
+    parser.add_argument(
+        '--skew', type=float, default=1.0,
+        help='The exponent of the Zipf distribution of list traffic.')
+    args = parser.parse_args()
+    randomizer = random.Random(0)
+    weights = [1 / (rank ** args.skew) for rank in range(1, args.lists + 1)]
+    traffic = randomizer.choices(
+        ['list{}.example.com'.format(i) for i in range(args.lists)],
+        weights, k=args.count)
+    msg = mfs(MESSAGE)
+    rows = []
+    with layers(ConfigLayer):
+        for slicing in ('message', 'list'):
+            slices = [[] for i in range(args.slices)]
+            for list_id in traffic:
+                filebase = serialize(
+                    msg, None, dict(listid=list_id), slicing == 'list')[0]
+                digest = int(filebase.split('+')[1], 16)
+                slices[digest * args.slices // (shamax + 1)].append(list_id)
+            busiest = max(len(slice) for slice in slices)
+            lists = sum(len(set(slice)) for slice in slices) / args.slices
+            hits = sum(_hit_rate(slice, args.cache_size) * len(slice)
+                       for slice in slices) / args.count
+            rows.append((slicing, busiest * args.slices / args.count,
+                         lists, hits))
+    report('Slicing of {} messages to {} lists over {} slices'.format(
+               args.count, args.lists, args.slices),
+           ('slicing', 'busiest/even', 'lists/slice', 'cache hits'), rows)
+
+
+if __name__ == '__main__':
+    main()
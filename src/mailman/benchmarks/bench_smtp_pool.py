@@ -0,0 +1,89 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""SMTP connections and time per message with and without a connection pool.
+
+The given number of messages is delivered to the test SMTP server, which
+counts the connections it accepts.  Without a pool, every delivery opens
+its own connection; with a pool, the deliveries share its connections as
+they do in the outgoing runner.
+"""
+
+__all__ = [
+    'main',
+    ]
+
+
+from contextlib import ExitStack
+from mailman.app.lifecycle import create_list
+from mailman.benchmarks.helpers import (
+    benchmark_parser, layers, report, timed)
+from mailman.config import config
+from mailman.mta.connection import ConnectionPool
+from mailman.mta.deliver import deliver
+from mailman.testing.helpers import specialized_message_from_string as mfs
+from mailman.testing.layers import ConfigLayer, SMTPLayer
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: Pooling
+Message-ID: <pooling>
+
+Pooling.
+"""
+
+
+
+def main():
+    parser = benchmark_parser(__doc__.splitlines()[0])
+    parser.set_defaults(count=1000)
+    parser.add_argument(
+        '--sessions', type=int, default=0,
+        help='The number of sessions per connection; 0 is unlimited.')
+    args = parser.parse_args()
+    rows = []
+    with layers(ConfigLayer, SMTPLayer):
+        mlist = create_list('test@example.com')
+        msg = mfs(MESSAGE)
+        smtpd = SMTPLayer.smtpd
+        for pooled in (False, True):
+            results = {}
+            with ExitStack() as resources:
+                if pooled:
+                    pool = ConnectionPool(
+                        config.mta.smtp_host, int(config.mta.smtp_port),
+                        args.sessions)
+                    resources.callback(pool.quit)
+                    resources.enter_context(pool.shared())
+                with timed(results, 'time'):
+                    for i in range(args.count):
+                        deliver(mlist, msg, dict(
+                            recipients=['bart@example.com']))
+            connections = smtpd.get_connection_count()
+            smtpd.reset()
+            smtpd.clear()
+            rows.append(('pool' if pooled else 'none', connections,
+                         connections * 1000 / args.count,
+                         results['time'] / args.count * 1000))
+    report('Delivery of {} messages'.format(args.count),
+           ('pooling', 'connections', 'per 1000 msgs', 'ms/msg'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark helpers.
+
+Benchmarks are not run as part of the test suite.  Each benchmark module is
+a script which sets up the same throw-away environment as the test layers,
+e.g.:
+
+    $ python -m mailman.benchmarks.bench_runner_latency
+"""
+
+__all__ = [
+    'benchmark_parser',
+    'layers',
+    'pushed_configuration',
+    'report',
+    'timed',
+    ]
+
+
+import os
+import time
+import argparse
+
+from contextlib import contextmanager
+from mailman.config import config
+from textwrap import dedent
+
+
+
+@contextmanager
+def layers(*layer_classes):
+    """Set up test layers for the duration of a benchmark.
+
+    :param layer_classes: The layers to set up, outermost first, e.g.
+        `ConfigLayer`, `SMTPLayer`.
+    """
+    for layer in layer_classes:
+        layer.setUp()
+    try:
+        # Only the outermost layer adds the example.com domain.
+        layer_classes[0].testSetUp()
+        try:
+            yield
+        finally:
+            layer_classes[0].testTearDown()
+    finally:
+        for layer in reversed(layer_classes):
+            layer.tearDown()
+
+
+
+@contextmanager
+def pushed_configuration(name, text):
+    """Push additional configuration, also for runner subprocesses.
+
+    The configuration is pushed onto the in-process configuration stack, and
+    a copy of the layer's configuration file containing the extra text is
+    used as `config.filename` for any runner subprocesses started by a
+    `TestableMaster`.
+
+    :param name: The name of the configuration to push.
+    :type name: str
+    :param text: The configuration text.
+    :type text: str
+    """
+    text = dedent(text)
+    original_filename = config.filename
+    with open(original_filename) as fp:
+        base = fp.read()
+    filename = os.path.join(os.path.dirname(original_filename),
+                            '{}.cfg'.format(name))
+    with open(filename, 'w') as fp:
+        fp.write(base)
+        fp.write(text)
+    config.push(name, text)
+    config.filename = filename
+    try:
+        yield
+    finally:
+        config.filename = original_filename
+        config.pop(name)
+        os.remove(filename)
+
+
+
+@contextmanager
+def timed(results, key):
+    """Record the wall clock seconds spent in the block in `results[key]`."""
+    start = time.perf_counter()
+    yield
+    results[key] = time.perf_counter() - start
+
+
+
+def benchmark_parser(description):
+    """Return an argument parser with the options common to all benchmarks."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        '-n', '--count', type=int, default=100,
+        help='The number of operations to time for each configuration.')
+    return parser
+
+
+
+def report(title, columns, rows):
+    """Print a table of benchmark results.
+
+    :param title: The title of the table.
+    :type title: str
+    :param columns: The column headings.
+    :type columns: sequence of str
+    :param rows: The table rows.  Floats are printed with 4 decimal places.
+    :type rows: sequence of sequences
+    """
+    cells = [[('{:.4f}'.format(value) if isinstance(value, float)
+               else str(value))
+              for value in row]
+             for row in rows]
+    widths = [max([len(column)] + [len(row[i]) for row in cells])
+              for i, column in enumerate(columns)]
+    print(title)
+    print('  '.join(column.rjust(width)
+                    for column, width in zip(columns, widths)))
+    print('  '.join('-' * width for width in widths))
+    for row in cells:
+        print('  '.join(cell.rjust(width)
+                        for cell, width in zip(row, widths)))
+    print()
@@ -22,9 +22,8 @@ __all__ = [
     ]
 
 
-import pickle
-
 from mailman.core.i18n import _
+from mailman.core.switchboard import read_entry
 from mailman.interfaces.command import ICLISubCommand
 from mailman.utilities.interact import interact
 from pprint import PrettyPrinter
@@ -69,17 +68,15 @@ class QFile:
         printer = PrettyPrinter(indent=4)
         assert len(args.qfile) == 1, 'Wrong number of positional arguments'
         with open(args.qfile[0], 'rb') as fp:
-            while True:
-                try:
-                    m.append(pickle.load(fp))
-                except EOFError:
-                    break
+            m.extend(read_entry(fp))
         if args.doprint:
             print(_('[----- start pickle -----]'))
             for i, obj in enumerate(m):
                 count = i + 1
                 print(_('<----- start object $count ----->'))
-                if isinstance(obj, (bytes, str)):
+                if isinstance(obj, bytes):
+                    print(obj.decode('utf-8', 'replace'))
+                elif isinstance(obj, str):
                     print(obj)
                 else:
                     printer.pprint(obj)
@@ -72,6 +72,7 @@ class Configuration:
     def __init__(self):
         self.switchboards = {}
         self.QFILE_SCHEMA_VERSION = version.QFILE_SCHEMA_VERSION
+        self.QFILE_FORMAT_VERSION = version.QFILE_FORMAT_VERSION
         self._config = None
         self.filename = None
         # Whether to create run-time paths or not.  This is for the test
@@ -271,6 +272,18 @@ class Configuration:
             archiver.is_enabled = as_boolean(section.enable)
             yield archiver
 
+    @property
+    def destination_configs(self):
+        """Iterate over all the delivery destination sections."""
+        for section in self._config.getByCategory('destination', []):
+            yield section
+
+    @property
+    def smarthost_configs(self):
+        """Iterate over all the smarthost sections."""
+        for section in self._config.getByCategory('smarthost', []):
+            yield section
+
     @property
     def language_configs(self):
         """Iterate over all the language configuration sections."""
@@ -0,0 +1,461 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Queuing and dequeuing messages through a database table.
+
+Unlike the file based switchboard, this lets runners on several hosts share a
+queue.  The queue entries live in Mailman's own database.  With PostgreSQL,
+runners claim them with SELECT ... FOR UPDATE SKIP LOCKED, so that they don't
+wait on each other.  Only with SQLite do the entries live in a database file
+of their own in the queue directory instead, which serializes all writers and
+can't be shared between hosts.
+
+The shards of a message share a single copy of the message, which is
+deleted along with the last of them.
+
+A runner claims the entries it is going to process by leasing them for a
+while.  Dequeuing an entry is the equivalent of moving a queue file to its
+.bak file; when the lease of a dequeued entry expires because its runner went
+away, the entry is recovered just like a .bak file would be.
+"""
+
+__all__ = [
+    'DatabaseSwitchboard',
+    ]
+
+
+import os
+import time
+import pickle
+import socket
+import logging
+import threading
+
+from lazr.config import as_timedelta
+from mailman.config import config
+from mailman.core.switchboard import (
+    LANES, MAX_BAK_COUNT, EnqueueBatch, deserialize, serialize, sort_key,
+    split_filebase, write_entry)
+from mailman.interfaces.switchboard import ISwitchboard
+from mailman.model.queueentry import queue_bodies, queue_entries
+from mailman.utilities.filesystem import makedirs
+from sqlalchemy import and_, create_engine, func, or_, select
+from zope.interface import implementer
+
+
+# Queue entries are sliced by the first 31 bits of their 160 bit digest.
+BUCKETS = 2 ** 31
+BUCKET_SHIFT = 160 - 31
+# How often wait() checks the database for new entries, in seconds.
+POLL_INTERVAL = 0.25
+# The default lease time for switchboards without a runner section.
+LEASE_TIME = 600
+# How long an SQLite writer waits for another one, in seconds.
+SQLITE_TIMEOUT = 30
+
+elog = logging.getLogger('mailman.error')
+rlog = logging.getLogger('mailman.runner')
+
+
+
+@implementer(ISwitchboard)
+class DatabaseSwitchboard:
+    """See `ISwitchboard`."""
+
+    def __init__(self, name, queue_directory,
+                 slice=None, numslices=1, recover=False,
+                 durability='strict', sync_interval=0, slicing='message',
+                 priority_head_start=0):
+        """Create a database switchboard.
+
+        The arguments are the same as for the file based `Switchboard`.  The
+        queue directory is only used to hold the queue database with SQLite.
+        Durability is left to the database.
+        """
+        assert (numslices & (numslices - 1)) == 0, (
+            'Not a power of 2: {0}'.format(numslices))
+        assert slicing in ('message', 'list'), (
+            'Bad slicing value: {0}'.format(slicing))
+        self.name = name
+        self.queue_directory = queue_directory
+        self.slicing = slicing
+        self.priority_head_start = priority_head_start
+        # The global switchboards are created when the configuration is
+        # loaded, before the database is available, so connect lazily.
+        self._engine_instance = None
+        self._lower = None
+        self._upper = None
+        if numslices != 1:
+            self._lower = BUCKETS * slice // numslices
+            self._upper = BUCKETS * (slice + 1) // numslices - 1
+        # The owner prefix identifies this slice of the queue on this host,
+        # so that a restarted runner can immediately recover what it had
+        # dequeued before.
+        self._owner_prefix = '{0}:{1}:{2}:'.format(
+            socket.gethostname(), name, slice)
+        self._owner = self._owner_prefix + str(os.getpid())
+        section = getattr(config, 'runner.' + name, None)
+        self.lease_time = (
+            LEASE_TIME if section is None
+            else as_timedelta(section.lease_time).total_seconds())
+        # Entries enqueued during an EnqueueBatch, by file base.
+        self._pending = {}
+        # The dequeued entries, whose leases are renewed until they are
+        # finished or requeued.
+        self._lock = threading.Lock()
+        self._leased = set()
+        self._renewer = None
+        if recover:
+            self.recover_backup_files()
+
+    @property
+    def _engine(self):
+        if self._engine_instance is None:
+            if config.db.engine.dialect.name != 'sqlite':
+                engine = config.db.engine
+            else:
+                rlog.warning(
+                    'The %s queue is kept in a local SQLite database, which '
+                    'runners on other hosts cannot share', self.name)
+                if config.create_paths:
+                    makedirs(self.queue_directory, 0o770)
+                url = 'sqlite:///' + os.path.join(
+                    self.queue_directory, 'queue.db')
+                engine = create_engine(
+                    url, connect_args=dict(timeout=SQLITE_TIMEOUT))
+                # The queue's own database is not managed by Mailman's
+                # schema migrations.
+                queue_entries.create(engine, checkfirst=True)
+                queue_bodies.create(engine, checkfirst=True)
+            self._engine_instance = engine
+        return self._engine_instance
+
+    def _where(self, *conditions):
+        conditions = (queue_entries.c.queue == self.name,) + conditions
+        if self._lower is not None:
+            conditions += (
+                queue_entries.c.bucket.between(self._lower, self._upper),)
+        return and_(*conditions)
+
+    def _claimable(self, now):
+        return and_(
+            queue_entries.c.dequeued == False,
+            or_(queue_entries.c.owner == None,
+                queue_entries.c.owner == self._owner,
+                queue_entries.c.lease_expires < now))
+
+    def enqueue(self, _msg, _metadata=None, **_kws):
+        """See `ISwitchboard`."""
+        filebase, msgsave, datasave = serialize(
+            _msg, _metadata, _kws, self.slicing == 'list')
+        self._enqueue(filebase, msgsave, datasave)
+        return filebase
+
+    def enqueue_shards(self, _msg, shards, _metadata=None, **_kws):
+        """See `ISwitchboard`."""
+        # The message is stored once, along with the first shard, and every
+        # shard's entry holds the message's key instead.
+        filebases = []
+        body = None
+        for index, shard in enumerate(shards):
+            data = ({} if _metadata is None else _metadata.copy())
+            data.update(shard)
+            filebase, msgsave, datasave = serialize(
+                _msg, data, _kws, self.slicing == 'list',
+                (index, len(shards)), shared=True)
+            if body is None:
+                body = dict(key=filebase, message=msgsave,
+                            shards=len(shards))
+            self._enqueue(filebase, body['key'].encode('ascii'), datasave,
+                          (body if index == 0 else None))
+            filebases.append(filebase)
+        return filebases
+
+    def _enqueue(self, filebase, msgsave, datasave, body=None):
+        when, digest, lane = split_filebase(filebase)
+        entry = dict(
+            queue=self.name,
+            filebase=filebase,
+            received=sort_key(when, lane, self.priority_head_start),
+            bucket=digest >> BUCKET_SHIFT,
+            message=msgsave,
+            metadata=datasave,
+            dequeued=False,
+            bak_count=0,
+            )
+        batch = EnqueueBatch.active()
+        if batch is None:
+            self._insert(entry, body)
+        else:
+            self._pending[filebase] = (entry, body)
+            batch.pending.append((self, filebase))
+
+    def _insert(self, entry, body=None):
+        with self._engine.begin() as connection:
+            # The message must exist before any of its shards are dequeued.
+            if body is not None:
+                connection.execute(queue_bodies.insert(), body)
+            connection.execute(queue_entries.insert(), entry)
+
+    def _publish(self, filebase):
+        self._insert(*self._pending.pop(filebase))
+
+    def _discard(self, filebase):
+        self._pending.pop(filebase, None)
+
+    def dequeue(self, filebase):
+        """See `ISwitchboard`."""
+        now = time.time()
+        entry_is = queue_entries.c.filebase == filebase
+        with self._engine.begin() as connection:
+            result = connection.execute(
+                queue_entries.update().where(
+                    self._where(entry_is, self._claimable(now))).values(
+                    owner=self._owner,
+                    lease_expires=now + self.lease_time,
+                    dequeued=True))
+            if result.rowcount != 1:
+                raise LookupError(
+                    'No such queue entry: {0}'.format(filebase))
+            row = connection.execute(
+                select([queue_entries.c.message, queue_entries.c.metadata])
+                .where(entry_is)).first()
+            data = pickle.loads(row.metadata)
+            msgsave = self._message(connection, row, data)
+        self._hold(filebase)
+        msg = (msgsave if data.get('_rawmsg') else pickle.loads(msgsave))
+        return deserialize(msg, data)
+
+    def _message(self, connection, row, data):
+        # Return the entry's stored message, which is shared by all the
+        # shards of a message.  The shared flag is removed from the data.
+        if not data.pop('_sharedmsg', False):
+            return row.message
+        return connection.execute(
+            select([queue_bodies.c.message]).where(
+                queue_bodies.c.key == row.message.decode('ascii'))).scalar()
+
+    def _delete(self, connection, row, condition):
+        # Delete the entry if it matches the condition, and its shared
+        # message along with the last of the shards sharing it.
+        result = connection.execute(queue_entries.delete().where(condition))
+        if (result.rowcount != 1 or
+                not pickle.loads(row.metadata).get('_sharedmsg')):
+            return
+        body_is = queue_bodies.c.key == row.message.decode('ascii')
+        connection.execute(queue_bodies.update().where(body_is).values(
+            shards=queue_bodies.c.shards - 1))
+        connection.execute(queue_bodies.delete().where(
+            and_(body_is, queue_bodies.c.shards <= 0)))
+
+    def _hold(self, filebase):
+        with self._lock:
+            self._leased.add(filebase)
+            if self._renewer is None:
+                self._renewer = threading.Thread(
+                    target=self._renew_leases, daemon=True)
+                self._renewer.start()
+
+    def _release(self, filebase):
+        with self._lock:
+            self._leased.discard(filebase)
+
+    def _renew_leases(self):
+        # Keep the leases of the entries being processed from expiring, so
+        # that a slow message isn't recovered and processed again elsewhere.
+        while True:
+            time.sleep(self.lease_time / 3)
+            with self._lock:
+                if len(self._leased) == 0:
+                    self._renewer = None
+                    return
+                filebases = list(self._leased)
+            try:
+                with self._engine.begin() as connection:
+                    connection.execute(queue_entries.update().where(and_(
+                        queue_entries.c.filebase.in_(filebases),
+                        queue_entries.c.owner == self._owner)).values(
+                        lease_expires=time.time() + self.lease_time))
+            except Exception as error:
+                # The next dequeue starts renewing again.
+                elog.error('Failed to renew queue entry leases: %s', error)
+                with self._lock:
+                    self._renewer = None
+                return
+
+    def _preserve(self, connection, row):
+        # The preserved file has a copy of the shared message of a shard.
+        data = pickle.loads(row.metadata)
+        msgsave = self._message(connection, row, data)
+        bad_dir = config.switchboards['bad'].queue_directory
+        psvfile = os.path.join(bad_dir, row.filebase + '.psv')
+        with open(psvfile, 'wb') as fp:
+            write_entry(fp, msgsave, pickle.dumps(
+                data, pickle.HIGHEST_PROTOCOL))
+
+    def finish(self, filebase, preserve=False):
+        """See `ISwitchboard`."""
+        self._release(filebase)
+        # Once the lease is lost, the entry belongs to another runner.
+        entry_is = and_(queue_entries.c.filebase == filebase,
+                        queue_entries.c.owner == self._owner)
+        try:
+            with self._engine.begin() as connection:
+                row = connection.execute(
+                    select([queue_entries.c.filebase,
+                            queue_entries.c.message,
+                            queue_entries.c.metadata])
+                    .where(entry_is)).first()
+                if row is None:
+                    elog.error('Lost the lease of queue entry: %s', filebase)
+                    return
+                if preserve:
+                    self._preserve(connection, row)
+                self._delete(connection, row, entry_is)
+        except Exception:
+            elog.exception(
+                'Failed to remove/preserve queue entry: %s', filebase)
+
+    def requeue(self, filebase):
+        """See `ISwitchboard`."""
+        self._release(filebase)
+        with self._engine.begin() as connection:
+            connection.execute(
+                queue_entries.update().where(and_(
+                    queue_entries.c.filebase == filebase,
+                    queue_entries.c.owner == self._owner)).values(
+                    owner=None, lease_expires=None, dequeued=False))
+
+    def sync(self):
+        """See `ISwitchboard`."""
+        # Every queue entry is committed to the database as it is written.
+        pass
+
+    def wait(self, timeout=None):
+        """See `ISwitchboard`."""
+        deadline = (None if timeout is None else time.time() + timeout)
+        query = select([queue_entries.c.id]).where(
+            self._where(queue_entries.c.owner == None)).limit(1)
+        while True:
+            with self._engine.connect() as connection:
+                if connection.execute(query).first() is not None:
+                    return True
+            if deadline is None:
+                interval = POLL_INTERVAL
+            else:
+                interval = min(POLL_INTERVAL, deadline - time.time())
+                if interval <= 0:
+                    return False
+            time.sleep(interval)
+
+    @property
+    def files(self):
+        """See `ISwitchboard`."""
+        return self.get_files()
+
+    def get_files(self, extension='.pck'):
+        """See `ISwitchboard`."""
+        # Dequeued entries are the equivalent of .bak files.
+        query = select([queue_entries.c.filebase]).where(self._where(
+            queue_entries.c.dequeued == (extension == '.bak'))).order_by(
+            queue_entries.c.received)
+        with self._engine.connect() as connection:
+            return [row.filebase for row in connection.execute(query)]
+
+    def backlog(self):
+        """See `ISwitchboard`."""
+        pending = self._where(queue_entries.c.dequeued == False)
+        with self._engine.connect() as connection:
+            count = connection.execute(
+                select([func.count()]).select_from(queue_entries)
+                .where(pending)).scalar()
+            head = connection.execute(
+                select([queue_entries.c.filebase]).where(pending)
+                .order_by(queue_entries.c.received).limit(1)).first()
+        if head is None:
+            return count, None
+        when, digest, lane = split_filebase(head.filebase)
+        return count, when
+
+    def lane_depths(self):
+        """See `ISwitchboard`."""
+        depths = {lane: 0 for lane in LANES}
+        for filebase in self.get_files():
+            when, digest, lane = split_filebase(filebase)
+            depths[lane] += 1
+        return depths
+
+    def next_files(self, count=None):
+        """See `ISwitchboard`."""
+        now = time.time()
+        self._recover(queue_entries.c.lease_expires < now)
+        with self._engine.begin() as connection:
+            candidates = select([queue_entries.c.id]).where(
+                self._where(self._claimable(now))).order_by(
+                queue_entries.c.received).limit(count)
+            if self._engine.dialect.name == 'postgresql':
+                # Don't wait for entries which other runners are claiming
+                # right now; there are plenty of others.
+                candidates = candidates.with_for_update(skip_locked=True)
+            ids = [row.id for row in connection.execute(candidates)]
+            if len(ids) > 0:
+                # Without SKIP LOCKED, another runner may have claimed some
+                # of the candidates in the meantime, so check again.
+                connection.execute(
+                    queue_entries.update().where(and_(
+                        queue_entries.c.id.in_(ids),
+                        self._claimable(now))).values(
+                        owner=self._owner,
+                        lease_expires=now + self.lease_time))
+            claimed = select([queue_entries.c.filebase]).where(self._where(
+                queue_entries.c.owner == self._owner,
+                queue_entries.c.dequeued == False)).order_by(
+                queue_entries.c.received).limit(count)
+            return [row.filebase for row in connection.execute(claimed)]
+
+    def _recover(self, condition):
+        # Put dequeued entries matching the condition back into the queue,
+        # counting how often that happened.  This is the equivalent of moving
+        # .bak files back to .pck files.
+        query = select([queue_entries.c.filebase,
+                        queue_entries.c.message,
+                        queue_entries.c.metadata,
+                        queue_entries.c.bak_count]).where(
+            self._where(queue_entries.c.dequeued == True, condition))
+        with self._engine.begin() as connection:
+            for row in connection.execute(query).fetchall():
+                bak_count = row.bak_count + 1
+                if bak_count >= MAX_BAK_COUNT:
+                    elog.error('.bak file max count, preserving file: %s',
+                               row.filebase)
+                    self._preserve(connection, row)
+                    self._delete(connection, row,
+                                 queue_entries.c.filebase == row.filebase)
+                else:
+                    connection.execute(
+                        queue_entries.update().where(and_(
+                            queue_entries.c.filebase == row.filebase,
+                            condition)).values(
+                            owner=None, lease_expires=None, dequeued=False,
+                            bak_count=bak_count))
+
+    def recover_backup_files(self):
+        """See `ISwitchboard`."""
+        # Recover everything this slice of the queue on this host had
+        # dequeued, without waiting for the leases to expire.  There's only
+        # ever one runner per slice and host.
+        self._recover(queue_entries.c.owner.startswith(self._owner_prefix))
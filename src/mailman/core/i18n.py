@@ -18,6 +18,7 @@
 """Internationalization."""
 
 __all__ = [
+    'ThreadLocalApplication',
     '_',
     'ctime',
     'initialize',
@@ -25,15 +26,42 @@ __all__ = [
 
 
 import time
+import threading
 import mailman.messages
 
-from flufl.i18n import PackageStrategy, registry
+from flufl.i18n import Application, PackageStrategy
 from mailman.interfaces.configuration import ConfigurationUpdatedEvent
 
 
 _ = None
 
 
+
+class ThreadLocalApplication(Application):
+    """An application whose translation contexts are per thread.
+
+    Runners may process several messages at the same time in worker threads,
+    each in the language of its own message, so every thread gets its own
+    stack of translation contexts.  The default language is shared by all
+    threads.
+    """
+
+    def __init__(self, strategy):
+        self._local = threading.local()
+        super().__init__(strategy)
+
+    @property
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @_stack.setter
+    def _stack(self, stack):
+        self._local.stack = stack
+
+
 
 def initialize(application=None):
     """Initialize the i18n subsystem.
@@ -46,7 +74,7 @@ def initialize(application=None):
     global _
     if application is None:
         strategy = PackageStrategy('mailman', mailman.messages)
-        application = registry.register(strategy)
+        application = ThreadLocalApplication(strategy)
     _ = application._
 
 
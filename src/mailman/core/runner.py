@@ -27,15 +27,18 @@ import signal
 import logging
 import traceback
 
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from io import StringIO
 from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.core.logging import reopen
-from mailman.core.switchboard import Switchboard
+from mailman.core.switchboard import EnqueueBatch
 from mailman.interfaces.languages import ILanguageManager
 from mailman.interfaces.listmanager import IListManager
 from mailman.interfaces.runner import IRunner, RunnerCrashEvent
+from mailman.utilities.modules import call_name
 from mailman.utilities.string import expand
 from zope.component import getUtility
 from zope.event import notify
@@ -51,6 +54,10 @@ rlog = logging.getLogger('mailman.runner')
 @implementer(IRunner)
 class Runner:
     is_queue_runner = True
+    # The maximum number of queue files to process in one iteration.  The
+    # queue is looked at again afterward, so newly arrived files are not
+    # stuck behind a long backlog.
+    files_per_iteration = 100
 
     def __init__(self, name, slice=None):
         """Create a runner.
@@ -70,8 +77,12 @@ class Runner:
         # should not have queue_directory or switchboard instance.
         if self.is_queue_runner:
             self.queue_directory = expand(section.path, substitutions)
-            self.switchboard = Switchboard(
-                name, self.queue_directory, slice, numslices, True)
+            self.switchboard = call_name(
+                section.switchboard, name, self.queue_directory, slice,
+                numslices, True, section.durability,
+                as_timedelta(section.sync_interval).total_seconds(),
+                section.slicing,
+                as_timedelta(section.priority_head_start).total_seconds())
         else:
             self.queue_directory = None
             self.switchboard= None
@@ -80,6 +91,22 @@ class Runner:
         self.sleep_float = (86400 * self.sleep_time.days +
                             self.sleep_time.seconds +
                             self.sleep_time.microseconds / 1.0e6)
+        # How to wait for new work when the queue is empty.
+        self.wakeup = section.wakeup
+        assert self.wakeup in ('sleep', 'notify'), (
+            'Bad wakeup value: {0}'.format(self.wakeup))
+        # How many queue files to process per transaction, and for how long.
+        self.batch_size = int(section.batch_size)
+        batch_time = as_timedelta(section.batch_time)
+        self.batch_float = (86400 * batch_time.days +
+                            batch_time.seconds +
+                            batch_time.microseconds / 1.0e6)
+        # How many queue files to process at the same time.  The worker
+        # threads are only started when they are first needed.
+        self.concurrency = int(section.concurrency)
+        self._executor = None
+        # Processed files whose finishing waits for the next queue sync.
+        self._unfinished = []
         self.max_restarts = int(section.max_restarts)
         self.start = as_boolean(section.start)
         self._stop = False
@@ -121,6 +148,9 @@ class Runner:
                 # Once through the loop that processes all the files in the
                 # queue directory.
                 filecnt = self._one_iteration()
+                # Make sure nothing enqueued with batched durability stays
+                # unsynced while we're idle.
+                self._sync_queues()
                 # Do the periodic work for the subclass.
                 self._do_periodic()
                 # If the stop flag is set, we're done.
@@ -133,71 +163,29 @@ class Runner:
         except KeyboardInterrupt:
             pass
         finally:
+            self._sync_queues()
             self._clean_up()
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
 
     def _one_iteration(self):
         """See `IRunner`."""
         me = self.__class__.__name__
         dlog.debug('[%s] starting oneloop', me)
-        # List all the files in our queue directory.  The switchboard is
-        # guaranteed to hand us the files in FIFO order.
-        files = self.switchboard.files
-        for filebase in files:
-            dlog.debug('[%s] processing filebase: %s', me, filebase)
-            try:
-                # Ask the switchboard for the message and metadata objects
-                # associated with this queue file.
-                msg, msgdata = self.switchboard.dequeue(filebase)
-            except Exception as error:
-                # This used to just catch email.Errors.MessageParseError, but
-                # other problems can occur in message parsing, e.g.
-                # ValueError, and exceptions can occur in unpickling too.  We
-                # don't want the runner to die, so we just log and skip this
-                # entry, but preserve it for analysis.
-                self._log(error)
-                elog.error('Skipping and preserving unparseable message: %s',
-                           filebase)
-                self.switchboard.finish(filebase, preserve=True)
-                config.db.abort()
-                continue
-            try:
-                dlog.debug('[%s] processing onefile', me)
-                self._process_one_file(msg, msgdata)
-                dlog.debug('[%s] finishing filebase: %s', me, filebase)
-                self.switchboard.finish(filebase)
-            except Exception as error:
-                # All runners that implement _dispose() must guarantee that
-                # exceptions are caught and dealt with properly.  Still, there
-                # may be a bug in the infrastructure, and we do not want those
-                # to cause messages to be lost.  Any uncaught exceptions will
-                # cause the message to be stored in the shunt queue for human
-                # intervention.
-                self._log(error)
-                # Put a marker in the metadata for unshunting.
-                msgdata['whichq'] = self.switchboard.name
-                # It is possible that shunting can throw an exception, e.g. a
-                # permissions problem or a MemoryError due to a really large
-                # message.  Try to be graceful.
-                try:
-                    shunt = config.switchboards['shunt']
-                    new_filebase = shunt.enqueue(msg, msgdata)
-                    elog.error('SHUNTING: %s', new_filebase)
-                    self.switchboard.finish(filebase)
-                except Exception as error:
-                    # The message wasn't successfully shunted.  Log the
-                    # exception and try to preserve the original queue entry
-                    # for possible analysis.
-                    self._log(error)
-                    elog.error(
-                        'SHUNTING FAILED, preserving original entry: %s',
-                        filebase)
-                    self.switchboard.finish(filebase, preserve=True)
-                config.db.abort()
-            # Other work we want to do each time through the loop.
-            dlog.debug('[%s] doing periodic', me)
-            self._do_periodic()
-            dlog.debug('[%s] committing transaction', me)
-            config.db.commit()
+        files = self._next_files()
+        processed = 0
+        if self.concurrency > 1:
+            # Short circuiting is handled by the dispatcher.
+            self._dispatch(files)
+            processed = len(files)
+        while processed < len(files):
+            if self.batch_size > 1:
+                processed += self._one_batch(
+                    files[processed:processed + self.batch_size])
+            else:
+                self._one_file(files[processed])
+                processed += 1
             dlog.debug('[%s] checking short circuit', me)
             if self._short_circuit():
                 dlog.debug('[%s] short circuiting', me)
@@ -205,6 +193,242 @@ class Runner:
         dlog.debug('[%s] ending oneloop: %s', me, len(files))
         return len(files)
 
+    def _next_files(self):
+        """See `IRunner`."""
+        # Get the oldest files in our queue directory.  The switchboard is
+        # guaranteed to hand us the files in FIFO order.
+        return self.switchboard.next_files(self.files_per_iteration)
+
+    def _one_file(self, filebase):
+        """Process one queue file in its own transaction."""
+        me = self.__class__.__name__
+        dlog.debug('[%s] processing filebase: %s', me, filebase)
+        try:
+            # Ask the switchboard for the message and metadata objects
+            # associated with this queue file.
+            msg, msgdata = self.switchboard.dequeue(filebase)
+        except Exception as error:
+            # This used to just catch email.Errors.MessageParseError, but
+            # other problems can occur in message parsing, e.g.
+            # ValueError, and exceptions can occur in unpickling too.  We
+            # don't want the runner to die, so we just log and skip this
+            # entry, but preserve it for analysis.
+            self._log(error)
+            elog.error('Skipping and preserving unparseable message: %s',
+                       filebase)
+            self.switchboard.finish(filebase, preserve=True)
+            config.db.abort()
+            return
+        try:
+            dlog.debug('[%s] processing onefile', me)
+            self._process_one_file(msg, msgdata)
+            dlog.debug('[%s] finishing filebase: %s', me, filebase)
+            self._finish(filebase)
+        except Exception as error:
+            # All runners that implement _dispose() must guarantee that
+            # exceptions are caught and dealt with properly.  Still, there
+            # may be a bug in the infrastructure, and we do not want those
+            # to cause messages to be lost.  Any uncaught exceptions will
+            # cause the message to be stored in the shunt queue for human
+            # intervention.
+            self._log(error)
+            preserve = self._shunt(filebase, msg, msgdata)
+            self._finish(filebase, preserve=preserve)
+            config.db.abort()
+        # Other work we want to do each time through the loop.
+        dlog.debug('[%s] doing periodic', me)
+        self._do_periodic()
+        dlog.debug('[%s] committing transaction', me)
+        config.db.commit()
+
+    def _finish(self, filebase, preserve=False):
+        """Finish a processed queue file.
+
+        If any queue has batched durability, what the file's processing
+        enqueued may not be on disk yet.  The file is then only finished by
+        the next `_sync_queues()`, so that a crash in between leaves its
+        backup file to be recovered.
+
+        :param filebase: The processed queue file.
+        :type filebase: str
+        :param preserve: Whether to preserve the queue file for analysis.
+        :type preserve: bool
+        """
+        if not preserve and any(
+                getattr(switchboard, 'durability', None) == 'batched'
+                for switchboard in config.switchboards.values()):
+            self._unfinished.append(filebase)
+        else:
+            self.switchboard.finish(filebase, preserve=preserve)
+
+    def _shunt(self, filebase, msg, msgdata):
+        """Move a message which could not be processed to the shunt queue.
+
+        :param filebase: The queue file the message was dequeued from.
+        :type filebase: str
+        :param msg: The message.
+        :type msg: `Message`
+        :param msgdata: The message metadata.
+        :type msgdata: dict
+        :return: True if the message could not be shunted, so the original
+            queue file must be preserved.
+        :rtype: bool
+        """
+        # Put a marker in the metadata for unshunting.
+        msgdata['whichq'] = self.switchboard.name
+        # It is possible that shunting can throw an exception, e.g. a
+        # permissions problem or a MemoryError due to a really large
+        # message.  Try to be graceful.
+        try:
+            shunt = config.switchboards['shunt']
+            new_filebase = shunt.enqueue(msg, msgdata)
+            elog.error('SHUNTING: %s', new_filebase)
+            return False
+        except Exception as error:
+            # The message wasn't successfully shunted.  Log the exception
+            # and try to preserve the original queue entry for possible
+            # analysis.
+            self._log(error)
+            elog.error(
+                'SHUNTING FAILED, preserving original entry: %s', filebase)
+            return True
+
+    def _dispatch(self, filebases):
+        """Process queue files concurrently in a pool of worker threads.
+
+        Up to `concurrency` files are processed at the same time, each in a
+        worker thread with its own database session and transaction.  The
+        files are dequeued and finished in this thread, in FIFO order, so a
+        file is only finished once all the files before it are.  No more
+        than twice `concurrency` files are dequeued but not yet finished, so
+        a slow file holds back the dequeuing of new ones.  Files which fail
+        are shunted just as in `_one_file()`.
+
+        :param filebases: The files to process, in FIFO order.
+        :type filebases: list of str
+        :return: The number of files processed.
+        :rtype: int
+        """
+        me = self.__class__.__name__
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.concurrency)
+        remaining = deque(filebases)
+        # The dequeued files and the futures of their processing.
+        pending = deque()
+        processed = 0
+        while remaining or pending:
+            if self._short_circuit():
+                # The files which haven't been dequeued yet stay in the queue.
+                remaining.clear()
+            running = sum(1 for filebase, future in pending
+                          if not future.done())
+            while (remaining and running < self.concurrency and
+                   len(pending) < 2 * self.concurrency):
+                filebase = remaining.popleft()
+                dlog.debug('[%s] dispatching filebase: %s', me, filebase)
+                try:
+                    msg, msgdata = self.switchboard.dequeue(filebase)
+                except Exception as error:
+                    # See _one_file().
+                    self._log(error)
+                    elog.error('Skipping and preserving unparseable '
+                               'message: %s', filebase)
+                    self.switchboard.finish(filebase, preserve=True)
+                    processed += 1
+                    continue
+                pending.append((filebase, self._executor.submit(
+                    self._work, filebase, msg, msgdata)))
+                running += 1
+            if len(pending) == 0:
+                continue
+            if not pending[0][1].done():
+                wait([future for filebase, future in pending
+                      if not future.done()], return_when=FIRST_COMPLETED)
+            while len(pending) > 0 and pending[0][1].done():
+                filebase, future = pending.popleft()
+                dlog.debug('[%s] finishing filebase: %s', me, filebase)
+                self._finish(filebase, preserve=future.result())
+                processed += 1
+                dlog.debug('[%s] doing periodic', me)
+                self._do_periodic()
+                config.db.commit()
+        return processed
+
+    def _work(self, filebase, msg, msgdata):
+        """Process one dequeued file in a worker thread.
+
+        :return: True if the queue file must be preserved.
+        :rtype: bool
+        """
+        try:
+            self._process_one_file(msg, msgdata)
+            # This commits the worker thread's own session.
+            config.db.commit()
+            return False
+        except Exception as error:
+            # See _one_file().
+            self._log(error)
+            config.db.abort()
+            return self._shunt(filebase, msg, msgdata)
+
+    def _one_batch(self, filebases):
+        """Process queue files in a single transaction.
+
+        Files are processed until all of `filebases` are done, the batch time
+        runs out, or the runner is asked to stop.  Everything the files
+        enqueue is held back until the transaction commits, and the files are
+        only finished after that, so that a crash leaves their backup files
+        to be recovered.  If anything goes wrong, the whole batch is rolled
+        back and its files are processed again one at a time, so that only a
+        bad file gets shunted.
+
+        :param filebases: The files to process, in FIFO order.
+        :type filebases: list of str
+        :return: The number of files processed.
+        :rtype: int
+        """
+        me = self.__class__.__name__
+        deadline = time.time() + self.batch_float
+        dequeued = []
+        with EnqueueBatch() as enqueued:
+            try:
+                for filebase in filebases:
+                    dlog.debug('[%s] processing filebase: %s', me, filebase)
+                    dequeued.append(filebase)
+                    msg, msgdata = self.switchboard.dequeue(filebase)
+                    self._process_one_file(msg, msgdata)
+                    if time.time() >= deadline or self._short_circuit():
+                        break
+                dlog.debug('[%s] doing periodic', me)
+                self._do_periodic()
+                dlog.debug('[%s] committing batch of %s', me, len(dequeued))
+                config.db.commit()
+            except Exception as error:
+                self._log(error)
+                config.db.abort()
+                enqueued.discard()
+                failed = True
+            else:
+                enqueued.publish()
+                failed = False
+        if failed:
+            elog.error('Batch failed, replaying %s files one at a time',
+                       len(dequeued))
+            for filebase in dequeued:
+                try:
+                    self.switchboard.requeue(filebase)
+                except FileNotFoundError:
+                    # The file could not even be dequeued.  Let _one_file()
+                    # run into the same problem and deal with it.
+                    pass
+            for filebase in dequeued:
+                self._one_file(filebase)
+            return len(dequeued)
+        for filebase in dequeued:
+            dlog.debug('[%s] finishing filebase: %s', me, filebase)
+            self._finish(filebase)
+        return len(dequeued)
+
     def _process_one_file(self, msg, msgdata):
         """See `IRunner`."""
         # Do some common sanity checking on the message metadata.  It's got to
@@ -263,6 +487,16 @@ class Runner:
         if keepqueued:
             self.switchboard.enqueue(msg, msgdata)
 
+    def _sync_queues(self):
+        if self.switchboard is not None:
+            self.switchboard.sync()
+        for switchboard in config.switchboards.values():
+            switchboard.sync()
+        # Everything the processed files enqueued is on disk now.
+        unfinished, self._unfinished = self._unfinished, []
+        for filebase in unfinished:
+            self.switchboard.finish(filebase)
+
     def _log(self, exc):
         elog.error('Uncaught runner exception: %s', exc)
         s = StringIO()
@@ -285,7 +519,13 @@ class Runner:
         """See `IRunner`."""
         if filecnt or self.sleep_float <= 0:
             return
-        time.sleep(self.sleep_float)
+        if self.wakeup == 'notify' and self.switchboard is not None:
+            # Wake up as soon as a new file lands in our queue directory, but
+            # never sleep longer than we would have anyway, so that the stop
+            # flag gets checked just as often.
+            self.switchboard.wait(self.sleep_float)
+        else:
+            time.sleep(self.sleep_float)
 
     def _short_circuit(self):
         """See `IRunner`."""
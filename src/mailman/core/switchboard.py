@@ -19,36 +19,77 @@
 
 Messages are represented as email.message.Message objects (or an instance ofa
 subclass).  Metadata is represented as a Python dictionary.  For every
-message/metadata pair in a queue, a single file containing two pickles is
-written.  First, the message is written to the pickle, then the metadata
-dictionary is written.
+message/metadata pair in a queue, a single file is written, containing the
+pickled metadata dictionary followed by the message's bytes or pickle.
+
+Queue files are named after the time they were enqueued and a hex digest,
+separated by a '+'.  Files whose metadata has a `deliver_after` time in the
+future are named after that time instead.  Files which are not in the normal
+priority lane have the name of their lane appended, separated by another '+'.
+
+The shards of a message, which each carry a part of its recipients, share one
+copy of the message.  It is stored in a .msg file next to each shard's queue
+file, all of which are hard links to the same file.
 """
 
 __all__ = [
+    'EnqueueBatch',
+    'QueueIndex',
     'Switchboard',
+    'deserialize',
     'handle_ConfigurationUpdatedEvent',
+    'read_entry',
+    'serialize',
+    'split_filebase',
+    'write_entry',
     ]
 
 
 import os
+import re
 import time
 import email
+import heapq
 import pickle
+import socket
+import struct
 import hashlib
 import logging
+import itertools
+import threading
 
+from datetime import timezone
+from lazr.config import as_timedelta
 from mailman.config import config
-from mailman.email.message import Message
+from mailman.email.message import LazyMessage, Message
 from mailman.interfaces.configuration import ConfigurationUpdatedEvent
 from mailman.interfaces.switchboard import ISwitchboard
-from mailman.utilities.filesystem import makedirs
+from mailman.utilities.filesystem import makedirs, sync_directory
+from mailman.utilities.modules import call_name
 from mailman.utilities.string import expand
+from mailman.utilities.watcher import make_watcher
 from zope.interface import implementer
 
 
 # 20 bytes of all bits set, maximum hashlib.sha.digest() value.  We do it this
 # way for Python 2/3 compatibility.
 shamax = int('0xffffffffffffffffffffffffffffffffffffffff', 16)
+# The identity of the enqueuing process, for unique queue file names.
+HOSTNAME = socket.gethostname()
+_counter = itertools.count()
+# The number of leading hex digits of a queue file's digest which come from
+# the list id, with list affinity slicing, or which spread the shards of a
+# message over the slices.  This allows for up to 2**32 slices.
+AFFINITY_DIGITS = 8
+# The priority lanes of queue files, and by how many priority head starts a
+# lane's files are moved ahead in the FIFO order.  The lane of a queue entry
+# is taken from its `priority` metadata key.
+LANES = {
+    'high': 1,
+    'normal': 0,
+    'low': -1,
+    }
+DEFAULT_LANE = 'normal'
 # Small increment to add to time in case two entries have the same time.  This
 # prevents skipping one of two entries with the same time until the next pass.
 DELTA = .0001
@@ -56,9 +97,434 @@ DELTA = .0001
 # In order to prevent loops and a message flood, when the count reaches this
 # value, we move the file to the bad queue as a .psv.
 MAX_BAK_COUNT = 3
+# Queue files since format version 2 start with this magic, followed by the
+# format version and the length of the pickled metadata.  Version 1 files are
+# two pickles, and pickles never start with a NUL byte.
+MAGIC = b'\x00MQF'
+HEADER = struct.Struct('>BI')
+# The message attributes which the raw message in a queue entry already
+# represents.  All others are stored with the metadata.
+RAW_ATTRIBUTES = frozenset((
+    '__version__', '_body_start', '_charset', '_default_type', '_flattened',
+    '_header_end', '_headers', '_payload', '_raw', '_raw_headers', 'defects',
+    'epilogue', 'policy', 'preamble',
+    ))
+# Characters which can't be stored in a raw message as they are.
+NOT_RAW = re.compile('[^\x00-\x7f\udc80-\udcff]')
 
 elog = logging.getLogger('mailman.error')
 
+# The enqueue batch which is active in the current thread, if any.
+_active = threading.local()
+
+
+
+class QueueIndex:
+    """An in-memory, FIFO ordered index of the files in a queue directory.
+
+    Queue file names start with the time the message was enqueued, so the
+    index is a heap of (time, filebase) entries.  Removals are lazy; a
+    removed file stays in the heap until it bubbles up to the top or the
+    heap gets too sparse and is rebuilt.
+    """
+
+    def __init__(self, predicate=None, head_start=0):
+        """Create an empty queue index.
+
+        :param predicate: If given, a callable which is passed the integer
+            value of a file's hex digest, and which returns True if the file
+            belongs in this index.
+        :type predicate: callable
+        :param head_start: The priority head start in seconds; see
+            `sort_key()`.
+        :type head_start: float
+        """
+        self._predicate = predicate
+        self._head_start = head_start
+        self._heap = []
+        self._live = set()
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, filebase):
+        return filebase in self._live
+
+    def add(self, filebase):
+        """Add a file to the index.
+
+        :param filebase: The base name of the queue file, without extension.
+        :type filebase: str
+        """
+        if filebase in self._live:
+            return
+        when, digest, lane = split_filebase(filebase)
+        if self._predicate is not None and not self._predicate(digest):
+            return
+        self._live.add(filebase)
+        heapq.heappush(self._heap, (
+            sort_key(when, lane, self._head_start), filebase))
+
+    def discard(self, filebase):
+        """Remove a file from the index, if it is present.
+
+        :param filebase: The base name of the queue file, without extension.
+        :type filebase: str
+        """
+        self._live.discard(filebase)
+        if len(self._heap) > 2 * len(self._live) + 1000:
+            self._heap = [entry for entry in self._heap
+                          if entry[1] in self._live]
+            heapq.heapify(self._heap)
+
+    def update(self, filebases):
+        """Make the index contain exactly the given files.
+
+        :param filebases: The base names of all the files in the queue.
+        :type filebases: iterable of str
+        """
+        filebases = set(filebases)
+        for filebase in self._live - filebases:
+            self.discard(filebase)
+        for filebase in filebases - self._live:
+            self.add(filebase)
+
+    def oldest(self, count=None):
+        """Return the oldest files in the index, in FIFO order.
+
+        Files in the high and low priority lanes are ordered as if they were
+        enqueued one head start earlier or later, respectively.
+
+        :param count: The maximum number of files to return, or None to
+            return all of them.
+        :type count: int or None
+        :return: The base names of the oldest files.
+        :rtype: list of str
+        """
+        heap = self._heap
+        if count is None:
+            count = len(self._live)
+        found = []
+        seen = set()
+        while heap and len(found) < count:
+            entry = heapq.heappop(heap)
+            filebase = entry[1]
+            # Skip lazily removed files and duplicates of re-added ones.
+            if filebase in self._live and filebase not in seen:
+                seen.add(filebase)
+                found.append(entry)
+        for entry in found:
+            heapq.heappush(heap, entry)
+        return [filebase for when, filebase in found]
+
+
+
+def split_filebase(filebase):
+    """Split the base name of a queue file into its parts.
+
+    :param filebase: The base name of the queue file, without extension.
+    :type filebase: str
+    :return: A 3-tuple of the time the file was enqueued, the integer value
+        of its hex digest and its priority lane.
+    :rtype: (float, int, str)
+    """
+    when, digest = filebase.split('+', 1)
+    digest, plus, lane = digest.partition('+')
+    return float(when), int(digest, 16), (lane or DEFAULT_LANE)
+
+
+
+def sort_key(when, lane, head_start):
+    """Return the key by which queue files are processed in FIFO order.
+
+    Files in higher priority lanes get a head start over the files in lower
+    ones.  Since the head start is limited, files in lower lanes still make
+    progress when the higher lanes are busy: a file in the low lane is
+    processed before any normal file enqueued more than one head start, and
+    any high file enqueued more than two head starts after it.
+
+    :param when: The time the file was enqueued.
+    :type when: float
+    :param lane: The file's priority lane.
+    :type lane: str
+    :param head_start: The priority head start in seconds.
+    :type head_start: float
+    :rtype: float
+    """
+    return when - LANES[lane] * head_start
+
+
+
+def _digest(msg, list_id, now, list_affinity, shard=None):
+    # The host name, process id and counter make the digest unique even for
+    # the same message enqueued several times at the same time.  Since it is
+    # a SHA1 digest like the ones of whole messages used to be, it is just as
+    # uniformly distributed over the slices, and older queue files are still
+    # sliced the same way.
+    message_id = (msg.get('message-id', '') if isinstance(msg, Message)
+                  else '')
+    identity = '\0'.join((
+        str(message_id), list_id, now, HOSTNAME, str(os.getpid()),
+        str(next(_counter))))
+    identity = identity.encode('utf-8', 'surrogateescape')
+    digest = hashlib.sha1(identity).hexdigest()
+    if list_affinity or shard is not None:
+        # The slice only depends on the leading digits of the digest, so
+        # take those from the list id to put all of the list's queue files
+        # into the same slice.
+        affinity = list_id
+        if not list_affinity:
+            # All the shards of a message start out from the same point.
+            affinity = '\0'.join((str(message_id), list_id))
+        affinity = hashlib.sha1(affinity.encode(
+            'utf-8', 'surrogateescape')).hexdigest()[:AFFINITY_DIGITS]
+        if shard is not None:
+            # Spread the shards evenly around the slices, so that with as
+            # many slices as shards (or a multiple of them) every shard goes
+            # to a different slice.
+            index, count = shard
+            ring = 16 ** AFFINITY_DIGITS
+            affinity = '{0:0{1}x}'.format(
+                (int(affinity, 16) + index * ring // count) % ring,
+                AFFINITY_DIGITS)
+        digest = affinity + digest[AFFINITY_DIGITS:]
+    return digest
+
+
+
+def serialize(_msg, _metadata, _kws, list_affinity=False, shard=None,
+              shared=False):
+    """Turn a message and its metadata into a queue entry.
+
+    This is shared by all switchboard implementations.
+
+    :param _msg: The message.
+    :param _metadata: The message metadata, or None.
+    :param _kws: Additional metadata, which takes precedence over `_metadata`.
+    :param list_affinity: Whether all entries for the same mailing list
+        should go to the same slice of the queue.
+    :type list_affinity: bool
+    :param shard: For the shards of a message, the index of this shard and
+        the number of shards.  The shards are spread over the slices, even
+        with list affinity.
+    :type shard: (int, int)
+    :param shared: Whether the message is stored separately, in a file
+        shared by all the shards of a message.
+    :type shared: bool
+    :return: A 3-tuple of the entry's base name, the pickled message and the
+        pickled metadata.
+    """
+    if _metadata is None:
+        _metadata = {}
+    data = _metadata.copy()
+    data.update(_kws)
+    list_id = data.get('listid', '--nolist--')
+    lane = data.get('priority', DEFAULT_LANE)
+    if lane not in LANES:
+        raise ValueError('Bad priority lane: {0}'.format(lane))
+    when = time.time()
+    # Files which must not be delivered before a certain time are named after
+    # that time, so that queues keep them in the order they become due in.
+    # Like all of Mailman's datetimes, it is a naive UTC datetime.
+    deliver_after = data.get('deliver_after')
+    if deliver_after is not None:
+        due = deliver_after.replace(tzinfo=timezone.utc).timestamp()
+        when = max(when, due)
+    stamp = repr(when)
+    msgsave = None
+    if data.get('_plaintext'):
+        protocol = 0
+        msgsave = pickle.dumps(str(_msg), protocol)
+    else:
+        protocol = pickle.HIGHEST_PROTOCOL
+        rawmsg = _as_bytes(_msg)
+        if rawmsg is None:
+            msgsave = pickle.dumps(_msg, protocol)
+    # Encode the current time into the file name for FIFO sorting.  The
+    # file name consists of two parts separated by a '+': the received
+    # time for this message (i.e. when it first showed up on this system)
+    # or the time it is due, and the sha hex digest of a unique identity
+    # for this entry.  We're also going to use the digest as a hash into
+    # the set of parallel runner processes.  Hashing the whole message would
+    # make the name unique as well, but at a cost proportional to the
+    # message size on every hop.
+    filebase = stamp + '+' + _digest(
+        _msg, list_id, stamp, list_affinity, shard)
+    if lane != DEFAULT_LANE:
+        filebase += '+' + lane
+    # Always add the metadata schema version number
+    data['version'] = config.QFILE_SCHEMA_VERSION
+    # Filter out volatile entries.  Use .keys() so that we can mutate the
+    # dictionary during the iteration.
+    for k in list(data):
+        if k.startswith('_'):
+            del data[k]
+    # We have to tell the dequeue() method whether to parse the message
+    # object or not.
+    data['_parsemsg'] = (protocol == 0)
+    if shared:
+        data['_sharedmsg'] = True
+    if msgsave is None:
+        # Store the message's bytes instead of its pickled object tree,
+        # along with any extra attributes it carries.
+        data['_rawmsg'] = True
+        data['_msgattrs'] = {
+            name: value for name, value in _msg.__dict__.items()
+            if name not in RAW_ATTRIBUTES}
+        msgsave = rawmsg
+    return filebase, msgsave, pickle.dumps(data, protocol)
+
+
+
+def _as_bytes(msg):
+    """Return the message's bytes, or None if it has to be pickled."""
+    # Instances of other classes may carry state which the bytes don't.
+    if type(msg) not in (Message, LazyMessage):
+        return None
+    # Header instances and non-ASCII strings would come back encoded, which
+    # isn't the same message for the code handling it.  Undecodable bytes
+    # from the parser are escaped as surrogates and survive unchanged.  Don't
+    # parse a lazy body just to check it.
+    lazy = (type(msg) is LazyMessage and msg.raw_body is not None)
+    for part in ([msg] if lazy else msg.walk()):
+        for name, value in part.raw_items():
+            if not isinstance(value, str) or NOT_RAW.search(value):
+                return None
+        if not lazy:
+            payload = part._payload
+            if isinstance(payload, str) and NOT_RAW.search(payload):
+                return None
+    try:
+        # Nobody looked at a lazy body, so it isn't generated again.
+        return msg.flattened()
+    except Exception:
+        # E.g. a payload which the generator doesn't understand.  Pickling
+        # always works.
+        return None
+
+
+
+def write_entry(fp, msgsave, datasave):
+    """Write a queue entry to a file in the current format.
+
+    :param fp: The file to write to.
+    :param msgsave: The stored message, as returned by `serialize()`.
+    :type msgsave: bytes
+    :param datasave: The pickled metadata, as returned by `serialize()`.
+    :type datasave: bytes
+    """
+    fp.write(MAGIC)
+    fp.write(HEADER.pack(config.QFILE_FORMAT_VERSION, len(datasave)))
+    fp.write(datasave)
+    fp.write(msgsave)
+
+
+
+def _read_parts(fp):
+    # Return the stored message bytes and the unpickled metadata.
+    if fp.read(len(MAGIC)) != MAGIC:
+        # A version 1 file, consisting of the two pickles.
+        fp.seek(0)
+        pickle.load(fp)
+        size = fp.tell()
+        data = pickle.load(fp)
+        fp.seek(0)
+        return fp.read(size), data
+    version, size = HEADER.unpack(fp.read(HEADER.size))
+    if version > config.QFILE_FORMAT_VERSION:
+        raise ValueError(
+            'Unsupported queue file format version: {0}'.format(version))
+    data = pickle.loads(fp.read(size))
+    return fp.read(), data
+
+
+
+def read_entry(fp):
+    """Read a queue entry from a file in any format.
+
+    :param fp: The file to read from.
+    :return: A 2-tuple of the stored message and the metadata, which can be
+        passed to `deserialize()`.  Depending on the format, the message is
+        an unpickled object or the message's bytes.
+    """
+    msgsave, data = _read_parts(fp)
+    if data.pop('_sharedmsg', False):
+        # The message is in the file the entry shares with the other shards
+        # of the same message.
+        with open(os.path.splitext(fp.name)[0] + '.msg', 'rb') as body:
+            msgsave = body.read()
+    if not data.get('_rawmsg'):
+        msgsave = pickle.loads(msgsave)
+    return msgsave, data
+
+
+
+def deserialize(msg, data):
+    """Finish turning a queue entry back into a message and its metadata.
+
+    :param msg: The unpickled message, or the message's bytes.
+    :param data: The unpickled metadata.
+    :return: A 2-tuple of the message and the metadata.
+    """
+    if data.pop('_rawmsg', False):
+        attributes = data.pop('_msgattrs')
+        msg = LazyMessage.from_bytes(msg)
+        msg.__dict__.update(attributes)
+    elif data.get('_parsemsg'):
+        # Calculate the original size of the text now so that we won't
+        # have to generate the message later when we do size restriction
+        # checking.
+        original_size = len(msg)
+        msg = email.message_from_string(msg, Message)
+        msg.original_size = original_size
+        data['original_size'] = original_size
+    return msg, data
+
+
+
+class EnqueueBatch:
+    """Hold back the files enqueued in this thread until they're published.
+
+    While the batch is active, `Switchboard.enqueue()` writes and syncs the
+    queue file as usual, but leaves it under its temporary name.  Nothing
+    can see the file until `publish()` renames it into place, so a batch of
+    work which is rolled back can also take back its enqueued messages by
+    calling `discard()`.  Other switchboard implementations hold back their
+    queue entries in the same way.  Files which are neither published nor
+    discarded when the batch exits are discarded.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self._outer = None
+
+    @staticmethod
+    def active():
+        """Return the batch which is active in this thread, or None."""
+        return getattr(_active, 'batch', None)
+
+    def __enter__(self):
+        self._outer = getattr(_active, 'batch', None)
+        _active.batch = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _active.batch = self._outer
+        self.discard()
+        return False
+
+    def publish(self):
+        """Make all the files enqueued during the batch visible."""
+        pending, self.pending = self.pending, []
+        for switchboard, filebase in pending:
+            switchboard._publish(filebase)
+
+    def discard(self):
+        """Throw away all the files enqueued during the batch."""
+        pending, self.pending = self.pending, []
+        for switchboard, filebase in pending:
+            switchboard._discard(filebase)
+
 
 
 @implementer(ISwitchboard)
@@ -66,7 +532,9 @@ class Switchboard:
     """See `ISwitchboard`."""
 
     def __init__(self, name, queue_directory,
-                 slice=None, numslices=1, recover=False):
+                 slice=None, numslices=1, recover=False,
+                 durability='strict', sync_interval=0, slicing='message',
+                 priority_head_start=0):
         """Create a switchboard object.
 
         :param name: The queue name.
@@ -81,11 +549,34 @@ class Switchboard:
         :type numslices: int
         :param recover: True if backup files should be recovered.
         :type recover: bool
+        :param durability: When queue files are synced to disk.  With
+            `strict`, every file is synced before it is renamed into place.
+            With `batched`, the files written within `sync_interval` seconds
+            of each other are synced together.  With `relaxed`, files are
+            never explicitly synced.
+        :type durability: str
+        :param sync_interval: The maximum number of seconds a file may go
+            unsynced in `batched` mode.
+        :type sync_interval: float
+        :param slicing: How enqueued files are assigned to slices.  With
+            `message`, every file goes to a random slice.  With `list`, all
+            files for the same mailing list go to the same slice.
+        :type slicing: str
+        :param priority_head_start: The number of seconds by which files in
+            a priority lane are moved ahead of the files in the next lower
+            lane; see `sort_key()`.
+        :type priority_head_start: float
         """
         assert (numslices & (numslices - 1)) == 0, (
             'Not a power of 2: {0}'.format(numslices))
+        assert durability in ('strict', 'batched', 'relaxed'), (
+            'Bad durability value: {0}'.format(durability))
+        assert slicing in ('message', 'list'), (
+            'Bad slicing value: {0}'.format(slicing))
         self.name = name
         self.queue_directory = queue_directory
+        self.slicing = slicing
+        self.priority_head_start = priority_head_start
         # If configured to, create the directory if it doesn't yet exist.
         if config.create_paths:
             makedirs(self.queue_directory, 0o770)
@@ -96,55 +587,120 @@ class Switchboard:
         if numslices != 1:
             self._lower = ((shamax + 1) * slice) / numslices
             self._upper = (((shamax + 1) * (slice + 1)) / numslices) - 1
+        # The directory watcher is created lazily, since most switchboards
+        # are only ever used for enqueuing.
+        self._watcher = None
+        self._index = None
+        self.durability = durability
+        self.sync_interval = sync_interval
+        # The names of the files written since the last sync, in `batched`
+        # mode, and when the first of them was written.
+        self._unsynced = []
+        self._unsynced_since = None
+        # Guards the index and the unsynced files, since a runner's worker
+        # threads can enqueue while the runner dequeues.
+        self._lock = threading.RLock()
         if recover:
             self.recover_backup_files()
 
     def enqueue(self, _msg, _metadata=None, **_kws):
         """See `ISwitchboard`."""
-        if _metadata is None:
-            _metadata = {}
-        # Calculate the SHA hexdigest of the message to get a unique base
-        # filename.  We're also going to use the digest as a hash into the set
-        # of parallel runner processes.
-        data = _metadata.copy()
-        data.update(_kws)
-        list_id = data.get('listid', '--nolist--')
-        # Get some data for the input to the sha hash.
-        now = repr(time.time())
-        if data.get('_plaintext'):
-            protocol = 0
-            msgsave = pickle.dumps(str(_msg), protocol)
-        else:
-            protocol = pickle.HIGHEST_PROTOCOL
-            msgsave = pickle.dumps(_msg, protocol)
-        # The list-id field is a string but the input to the hash function must
-        # be bytes.
-        hashfood = msgsave + list_id.encode('utf-8') + now.encode('utf-8')
-        # Encode the current time into the file name for FIFO sorting.  The
-        # file name consists of two parts separated by a '+': the received
-        # time for this message (i.e. when it first showed up on this system)
-        # and the sha hex digest.
-        filebase = now + '+' + hashlib.sha1(hashfood).hexdigest()
+        filebase, msgsave, datasave = serialize(
+            _msg, _metadata, _kws, self.slicing == 'list')
+        self._write(filebase, msgsave, datasave)
+        return filebase
+
+    def enqueue_shards(self, _msg, shards, _metadata=None, **_kws):
+        """See `ISwitchboard`."""
+        filebases = []
+        body = None
+        for index, shard in enumerate(shards):
+            data = ({} if _metadata is None else _metadata.copy())
+            data.update(shard)
+            filebase, msgsave, datasave = serialize(
+                _msg, data, _kws, self.slicing == 'list',
+                (index, len(shards)), shared=True)
+            bodyfile = os.path.join(self.queue_directory, filebase + '.msg')
+            if body is None:
+                # The message is written only once.  Its file must exist
+                # before any of the shards can be dequeued.
+                with open(bodyfile, 'wb') as fp:
+                    fp.write(msgsave)
+                    fp.flush()
+                    if self.durability == 'strict':
+                        os.fsync(fp.fileno())
+                if self.durability == 'batched':
+                    with self._lock:
+                        self._remember_unsynced(filebase + '.msg')
+                body = bodyfile
+            else:
+                os.link(body, bodyfile)
+            self._write(filebase, b'', datasave)
+            filebases.append(filebase)
+        return filebases
+
+    def _write(self, filebase, msgsave, datasave):
         filename = os.path.join(self.queue_directory, filebase + '.pck')
         tmpfile = filename + '.tmp'
-        # Always add the metadata schema version number
-        data['version'] = config.QFILE_SCHEMA_VERSION
-        # Filter out volatile entries.  Use .keys() so that we can mutate the
-        # dictionary during the iteration.
-        for k in list(data):
-            if k.startswith('_'):
-                del data[k]
-        # We have to tell the dequeue() method whether to parse the message
-        # object or not.
-        data['_parsemsg'] = (protocol == 0)
         # Write to the pickle file the message object and metadata.
         with open(tmpfile, 'wb') as fp:
-            fp.write(msgsave)
-            pickle.dump(data, fp, protocol)
+            write_entry(fp, msgsave, datasave)
             fp.flush()
-            os.fsync(fp.fileno())
-        os.rename(tmpfile, filename)
-        return filebase
+            if self.durability == 'strict':
+                os.fsync(fp.fileno())
+        batch = EnqueueBatch.active()
+        if batch is None:
+            self._publish(filebase)
+        else:
+            batch.pending.append((self, filebase))
+
+    def _publish(self, filebase):
+        filename = os.path.join(self.queue_directory, filebase + '.pck')
+        os.rename(filename + '.tmp', filename)
+        with self._lock:
+            if self._index is not None:
+                self._index.add(filebase)
+            if self.durability == 'batched':
+                self._remember_unsynced(filebase + '.pck')
+
+    def _discard(self, filebase):
+        tmpfile = os.path.join(self.queue_directory, filebase + '.pck.tmp')
+        try:
+            os.unlink(tmpfile)
+        except FileNotFoundError:
+            pass
+        self._remove_body(filebase)
+
+    def _remove_body(self, filebase, directory=None):
+        # Remove the shard's link to the message it shares with the other
+        # shards, or move it to the given directory.  The message itself is
+        # gone with the last link.
+        bodyfile = os.path.join(self.queue_directory, filebase + '.msg')
+        try:
+            if directory is None:
+                os.unlink(bodyfile)
+            else:
+                os.rename(bodyfile, os.path.join(directory, filebase + '.msg'))
+        except FileNotFoundError:
+            # Not a shard.
+            pass
+
+    def _remember_unsynced(self, filename):
+        now = time.time()
+        if self._unsynced_since is None:
+            self._unsynced_since = now
+        self._unsynced.append(filename)
+        if now - self._unsynced_since >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """See `ISwitchboard`."""
+        with self._lock:
+            if len(self._unsynced) == 0:
+                return
+            sync_directory(self.queue_directory, self._unsynced)
+            self._unsynced = []
+            self._unsynced_since = None
 
     def dequeue(self, filebase):
         """See `ISwitchboard`."""
@@ -157,17 +713,11 @@ class Switchboard:
             # process crashes uncleanly the .bak file will be used to
             # re-instate the .pck file in order to try again.
             os.rename(filename, backfile)
-            msg = pickle.load(fp)
-            data = pickle.load(fp)
-        if data.get('_parsemsg'):
-            # Calculate the original size of the text now so that we won't
-            # have to generate the message later when we do size restriction
-            # checking.
-            original_size = len(msg)
-            msg = email.message_from_string(msg, Message)
-            msg.original_size = original_size
-            data['original_size'] = original_size
-        return msg, data
+            with self._lock:
+                if self._index is not None:
+                    self._index.discard(filebase)
+            msg, data = read_entry(fp)
+        return deserialize(msg, data)
 
     def finish(self, filebase, preserve=False):
         """See `ISwitchboard`."""
@@ -177,12 +727,74 @@ class Switchboard:
                 bad_dir = config.switchboards['bad'].queue_directory
                 psvfile = os.path.join(bad_dir, filebase + '.psv')
                 os.rename(bakfile, psvfile)
+                self._remove_body(filebase, bad_dir)
             else:
                 os.unlink(bakfile)
+                self._remove_body(filebase)
         except EnvironmentError:
             elog.exception(
                 'Failed to unlink/preserve backup file: %s', bakfile)
 
+    def requeue(self, filebase):
+        """See `ISwitchboard`."""
+        bakfile = os.path.join(self.queue_directory, filebase + '.bak')
+        pckfile = os.path.join(self.queue_directory, filebase + '.pck')
+        os.rename(bakfile, pckfile)
+        with self._lock:
+            if self._index is not None:
+                self._index.add(filebase)
+
+    def wait(self, timeout=None):
+        """See `ISwitchboard`."""
+        if self._watcher is None:
+            self._watcher = make_watcher(self.queue_directory)
+        return self._watcher.wait(timeout)
+
+    def _in_slice(self, digest):
+        # MAS: both comparisons need to be <= to get complete range.
+        return self._lower <= digest <= self._upper
+
+    def next_files(self, count=None):
+        """See `ISwitchboard`."""
+        with self._lock:
+            self._refresh_index()
+            return self._index.oldest(count)
+
+    def _refresh_index(self):
+        # Bring the in-memory index up to date with the queue directory.
+        # Create the watcher before the first directory scan so that no
+        # change is missed between the two.
+        if self._watcher is None:
+            self._watcher = make_watcher(self.queue_directory)
+        if self._index is None:
+            self._index = QueueIndex(
+                None if self._lower is None else self._in_slice,
+                self.priority_head_start)
+        changes = self._watcher.changes()
+        if changes is None:
+            self._index.update(
+                filebase for filebase, ext in (
+                    os.path.splitext(f)
+                    for f in os.listdir(self.queue_directory))
+                if ext == '.pck')
+        else:
+            arrived, departed = changes
+            for filebase in departed:
+                self._index.discard(filebase)
+            for filebase in arrived:
+                self._index.add(filebase)
+
+    def backlog(self):
+        """See `ISwitchboard`."""
+        with self._lock:
+            self._refresh_index()
+            head = self._index.oldest(1)
+            count = len(self._index)
+        if len(head) == 0:
+            return count, None
+        when, digest, lane = split_filebase(head[0])
+        return count, when
+
     @property
     def files(self):
         """See `ISwitchboard`."""
@@ -199,18 +811,26 @@ class Switchboard:
             filebase, ext = os.path.splitext(f)
             if ext != extension:
                 continue
-            when, digest = filebase.split('+', 1)
+            when, digest, lane = split_filebase(filebase)
             # Throw out any files which don't match our bitrange.  BAW: test
             # performance and end-cases of this algorithm.  MAS: both
             # comparisons need to be <= to get complete range.
-            if lower is None or (lower <= int(digest, 16) <= upper):
-                key = float(when)
+            if lower is None or (lower <= digest <= upper):
+                key = sort_key(when, lane, self.priority_head_start)
                 while key in times:
                     key += DELTA
                 times[key] = filebase
         # FIFO sort
         return [times[k] for k in sorted(times)]
 
+    def lane_depths(self):
+        """See `ISwitchboard`."""
+        depths = {lane: 0 for lane in LANES}
+        for filebase in self.get_files():
+            when, digest, lane = split_filebase(filebase)
+            depths[lane] += 1
+        return depths
+
     def recover_backup_files(self):
         """See `ISwitchboard`."""
         # Move all .bak files in our slice to .pck.  It's impossible for both
@@ -224,10 +844,7 @@ class Switchboard:
             dst = os.path.join(self.queue_directory, filebase + '.pck')
             with open(src, 'rb+') as fp:
                 try:
-                    # Throw away the message object.
-                    pickle.load(fp)
-                    data_pos = fp.tell()
-                    data = pickle.load(fp)
+                    msgsave, data = _read_parts(fp)
                 except Exception as error:
                     # If unpickling throws any exception, just log and
                     # preserve this entry
@@ -236,21 +853,28 @@ class Switchboard:
                     self.finish(filebase, preserve=True)
                 else:
                     data['_bak_count'] = data.get('_bak_count', 0) + 1
-                    fp.seek(data_pos)
                     if data.get('_parsemsg'):
                         protocol = 0
                     else:
                         protocol = 1
-                    pickle.dump(data, fp, protocol)
+                    # This also converts older files to the current format.
+                    fp.seek(0)
+                    write_entry(fp, msgsave, pickle.dumps(data, protocol))
                     fp.truncate()
                     fp.flush()
-                    os.fsync(fp.fileno())
+                    if self.durability == 'strict':
+                        os.fsync(fp.fileno())
                     if data['_bak_count'] >= MAX_BAK_COUNT:
                         elog.error('.bak file max count, preserving file: %s',
                                    filebase)
                         self.finish(filebase, preserve=True)
                     else:
                         os.rename(src, dst)
+                        with self._lock:
+                            if self._index is not None:
+                                self._index.add(filebase)
+                            if self.durability == 'batched':
+                                self._remember_unsynced(filebase + '.pck')
 
 
 
@@ -269,4 +893,10 @@ def handle_ConfigurationUpdatedEvent(event):
             substitutions = config.paths
             substitutions['name'] = name
             path = expand(conf.path, substitutions)
-            config.switchboards[name] = Switchboard(name, path)
+            config.switchboards[name] = call_name(
+                conf.switchboard, name, path, durability=conf.durability,
+                sync_interval=as_timedelta(
+                    conf.sync_interval).total_seconds(),
+                slicing=conf.slicing,
+                priority_head_start=as_timedelta(
+                    conf.priority_head_start).total_seconds())
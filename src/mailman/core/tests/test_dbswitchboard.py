@@ -0,0 +1,330 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the database switchboard."""
+
+__all__ = [
+    'TestDatabaseSwitchboard',
+    'TestDatabaseSwitchboardRunner',
+    ]
+
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.core.dbswitchboard import DatabaseSwitchboard
+from mailman.core.runner import Runner
+from mailman.core.switchboard import (
+    EnqueueBatch, read_entry, split_filebase)
+from mailman.model.queueentry import queue_bodies
+from mailman.testing.helpers import (
+    LogFileMark, configuration, get_queue_messages, make_testable_runner,
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+from sqlalchemy import func, select
+from unittest.mock import patch
+
+
+SWITCHBOARD = 'mailman.core.dbswitchboard.DatabaseSwitchboard'
+
+
+
+class ForwardingRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        config.switchboards['virgin'].enqueue(msg, msgdata)
+        return False
+
+
+
+class TestDatabaseSwitchboard(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._switchboard = self._make()
+
+    def _make(self, *args, **kws):
+        return DatabaseSwitchboard(
+            'test', self._queue_directory, *args, **kws)
+
+    def test_enqueue_dequeue(self):
+        filebase = self._switchboard.enqueue(self._msg, listid='ant.example')
+        self.assertEqual(self._switchboard.files, [filebase])
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['listid'], 'ant.example')
+        # The dequeued entry is the equivalent of a .bak file.
+        self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.get_files('.bak'), [filebase])
+        self._switchboard.finish(filebase)
+        self.assertEqual(self._switchboard.get_files('.bak'), [])
+
+    def test_sqlite_fallback(self):
+        # With SQLite, the queue lives in a database file of its own, which
+        # can't be shared with other hosts.
+        mark = LogFileMark('mailman.runner')
+        self.assertIsNot(self._switchboard._engine, config.db.engine)
+        self.assertTrue(os.path.exists(
+            os.path.join(self._queue_directory, 'queue.db')))
+        self.assertIn('The test queue is kept in a local SQLite database',
+                      mark.read())
+
+    def test_server_database(self):
+        # Any other database holds the queue itself.
+        with patch.object(config.db.engine.dialect, 'name', 'mysql'):
+            self.assertIs(self._make()._engine, config.db.engine)
+
+    def test_plaintext(self):
+        filebase = self._switchboard.enqueue(
+            'From: anne@example.com\n\nHi\n', _plaintext=True)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['from'], 'anne@example.com')
+        self.assertEqual(msgdata['original_size'], 27)
+
+    def test_fifo_order(self):
+        filebases = [self._switchboard.enqueue(self._msg) for i in range(5)]
+        self.assertEqual(self._switchboard.files, filebases)
+        self.assertEqual(self._switchboard.next_files(3), filebases[:3])
+
+    def test_backlog(self):
+        self.assertEqual(self._switchboard.backlog(), (0, None))
+        filebases = [self._switchboard.enqueue(self._msg) for i in range(3)]
+        count, when = self._switchboard.backlog()
+        self.assertEqual(count, 3)
+        self.assertEqual(when, split_filebase(filebases[0])[0])
+        # Dequeued entries are not part of the backlog.
+        self._switchboard.dequeue(filebases[0])
+        self.assertEqual(self._switchboard.backlog(),
+                         (2, split_filebase(filebases[1])[0]))
+
+    def test_claims_are_exclusive(self):
+        # Two runners, e.g. on different hosts, never claim the same entry.
+        other = self._make()
+        other._owner = 'elsewhere'
+        filebases = [self._switchboard.enqueue(self._msg) for i in range(4)]
+        self.assertEqual(self._switchboard.next_files(2), filebases[:2])
+        self.assertEqual(other.next_files(), filebases[2:])
+        self.assertEqual(self._switchboard.next_files(), filebases[:2])
+        self.assertRaises(LookupError, other.dequeue, filebases[0])
+
+    def test_expired_lease(self):
+        # A runner which claimed entries but went away loses them when its
+        # lease expires.
+        other = self._make()
+        other._owner = 'elsewhere'
+        filebase = self._switchboard.enqueue(self._msg)
+        self.assertEqual(self._switchboard.next_files(), [filebase])
+        self.assertEqual(other.next_files(), [])
+        with patch('mailman.core.dbswitchboard.time.time',
+                   return_value=10**10):
+            self.assertEqual(other.next_files(), [filebase])
+
+    def test_expired_dequeued_entries_are_recovered(self):
+        # A dequeued entry whose lease expires is recovered like a .bak file,
+        # until it has been recovered too often.
+        filebase = self._switchboard.enqueue(self._msg)
+        bad_dir = config.switchboards['bad'].queue_directory
+        for i in range(2):
+            self._switchboard.dequeue(filebase)
+            with patch('mailman.core.dbswitchboard.time.time',
+                       return_value=10**10 + i):
+                self.assertEqual(self._switchboard.next_files(), [filebase])
+        self._switchboard.dequeue(filebase)
+        with patch('mailman.core.dbswitchboard.time.time',
+                   return_value=10**11):
+            self.assertEqual(self._switchboard.next_files(), [])
+        self.assertTrue(
+            os.path.exists(os.path.join(bad_dir, filebase + '.psv')))
+        os.remove(os.path.join(bad_dir, filebase + '.psv'))
+
+    def test_lease_renewal(self):
+        # The lease of an entry is renewed while it is being processed, so
+        # that a slow message isn't recovered by another runner.
+        other = self._make()
+        other._owner = 'elsewhere'
+        self._switchboard.lease_time = 0.3
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        time.sleep(1)
+        self.assertEqual(other.next_files(), [])
+        self._switchboard.finish(filebase)
+        self.assertEqual(self._switchboard.get_files('.bak'), [])
+
+    def test_finish_lost_lease(self):
+        # A runner which lost the lease of an entry leaves it alone.
+        other = self._make()
+        other._owner = 'elsewhere'
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        with patch('mailman.core.dbswitchboard.time.time',
+                   return_value=10**10):
+            self.assertEqual(other.next_files(), [filebase])
+            other.dequeue(filebase)
+        error_log = LogFileMark('mailman.error')
+        self._switchboard.finish(filebase, preserve=True)
+        self.assertIn('Lost the lease of queue entry: ' + filebase,
+                      error_log.read())
+        self.assertEqual(other.get_files('.bak'), [filebase])
+        bad_dir = config.switchboards['bad'].queue_directory
+        self.assertFalse(
+            os.path.exists(os.path.join(bad_dir, filebase + '.psv')))
+        other.finish(filebase)
+        self.assertEqual(other.get_files('.bak'), [])
+
+    def test_recover_backup_files(self):
+        # A restarted runner immediately recovers what it had dequeued.
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        restarted = self._make(recover=True)
+        self.assertEqual(restarted.files, [filebase])
+
+    def test_requeue(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        self._switchboard.requeue(filebase)
+        self.assertEqual(self._switchboard.files, [filebase])
+
+    def test_slices(self):
+        filebases = [self._switchboard.enqueue(self._msg) for i in range(20)]
+        found = [self._make(i, 4).files for i in range(4)]
+        self.assertEqual(sorted(sum(found, [])), sorted(filebases))
+
+    def test_priority_lanes(self):
+        switchboard = self._make(priority_head_start=60)
+        with patch('mailman.core.switchboard.time.time', return_value=1000):
+            normal = switchboard.enqueue(self._msg)
+            low = switchboard.enqueue(self._msg, priority='low')
+        with patch('mailman.core.switchboard.time.time', return_value=1030):
+            high = switchboard.enqueue(self._msg, priority='high')
+        self.assertEqual(switchboard.next_files(), [high, normal, low])
+        self.assertEqual(switchboard.lane_depths(),
+                         dict(high=1, normal=1, low=1))
+
+    def test_list_affinity(self):
+        switchboard = self._make(slicing='list')
+        for i in range(20):
+            switchboard.enqueue(self._msg, listid='ant.example.com')
+        found = [len(self._make(i, 4).files) for i in range(4)]
+        self.assertEqual(sorted(found), [0, 0, 0, 20])
+
+    def test_enqueue_batch(self):
+        with EnqueueBatch() as batch:
+            filebase = self._switchboard.enqueue(self._msg)
+            self.assertEqual(self._switchboard.files, [])
+            batch.publish()
+        self.assertEqual(self._switchboard.files, [filebase])
+        # Entries which are not published are thrown away.
+        with EnqueueBatch():
+            self._switchboard.enqueue(self._msg)
+        self.assertEqual(self._switchboard.files, [filebase])
+
+    def test_enqueue_shards(self):
+        shards = [dict(recipients=['anne@example.com']),
+                  dict(recipients=['bart@example.com'])]
+        filebases = self._switchboard.enqueue_shards(
+            self._msg, shards, listid='ant.example')
+        self.assertEqual([self._make(i, 2).files for i in range(2)],
+                         [[filebase] for filebase in filebases])
+        for filebase, shard in zip(filebases, shards):
+            msg, msgdata = self._switchboard.dequeue(filebase)
+            self.assertEqual(msg['message-id'], '<ant>')
+            self.assertEqual(msgdata['recipients'], shard['recipients'])
+            self.assertEqual(msgdata['listid'], 'ant.example')
+
+    def _bodies(self):
+        with self._switchboard._engine.connect() as connection:
+            return connection.execute(
+                select([func.count()]).select_from(queue_bodies)).scalar()
+
+    def test_shared_shard_body(self):
+        # The message is stored once for all the shards, until the last of
+        # them is finished.
+        shards = [dict(recipients=['anne@example.com']),
+                  dict(recipients=['bart@example.com']),
+                  dict(recipients=['cris@example.com'])]
+        with EnqueueBatch() as batch:
+            filebases = self._switchboard.enqueue_shards(self._msg, shards)
+            self.assertEqual(self._bodies(), 0)
+            batch.publish()
+        self.assertEqual(self._bodies(), 1)
+        for filebase in filebases:
+            msg, msgdata = self._switchboard.dequeue(filebase)
+            self.assertEqual(msg['message-id'], '<ant>')
+            self.assertNotIn('_sharedmsg', msgdata)
+        self._switchboard.finish(filebases[0])
+        self.assertEqual(self._bodies(), 1)
+        # A preserved shard has a copy of the message.
+        self._switchboard.finish(filebases[1], preserve=True)
+        self.assertEqual(self._bodies(), 1)
+        bad_dir = config.switchboards['bad'].queue_directory
+        psvfile = os.path.join(bad_dir, filebases[1] + '.psv')
+        self.addCleanup(os.remove, psvfile)
+        with open(psvfile, 'rb') as fp:
+            msgsave, msgdata = read_entry(fp)
+        self.assertIn(b'Message-ID: <ant>', msgsave)
+        self.assertEqual(msgdata['recipients'], ['bart@example.com'])
+        self._switchboard.finish(filebases[2])
+        self.assertEqual(self._bodies(), 0)
+
+    def test_wait(self):
+        self.assertFalse(self._switchboard.wait(0))
+        self._switchboard.enqueue(self._msg)
+        self.assertTrue(self._switchboard.wait(0))
+
+
+
+class TestDatabaseSwitchboardRunner(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        create_list('test@example.com')
+        config.db.commit()
+
+    @configuration('runner.in', switchboard=SWITCHBOARD)
+    def test_runner(self):
+        # The switchboard is selected through the configuration, both for
+        # the runner and for the global switchboards.
+        switchboard = config.switchboards['in']
+        self.assertIsInstance(switchboard, DatabaseSwitchboard)
+        for message_id in ('<ant>', '<bee>'):
+            msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: {0}
+
+""".format(message_id))
+            switchboard.enqueue(msg, listid='test.example.com')
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        self.assertIsInstance(runner.switchboard, DatabaseSwitchboard)
+        runner.run()
+        self.assertEqual(switchboard.files, [])
+        self.assertEqual(switchboard.get_files('.bak'), [])
+        messages = get_queue_messages('virgin', sort_on='message-id')
+        self.assertEqual([bag.msg['message-id'] for bag in messages],
+                         ['<ant>', '<bee>'])
@@ -18,14 +18,21 @@
 """Test some Runner base class behavior."""
 
 __all__ = [
+    'TestBatching',
+    'TestConcurrency',
+    'TestDurability',
     'TestRunner',
     ]
 
 
+import os
+import time
 import unittest
+import threading
 
 from mailman.app.lifecycle import create_list
 from mailman.config import config
+from mailman.core.i18n import _
 from mailman.core.runner import Runner
 from mailman.interfaces.runner import RunnerCrashEvent
 from mailman.runners.virgin import VirginRunner
@@ -34,6 +41,7 @@ from mailman.testing.helpers import (
     make_digest_messages, make_testable_runner,
     specialized_message_from_string as mfs)
 from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
 
 
 
@@ -42,6 +50,56 @@ class CrashingRunner(Runner):
         raise RuntimeError('borked')
 
 
+
+class ForwardingRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        if msg['message-id'] == '<bad>':
+            raise RuntimeError('borked')
+        config.switchboards['virgin'].enqueue(msg, msgdata)
+        return False
+
+
+
+class ThreadedRunner(ForwardingRunner):
+    # Keep track of how many files are being processed at the same time, and
+    # by which database sessions.
+    def __init__(self, name, slice=None):
+        super(ThreadedRunner, self).__init__(name, slice)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most_active = 0
+        self.sessions = set()
+
+    def _dispose(self, mlist, msg, msgdata):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+            self.sessions.add(id(config.db.store()))
+        try:
+            # The first file is the slowest.
+            time.sleep(0.2 if msg['message-id'] == '<ant>' else 0.02)
+            return super(ThreadedRunner, self)._dispose(mlist, msg, msgdata)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+
+class LanguageRunner(Runner):
+    # Record the language each file is processed in, while another worker
+    # thread is processing a file in a different language.
+    def __init__(self, name, slice=None):
+        super(LanguageRunner, self).__init__(name, slice)
+        self.barrier = threading.Barrier(2, timeout=5)
+        self.languages = {}
+
+    def _dispose(self, mlist, msg, msgdata):
+        self.barrier.wait()
+        self.languages[msg['message-id']] = _.code
+        self.barrier.wait()
+        return False
+
+
 
 class TestRunner(unittest.TestCase):
     """Test the Runner base class behavior."""
@@ -87,6 +145,14 @@ Message-ID: <ant>
         self.assertEqual(len(shunted), 1)
         self.assertEqual(shunted[0].msg['message-id'], '<ant>')
 
+    def test_priority_head_start(self):
+        # Only the virgin queue's notifications overtake its digests by
+        # default.  The other queues are processed in FIFO order.
+        self.assertEqual(config.switchboards['out'].priority_head_start, 0)
+        self.assertEqual(config.switchboards['in'].priority_head_start, 0)
+        self.assertEqual(
+            config.switchboards['virgin'].priority_head_start, 300)
+
     def test_digest_messages(self):
         # In LP: #1130697, the digest runner creates MIME digests using the
         # stdlib MIMEMutlipart class, however this class does not have the
@@ -120,3 +186,252 @@ Message-ID: <ant>
         # The list's -request address is the original sender.
         self.assertEqual(bag.msgdata['original_sender'],
                          'test-request@example.com')
+
+
+
+
+class TestBatching(unittest.TestCase):
+    """Test processing queue files in batches."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        create_list('test@example.com')
+        # Rolling back a failed batch must not lose the mailing list.
+        config.db.commit()
+        self._switchboard = config.switchboards['in']
+
+    def _enqueue(self, *message_ids):
+        for message_id in message_ids:
+            msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: {}
+
+""".format(message_id))
+            self._switchboard.enqueue(msg, listid='test.example.com')
+
+    def _backup_files(self):
+        return [filename
+                for filename in os.listdir(self._switchboard.queue_directory)
+                if filename.endswith('.bak')]
+
+    @configuration('runner.in', batch_size=10)
+    def test_one_commit_per_batch(self):
+        self._enqueue('<ant>', '<bee>', '<cat>')
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        commits = []
+        def commit():
+            # Nothing enqueued in the batch is visible before the commit, and
+            # the processed files are still backed up.
+            commits.append((len(config.switchboards['virgin'].files),
+                            len(self._backup_files())))
+        with patch.object(config.db, 'commit', side_effect=commit):
+            runner.run()
+        self.assertEqual(commits, [(0, 3)])
+        messages = get_queue_messages('virgin', sort_on='message-id')
+        self.assertEqual([bag.msg['message-id'] for bag in messages],
+                         ['<ant>', '<bee>', '<cat>'])
+        self.assertEqual(self._backup_files(), [])
+
+    @configuration('runner.in', batch_size=2)
+    def test_batch_size(self):
+        self._enqueue('<ant>', '<bee>', '<cat>')
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        with patch.object(config.db, 'commit') as commit:
+            runner.run()
+        self.assertEqual(commit.call_count, 2)
+        self.assertEqual(len(get_queue_messages('virgin')), 3)
+
+    @configuration('runner.in', batch_size=10)
+    def test_failed_batch_is_replayed(self):
+        # When one file in the batch fails, the batch is rolled back and
+        # replayed one file at a time.  Only the bad file is shunted, and the
+        # good files are only forwarded once.
+        self._enqueue('<ant>', '<bad>', '<cat>')
+        error_log = LogFileMark('mailman.error')
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        runner.run()
+        self.assertIn('Batch failed, replaying 2 files one at a time',
+                      error_log.read())
+        messages = get_queue_messages('virgin', sort_on='message-id')
+        self.assertEqual([bag.msg['message-id'] for bag in messages],
+                         ['<ant>', '<cat>'])
+        shunted = get_queue_messages('shunt')
+        self.assertEqual(len(shunted), 1)
+        self.assertEqual(shunted[0].msg['message-id'], '<bad>')
+        self.assertEqual(len(self._switchboard.files), 0)
+        self.assertEqual(self._backup_files(), [])
+
+
+
+
+class TestConcurrency(unittest.TestCase):
+    """Test processing queue files in a pool of worker threads."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        create_list('test@example.com')
+        # The worker threads have their own database sessions.
+        config.db.commit()
+        self._switchboard = config.switchboards['in']
+
+    def _enqueue(self, *message_ids):
+        for message_id in message_ids:
+            msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: {}
+
+""".format(message_id))
+            self._switchboard.enqueue(msg, listid='test.example.com')
+
+    def _run(self, runner):
+        # Record the order in which the runner dequeues and finishes files,
+        # and the most files it has dequeued but not finished.
+        dequeued = []
+        finished = []
+        most_pending = []
+        dequeue = runner.switchboard.dequeue
+        finish = runner.switchboard.finish
+        def dequeue_and_record(filebase):
+            dequeued.append(filebase)
+            most_pending.append(len(dequeued) - len(finished))
+            return dequeue(filebase)
+        def finish_and_record(filebase, preserve=False):
+            finished.append(filebase)
+            finish(filebase, preserve)
+        with patch.object(runner.switchboard, 'dequeue',
+                          dequeue_and_record), \
+             patch.object(runner.switchboard, 'finish', finish_and_record):
+            runner.run()
+        return dequeued, finished, max(most_pending)
+
+    @configuration('runner.in', concurrency=3)
+    def test_concurrent_processing(self):
+        self._enqueue('<ant>', '<bee>', '<cat>', '<dog>')
+        runner = make_testable_runner(ThreadedRunner, 'in')
+        self._run(runner)
+        self.assertEqual(runner.most_active, 3)
+        messages = get_queue_messages('virgin', sort_on='message-id')
+        self.assertEqual([bag.msg['message-id'] for bag in messages],
+                         ['<ant>', '<bee>', '<cat>', '<dog>'])
+        self.assertEqual(len(self._switchboard.files), 0)
+        self.assertEqual(get_queue_messages('shunt'), [])
+
+    @configuration('runner.in', concurrency=2)
+    def test_worker_sessions(self):
+        # Every worker thread uses its own database session.
+        self._enqueue('<ant>', '<bee>', '<cat>')
+        runner = make_testable_runner(ThreadedRunner, 'in')
+        self._run(runner)
+        self.assertEqual(len(runner.sessions), 2)
+        self.assertNotIn(id(config.db.store()), runner.sessions)
+
+    @configuration('runner.in', concurrency=2)
+    def test_ordered_finish(self):
+        # Files are finished in the order they were dequeued, even though the
+        # first file is the last one to be processed.
+        self._enqueue('<ant>', '<bee>', '<cat>', '<dog>', '<elf>', '<fly>')
+        runner = make_testable_runner(ThreadedRunner, 'in')
+        dequeued, finished, most_pending = self._run(runner)
+        self.assertEqual(len(finished), 6)
+        self.assertEqual(finished, dequeued)
+        # The slow first file holds back the dequeuing of new files.
+        self.assertEqual(most_pending, 4)
+        self.assertEqual(runner.most_active, 2)
+
+    @configuration('runner.in', concurrency=2)
+    def test_worker_languages(self):
+        # Every worker thread has its own translation context.
+        mlist = create_list('ant@example.com')
+        mlist.preferred_language = 'fr'
+        config.db.commit()
+        msg = mfs("""\
+From: anne@example.com
+To: ant@example.com
+Message-ID: <ant>
+
+""")
+        self._switchboard.enqueue(msg, listid='ant.example.com')
+        self._enqueue('<bee>')
+        runner = make_testable_runner(LanguageRunner, 'in')
+        runner.run()
+        self.assertEqual(runner.languages, {'<ant>': 'fr', '<bee>': 'en'})
+        self.assertEqual(get_queue_messages('shunt'), [])
+
+    @configuration('runner.in', concurrency=2)
+    def test_shunt(self):
+        self._enqueue('<ant>', '<bad>', '<cat>')
+        error_log = LogFileMark('mailman.error')
+        runner = make_testable_runner(ThreadedRunner, 'in')
+        self._run(runner)
+        self.assertIn('RuntimeError: borked', error_log.read())
+        messages = get_queue_messages('virgin', sort_on='message-id')
+        self.assertEqual([bag.msg['message-id'] for bag in messages],
+                         ['<ant>', '<cat>'])
+        shunted = get_queue_messages('shunt')
+        self.assertEqual(len(shunted), 1)
+        self.assertEqual(shunted[0].msg['message-id'], '<bad>')
+        self.assertEqual(shunted[0].msgdata['whichq'], 'in')
+        self.assertEqual(len(self._switchboard.files), 0)
+        self.assertEqual(
+            [filename
+             for filename in os.listdir(self._switchboard.queue_directory)
+             if filename.endswith('.bak')],
+            [])
+
+
+
+
+class TestDurability(unittest.TestCase):
+    """Test finishing queue files with batched durability."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        create_list('test@example.com')
+        self._switchboard = config.switchboards['in']
+        # The virgin queue syncs what is enqueued to it only when asked.
+        virgin = config.switchboards['virgin']
+        for name, value in (('durability', 'batched'),
+                            ('sync_interval', 3600)):
+            patcher = patch.object(virgin, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._switchboard.enqueue(msg, listid='test.example.com')
+
+    def _backup_files(self):
+        return [filename
+                for filename in os.listdir(self._switchboard.queue_directory)
+                if filename.endswith('.bak')]
+
+    def test_finish_after_sync(self):
+        # The processed file is only finished once the message it forwarded
+        # to the virgin queue is synced.
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        runner._one_iteration()
+        self.assertEqual(len(config.switchboards['virgin'].files), 1)
+        self.assertEqual(len(self._backup_files()), 1)
+        runner._sync_queues()
+        self.assertEqual(self._backup_files(), [])
+
+    def test_run(self):
+        # The runner's main loop syncs the queues and finishes the files.
+        backups = []
+        def sync():
+            backups.append(len(self._backup_files()))
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        with patch.object(config.switchboards['virgin'], 'sync',
+                          side_effect=sync):
+            runner.run()
+        self.assertIn(1, backups)
+        self.assertEqual(self._backup_files(), [])
+        self.assertEqual(len(get_queue_messages('virgin')), 1)
@@ -18,17 +18,40 @@
 """Switchboard tests."""
 
 __all__ = [
+    'TestDurability',
+    'TestEnqueueBatch',
+    'TestNextFiles',
+    'TestPriorityLanes',
+    'TestQueueFileFormat',
+    'TestQueueIndex',
+    'TestShards',
     'TestSwitchboard',
+    'TestWait',
     ]
 
 
+import os
+import time
+import email
+import pickle
+import shutil
+import tempfile
 import unittest
+import itertools
+import threading
 
+from datetime import datetime
 from mailman.config import config
+from mailman.core.switchboard import (
+    MAGIC, EnqueueBatch, QueueIndex, Switchboard, deserialize, read_entry,
+    serialize, shamax)
+from mailman.email.message import (
+    LazyMessage, Message, UserNotification)
 from mailman.testing.helpers import (
-    LogFileMark,
+    LogFileMark, configuration, get_queue_messages,
     specialized_message_from_string as mfs)
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.watcher import PollingWatcher
 from unittest.mock import patch
 
 
@@ -56,3 +79,674 @@ Message-ID: <ant>
         traceback = error_log.read().splitlines()
         self.assertEqual(traceback[1], 'Traceback (most recent call last):')
         self.assertEqual(traceback[-1], 'OSError: Oops!')
+
+    def test_unique_file_names(self):
+        # The same message enqueued over and over again gets a new name every
+        # time, without hashing the message.
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        with patch('mailman.core.switchboard.time.time', return_value=1.0):
+            filebases = set(serialize(msg, None, dict(listid='test'))[0]
+                            for i in range(100))
+        self.assertEqual(len(filebases), 100)
+        for filebase in filebases:
+            self.assertTrue(filebase.startswith('1.0+'))
+
+    def test_due_file_names(self):
+        # Files which must not be delivered yet are named after the time
+        # they are due, so that the queue keeps them in that order.
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        deliver_after = datetime(2015, 6, 1, 12, 0, 0)
+        with patch('mailman.core.switchboard.time.time', return_value=1.0):
+            later = serialize(msg, None, dict(deliver_after=deliver_after))
+            earlier = serialize(
+                msg, None, dict(deliver_after=datetime(1970, 1, 1)))
+        self.assertTrue(later[0].startswith('1433160000.0+'))
+        self.assertTrue(earlier[0].startswith('1.0+'))
+
+    def test_uniform_slices(self):
+        # Queue file names are spread evenly over the runner slices.
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        counts = [0] * 4
+        for i in range(4000):
+            filebase = serialize(msg, None, dict(listid='test'))[0]
+            digest = int(filebase.split('+')[1], 16)
+            counts[digest * 4 // (shamax + 1)] += 1
+        for count in counts:
+            self.assertGreater(count, 800)
+
+    def test_list_affinity(self):
+        # With list slicing, all the files for a list are in the same slice,
+        # and the lists are spread over the slices.
+        queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, queue_directory)
+        switchboard = Switchboard('test', queue_directory, slicing='list')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        slices = [Switchboard('test', queue_directory, i, 4)
+                  for i in range(4)]
+        for i in range(40):
+            switchboard.enqueue(msg, listid='list{}.example.com'.format(i))
+            switchboard.enqueue(msg, listid='list{}.example.com'.format(i))
+        lists = []
+        for slice in slices:
+            found = set()
+            for filebase in slice.files:
+                msg, msgdata = slice.dequeue(filebase)
+                found.add(msgdata['listid'])
+            self.assertGreater(len(found), 0)
+            lists.extend(found)
+        self.assertEqual(len(lists), 40)
+        self.assertEqual(len(set(lists)), 40)
+
+    def test_hot_list_fairness(self):
+        # A busy list doesn't starve the other lists in its slice, since the
+        # slice is still processed in FIFO order.
+        queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, queue_directory)
+        switchboard = Switchboard('test', queue_directory, slicing='list')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        hot = switchboard.enqueue(msg, listid='hot.example.com')
+        slices = [Switchboard('test', queue_directory, i, 2)
+                  for i in range(2)]
+        slice = [slice for slice in slices if hot in slice.files][0]
+        # Find another list in the same slice.
+        for i in itertools.count():
+            cold = switchboard.enqueue(
+                msg, listid='cold{}.example.com'.format(i))
+            if cold in slice.files:
+                break
+            os.remove(os.path.join(queue_directory, cold + '.pck'))
+        for i in range(10):
+            switchboard.enqueue(msg, listid='hot.example.com')
+        self.assertEqual(slice.next_files(2), [hot, cold])
+
+    @configuration('runner.virgin', slicing='list')
+    def test_configured_slicing(self):
+        self.assertEqual(config.switchboards['virgin'].slicing, 'list')
+        self.assertEqual(config.switchboards['in'].slicing, 'message')
+
+
+
+class TestWait(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._switchboard = config.switchboards['shunt']
+        # Forget about any files which arrived during earlier tests.
+        self._switchboard.wait(0)
+
+    def _enqueue_later(self, switchboard):
+        def enqueue():
+            time.sleep(0.2)
+            switchboard.enqueue(self._msg)
+        thread = threading.Thread(target=enqueue)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_wait_times_out(self):
+        # With nothing arriving in the queue, wait() returns False once the
+        # timeout expires.
+        self.assertFalse(self._switchboard.wait(0.1))
+
+    def test_wait_wakes_on_enqueue(self):
+        # wait() returns as soon as another process drops a file into the
+        # queue, well before the timeout expires.
+        self._enqueue_later(self._switchboard)
+        start = time.time()
+        self.assertTrue(self._switchboard.wait(10))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(self._switchboard.files), 1)
+
+    def test_earlier_arrivals_are_not_missed(self):
+        # A file that lands between scanning the queue and waiting on it
+        # wakes the waiter immediately.
+        self._switchboard.enqueue(self._msg)
+        self.assertTrue(self._switchboard.wait(10))
+
+    def test_polling_fallback(self):
+        # The polling watcher is used where inotify is not available.
+        # Because it can't tell temporary files from queue files, it may
+        # wake up early, but it never times out when a file arrives.
+        watcher = PollingWatcher(self._switchboard.queue_directory)
+        self._enqueue_later(self._switchboard)
+        while len(self._switchboard.files) == 0:
+            self.assertTrue(watcher.wait(10))
+        self.assertEqual(len(self._switchboard.files), 1)
+
+
+
+
+class TestQueueIndex(unittest.TestCase):
+    def test_fifo_order(self):
+        index = QueueIndex()
+        index.add('3.0+cc')
+        index.add('1.0+aa')
+        index.add('2.0+bb')
+        self.assertEqual(index.oldest(), ['1.0+aa', '2.0+bb', '3.0+cc'])
+        self.assertEqual(index.oldest(2), ['1.0+aa', '2.0+bb'])
+        # Asking doesn't consume anything.
+        self.assertEqual(len(index), 3)
+
+    def test_discard(self):
+        index = QueueIndex()
+        index.add('1.0+aa')
+        index.add('2.0+bb')
+        index.discard('1.0+aa')
+        index.discard('9.0+ff')
+        self.assertNotIn('1.0+aa', index)
+        self.assertEqual(index.oldest(1), ['2.0+bb'])
+        # A file which is discarded and then added again is only reported
+        # once.
+        index.add('1.0+aa')
+        self.assertEqual(index.oldest(5), ['1.0+aa', '2.0+bb'])
+        self.assertEqual(index.oldest(), ['1.0+aa', '2.0+bb'])
+
+    def test_update(self):
+        index = QueueIndex()
+        index.add('1.0+aa')
+        index.add('2.0+bb')
+        index.update(['2.0+bb', '3.0+cc'])
+        self.assertEqual(index.oldest(), ['2.0+bb', '3.0+cc'])
+
+    def test_predicate(self):
+        index = QueueIndex(lambda digest: digest < 0x80)
+        index.add('1.0+7f')
+        index.add('2.0+80')
+        self.assertEqual(index.oldest(), ['1.0+7f'])
+
+
+
+
+class TestNextFiles(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._switchboard = Switchboard('test', self._queue_directory)
+        # Another process writing into the same queue.
+        self._other = Switchboard('test', self._queue_directory)
+
+    def test_fifo_order(self):
+        filebases = [self._other.enqueue(self._msg) for i in range(5)]
+        self.assertEqual(self._switchboard.next_files(), filebases)
+        self.assertEqual(self._switchboard.next_files(), self._other.files)
+
+    def test_count(self):
+        filebases = [self._other.enqueue(self._msg) for i in range(5)]
+        self.assertEqual(self._switchboard.next_files(2), filebases[:2])
+
+    def test_arrivals(self):
+        # Files enqueued by this switchboard or by another process after the
+        # index was built are found.
+        self.assertEqual(self._switchboard.next_files(), [])
+        mine = self._switchboard.enqueue(self._msg)
+        theirs = self._other.enqueue(self._msg)
+        self.assertEqual(self._switchboard.next_files(), [mine, theirs])
+
+    def test_departures(self):
+        filebases = [self._other.enqueue(self._msg) for i in range(3)]
+        self.assertEqual(self._switchboard.next_files(), filebases)
+        self._switchboard.dequeue(filebases[0])
+        self._switchboard.finish(filebases[0])
+        self._other.dequeue(filebases[1])
+        self.assertEqual(self._switchboard.next_files(), filebases[2:])
+
+    def test_recovered_files(self):
+        # A file which is dequeued and then recovered from its backup comes
+        # back.
+        filebase = self._other.enqueue(self._msg)
+        self.assertEqual(self._switchboard.next_files(), [filebase])
+        self._other.dequeue(filebase)
+        self.assertEqual(self._switchboard.next_files(), [])
+        self._other.recover_backup_files()
+        self.assertEqual(self._switchboard.next_files(), [filebase])
+
+    def test_slices(self):
+        filebases = [self._other.enqueue(self._msg) for i in range(20)]
+        slices = [Switchboard('test', self._queue_directory, i, 4)
+                  for i in range(4)]
+        found = [switchboard.next_files() for switchboard in slices]
+        for switchboard, files in zip(slices, found):
+            self.assertEqual(files, switchboard.files)
+        self.assertEqual(sorted(sum(found, [])), sorted(filebases))
+
+    def test_polling_watcher(self):
+        with patch('mailman.core.switchboard.make_watcher', PollingWatcher):
+            switchboard = Switchboard('test', self._queue_directory)
+            self.assertEqual(switchboard.next_files(), [])
+            filebase = self._other.enqueue(self._msg)
+            self.assertEqual(switchboard.next_files(), [filebase])
+            self._other.dequeue(filebase)
+            self.assertEqual(switchboard.next_files(), [])
+
+    def test_backlog(self):
+        self.assertEqual(self._switchboard.backlog(), (0, None))
+        before = time.time()
+        filebases = [self._other.enqueue(self._msg) for i in range(3)]
+        count, when = self._switchboard.backlog()
+        self.assertEqual(count, 3)
+        self.assertGreaterEqual(when, before - 1)
+        self.assertLessEqual(when, time.time())
+        # The head of the queue was enqueued first.
+        self._switchboard.dequeue(filebases[0])
+        count, later = self._switchboard.backlog()
+        self.assertEqual(count, 2)
+        self.assertGreaterEqual(later, when)
+
+
+
+
+class TestEnqueueBatch(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._switchboard = Switchboard('test', self._queue_directory)
+
+    def test_publish(self):
+        with EnqueueBatch() as batch:
+            filebase = self._switchboard.enqueue(self._msg)
+            self.assertEqual(self._switchboard.files, [])
+            batch.publish()
+        self.assertEqual(self._switchboard.files, [filebase])
+
+    def test_discard(self):
+        with EnqueueBatch() as batch:
+            self._switchboard.enqueue(self._msg)
+            batch.discard()
+        self.assertEqual(os.listdir(self._queue_directory), [])
+
+    def test_unpublished_files_are_discarded(self):
+        with EnqueueBatch():
+            self._switchboard.enqueue(self._msg)
+        self.assertEqual(os.listdir(self._queue_directory), [])
+        # Outside of a batch, files are enqueued immediately.
+        filebase = self._switchboard.enqueue(self._msg)
+        self.assertEqual(self._switchboard.files, [filebase])
+
+
+
+
+class TestDurability(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+
+    def _enqueue(self, durability, count, sync_interval=0):
+        switchboard = Switchboard(
+            'test', self._queue_directory,
+            durability=durability, sync_interval=sync_interval)
+        with patch('mailman.core.switchboard.os.fsync') as fsync, \
+             patch('mailman.core.switchboard.sync_directory') as sync:
+            filebases = [switchboard.enqueue(self._msg)
+                         for i in range(count)]
+            switchboard.sync()
+        return filebases, fsync, sync
+
+    def test_strict(self):
+        filebases, fsync, sync = self._enqueue('strict', 3)
+        self.assertEqual(fsync.call_count, 3)
+        self.assertEqual(sync.call_count, 0)
+
+    def test_relaxed(self):
+        filebases, fsync, sync = self._enqueue('relaxed', 3)
+        self.assertEqual(fsync.call_count, 0)
+        self.assertEqual(sync.call_count, 0)
+
+    def test_batched(self):
+        # Within the sync interval, the files are only synced when asked to.
+        filebases, fsync, sync = self._enqueue('batched', 3, 60)
+        self.assertEqual(fsync.call_count, 0)
+        self.assertEqual(sync.call_count, 1)
+        self.assertEqual(
+            sync.call_args[0],
+            (self._queue_directory,
+             [filebase + '.pck' for filebase in filebases]))
+
+    def test_batched_interval_expired(self):
+        # Once the sync interval has passed, the next enqueue syncs.
+        filebases, fsync, sync = self._enqueue('batched', 3)
+        self.assertEqual(fsync.call_count, 0)
+        self.assertEqual(sync.call_count, 3)
+
+    @configuration('runner.virgin', durability='relaxed')
+    def test_configured_durability(self):
+        self.assertEqual(config.switchboards['virgin'].durability, 'relaxed')
+        self.assertEqual(config.switchboards['in'].durability, 'strict')
+
+
+
+
+class TestQueueFileFormat(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+Subject: A test
+
+First line.
+""")
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._switchboard = Switchboard('test', self._queue_directory)
+
+    def _path(self, filebase):
+        return os.path.join(self._queue_directory, filebase + '.pck')
+
+    def test_raw_message(self):
+        # Plain messages are stored as bytes, not as pickles.
+        filebase = self._switchboard.enqueue(self._msg, foo=7)
+        with open(self._path(filebase), 'rb') as fp:
+            contents = fp.read()
+        self.assertTrue(contents.startswith(MAGIC))
+        self.assertTrue(contents.endswith(self._msg.as_bytes()))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertIsInstance(msg, LazyMessage)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msg.get_payload(), 'First line.\n')
+        self.assertEqual(msgdata['foo'], 7)
+        self.assertNotIn('_rawmsg', msgdata)
+        self.assertNotIn('_msgattrs', msgdata)
+
+    def test_attributes_are_preserved(self):
+        self._msg.original_size = 1234
+        self._msg.set_unixfrom('From anne@example.com')
+        filebase = self._switchboard.enqueue(self._msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg.original_size, 1234)
+        self.assertEqual(msg.get_unixfrom(), 'From anne@example.com')
+
+    def test_body_is_parsed_lazily(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['subject'], 'A test')
+        self.assertEqual(msg.raw_body, b'First line.\n')
+        # Requeuing an unparsed message doesn't change it.
+        filebase = self._switchboard.enqueue(msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg.as_bytes(), self._msg.as_bytes())
+        # Modifying the body is seen after requeuing.
+        msg.set_payload('Second line.\n')
+        self.assertIsNone(msg.raw_body)
+        filebase = self._switchboard.enqueue(msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg.get_payload(), 'Second line.\n')
+
+    def test_subclasses_are_pickled(self):
+        # Instances of Message subclasses may carry state of their own.
+        msg = UserNotification(
+            'anne@example.com', 'test@example.com', 'A test', 'Hello')
+        filebase = self._switchboard.enqueue(msg)
+        with open(self._path(filebase), 'rb') as fp:
+            contents = fp.read()
+        self.assertTrue(contents.startswith(MAGIC))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertIsInstance(msg, UserNotification)
+        self.assertEqual(msg['subject'], 'A test')
+
+    def test_unflattenable_messages_are_pickled(self):
+        # A non-ASCII header value would come back encoded.
+        self._msg['X-Name'] = 'Ann\xe9'
+        filebase = self._switchboard.enqueue(self._msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertNotIsInstance(msg, LazyMessage)
+        self.assertEqual(msg['x-name'], 'Ann\xe9')
+
+    def test_undecodable_bytes(self):
+        # Parsed 8-bit messages are stored as they were received.
+        raw = (b'From: anne@example.com\nSubject: Caf\xe9\n\n'
+               b'Na\xefve.\n')
+        msg = email.message_from_bytes(raw, Message)
+        filebase = self._switchboard.enqueue(msg)
+        with open(self._path(filebase), 'rb') as fp:
+            self.assertTrue(fp.read().endswith(raw))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertIsInstance(msg, LazyMessage)
+        self.assertEqual(msg.as_bytes(), raw)
+
+    def test_version_1_files(self):
+        # Files written by older versions of Mailman are still readable.
+        filebase = '1234567890.1234+0123456789abcdef0123456789abcdef01234567'
+        with open(self._path(filebase), 'wb') as fp:
+            pickle.dump(self._msg, fp, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(dict(foo=7, _parsemsg=False), fp,
+                        pickle.HIGHEST_PROTOCOL)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['foo'], 7)
+
+    def test_recovered_version_1_files(self):
+        # Recovering a version 1 backup file converts it.
+        filebase = '1234567890.1234+0123456789abcdef0123456789abcdef01234567'
+        backfile = os.path.join(self._queue_directory, filebase + '.bak')
+        with open(backfile, 'wb') as fp:
+            pickle.dump(self._msg, fp, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(dict(foo=7, _parsemsg=False), fp,
+                        pickle.HIGHEST_PROTOCOL)
+        self._switchboard.recover_backup_files()
+        with open(self._path(filebase), 'rb') as fp:
+            self.assertTrue(fp.read().startswith(MAGIC))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['foo'], 7)
+        self.assertEqual(msgdata['_bak_count'], 1)
+
+
+
+
+class TestPriorityLanes(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._switchboard = Switchboard(
+            'test', self._queue_directory, priority_head_start=60)
+
+    def _enqueue(self, when, priority):
+        with patch('mailman.core.switchboard.time.time', return_value=when):
+            return self._switchboard.enqueue(self._msg, priority=priority)
+
+    def test_file_names(self):
+        # The lane is part of the file name, except for the normal lane.
+        self.assertTrue(self._enqueue(1000, 'high').endswith('+high'))
+        self.assertTrue(self._enqueue(1000, 'low').endswith('+low'))
+        self.assertEqual(self._enqueue(1000, 'normal').count('+'), 1)
+        self.assertRaises(ValueError, self._enqueue, 1000, 'urgent')
+
+    def test_order(self):
+        low = self._enqueue(1000, 'low')
+        normal = self._enqueue(1000, 'normal')
+        high = self._enqueue(1030, 'high')
+        self.assertEqual(self._switchboard.files, [high, normal, low])
+        self.assertEqual(self._switchboard.next_files(), [high, normal, low])
+
+    def test_no_starvation(self):
+        # Files in lower lanes eventually go ahead of the higher ones.
+        low = self._enqueue(1000, 'low')
+        normal = self._enqueue(1100, 'normal')
+        high = self._enqueue(1200, 'high')
+        self.assertEqual(self._switchboard.files, [low, normal, high])
+        self.assertEqual(self._switchboard.next_files(), [low, normal, high])
+
+    def test_fifo(self):
+        # Without a head start, the lanes don't matter.
+        switchboard = Switchboard('test', self._queue_directory)
+        low = self._enqueue(1000, 'low')
+        high = self._enqueue(1030, 'high')
+        self.assertEqual(switchboard.files, [low, high])
+        self.assertEqual(switchboard.next_files(), [low, high])
+
+    def test_priority_is_kept(self):
+        filebase = self._enqueue(1000, 'high')
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['priority'], 'high')
+
+    def test_lane_depths(self):
+        self._enqueue(1000, 'high')
+        self._enqueue(1000, 'low')
+        self._enqueue(1000, 'low')
+        self.assertEqual(self._switchboard.lane_depths(),
+                         dict(high=1, normal=0, low=2))
+
+    def test_user_notifications(self):
+        # Notifications go in the high lane.
+        msg = UserNotification(
+            'anne@example.com', 'test@example.com', 'A test', 'Hello')
+        msg.send(None)
+        items = get_queue_messages('virgin')
+        self.assertEqual(items[0].msgdata['priority'], 'high')
+
+
+
+
+class TestShards(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+A message for many recipients.
+""")
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._switchboard = Switchboard('test', self._queue_directory)
+        self._shards = [dict(recipients=['anne@example.com']),
+                        dict(recipients=['bart@example.com']),
+                        dict(recipients=['cris@example.com']),
+                        dict(recipients=['dave@example.com'])]
+
+    def _body(self, filebase, directory=None):
+        return os.path.join(directory or self._queue_directory,
+                            filebase + '.msg')
+
+    def test_shared_message(self):
+        # The shards share one copy of the message.
+        filebases = self._switchboard.enqueue_shards(
+            self._msg, self._shards, dict(tolist=True), listid='test')
+        self.assertEqual(sorted(self._switchboard.files), sorted(filebases))
+        inodes = set(os.stat(self._body(filebase)).st_ino
+                     for filebase in filebases)
+        self.assertEqual(len(inodes), 1)
+        self.assertEqual(os.stat(self._body(filebases[0])).st_nlink, 4)
+        with open(os.path.join(self._queue_directory,
+                               filebases[0] + '.pck'), 'rb') as fp:
+            self.assertNotIn(b'many recipients', fp.read())
+        for filebase, shard in zip(filebases, self._shards):
+            msg, msgdata = self._switchboard.dequeue(filebase)
+            self.assertEqual(msg['message-id'], '<ant>')
+            self.assertEqual(msg.get_payload(),
+                             'A message for many recipients.\n')
+            self.assertEqual(msgdata['recipients'], shard['recipients'])
+            self.assertTrue(msgdata['tolist'])
+            self.assertEqual(msgdata['listid'], 'test')
+            self.assertNotIn('_sharedmsg', msgdata)
+            self._switchboard.finish(filebase)
+        # The message is gone with the last shard.
+        self.assertEqual(os.listdir(self._queue_directory), [])
+
+    def test_shards_are_spread_over_slices(self):
+        # With as many slices as shards, every shard goes to its own slice,
+        # even with list affinity.
+        for slicing in ('message', 'list'):
+            switchboard = Switchboard(
+                'test', self._queue_directory, slicing=slicing)
+            for i in range(10):
+                filebases = switchboard.enqueue_shards(
+                    self._msg, self._shards, listid='test')
+                for slice in range(4):
+                    found = Switchboard(
+                        'test', self._queue_directory, slice, 4).files
+                    self.assertEqual(len(found), 1)
+                for filebase in filebases:
+                    switchboard.dequeue(filebase)
+                    switchboard.finish(filebase)
+
+    def test_preserve(self):
+        # A preserved shard takes its link to the message to the bad queue.
+        filebases = self._switchboard.enqueue_shards(
+            self._msg, self._shards)
+        self._switchboard.dequeue(filebases[0])
+        self._switchboard.finish(filebases[0], preserve=True)
+        bad_dir = config.switchboards['bad'].queue_directory
+        psvfile = os.path.join(bad_dir, filebases[0] + '.psv')
+        self.addCleanup(os.remove, psvfile)
+        self.addCleanup(os.remove, self._body(filebases[0], bad_dir))
+        with open(psvfile, 'rb') as fp:
+            msg, msgdata = deserialize(*read_entry(fp))
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['recipients'], ['anne@example.com'])
+        # The other shards still have the message.
+        msg, msgdata = self._switchboard.dequeue(filebases[1])
+        self.assertEqual(msg['message-id'], '<ant>')
+
+    def test_enqueue_batch(self):
+        # Shards which are not published are thrown away, along with their
+        # message.
+        with EnqueueBatch():
+            self._switchboard.enqueue_shards(self._msg, self._shards)
+        self.assertEqual(os.listdir(self._queue_directory), [])
@@ -0,0 +1,67 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Queue entry and body tables
+
+Revision ID: 4bd95c99b2e
+Revises: 2bb9b382198
+Create Date: 2015-04-14 11:32:07.428591
+
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '4bd95c99b2e'
+down_revision = '2bb9b382198'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'queueentry',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('queue', sa.Unicode(), nullable=False),
+        sa.Column('filebase', sa.Unicode(), nullable=False),
+        sa.Column('received', sa.Float(), nullable=False),
+        sa.Column('bucket', sa.Integer(), nullable=False),
+        sa.Column('message', sa.LargeBinary(), nullable=False),
+        sa.Column('metadata', sa.LargeBinary(), nullable=False),
+        sa.Column('owner', sa.Unicode(), nullable=True),
+        sa.Column('lease_expires', sa.Float(), nullable=True),
+        sa.Column('dequeued', sa.Boolean(), nullable=False),
+        sa.Column('bak_count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('filebase')
+        )
+    op.create_index(
+        'ix_queueentry_queue_received', 'queueentry', ['queue', 'received'])
+    op.create_table(
+        'queuebody',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('key', sa.Unicode(), nullable=False),
+        sa.Column('message', sa.LargeBinary(), nullable=False),
+        sa.Column('shards', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('key')
+        )
+
+
+def downgrade():
+    op.drop_table('queuebody')
+    op.drop_index('ix_queueentry_queue_received', 'queueentry')
+    op.drop_table('queueentry')
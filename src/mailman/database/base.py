@@ -24,11 +24,13 @@ __all__ = [
 
 import logging
 
+from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from mailman.interfaces.database import IDatabase
+from mailman.utilities.modules import find_name
 from mailman.utilities.string import expand
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from zope.interface import implementer
 
 
@@ -86,6 +88,41 @@ class SABaseDatabase:
         """
         pass
 
+    def _engine_options(self):
+        """Return the options for creating the engine.
+
+        These are the engine and connection pool options in the `[database]`
+        section which are set.  Override this to add options which are
+        specific to a database.
+
+        :return: The keyword arguments for `create_engine()`.
+        :rtype: dict
+        """
+        section = config.database
+        options = {}
+        if section.pool_class:
+            options['poolclass'] = find_name(section.pool_class)
+        for name in ('pool_size', 'max_overflow'):
+            value = getattr(section, name)
+            if value:
+                options[name] = int(value)
+        for name in ('pool_timeout', 'pool_recycle'):
+            value = getattr(section, name)
+            if value:
+                options[name] = int(as_timedelta(value).total_seconds())
+        if as_boolean(section.pool_pre_ping):
+            options['pool_pre_ping'] = True
+        return options
+
+    def _configure_engine(self, engine):
+        """Prepare a newly created engine before it is used.
+
+        Override this to e.g. listen for the engine's connection events.
+
+        :param engine: The engine.
+        """
+        pass
+
     def initialize(self, debug=None):
         """See `IDatabase`."""
         # Calculate the engine url.
@@ -107,7 +144,10 @@ class SABaseDatabase:
         # engines, and yes, we could have chmod'd the file after the fact, but
         # half dozen and all...
         self.url = url
-        self.engine = create_engine(url)
-        session = sessionmaker(bind=self.engine)
-        self.store = session()
+        self.engine = create_engine(url, **self._engine_options())
+        self._configure_engine(self.engine)
+        # Every thread gets its own session, so that runners can process
+        # queue files concurrently, each in its own transaction.  The store
+        # proxies to the calling thread's session.
+        self.store = scoped_session(sessionmaker(bind=self.engine))
         self.store.commit()
@@ -26,6 +26,8 @@ __all__ = [
 import os
 import types
 import alembic.command
+# The queue entry table has no model class to make it part of the schema.
+import mailman.model.queueentry
 
 from alembic.migration import MigrationContext
 from alembic.script import ScriptDirectory
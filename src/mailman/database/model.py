@@ -19,6 +19,7 @@
 
 __all__ = [
     'Model',
+    'in_batches',
     ]
 
 
@@ -28,6 +29,10 @@ from mailman.config import config
 from sqlalchemy.ext.declarative import declarative_base
 
 
+# SQLite allows at most 999 parameters in a statement.
+IN_BATCH_SIZE = 500
+
+
 class ModelMeta:
     """The custom metaclass for all model base classes.
 
@@ -52,3 +57,16 @@ class ModelMeta:
 
 
 Model = declarative_base(cls=ModelMeta)
+
+
+def in_batches(values):
+    """Split values into lists which fit into an IN clause.
+
+    :param values: The values to look up.
+    :type values: iterable
+    :return: Lists of at most `IN_BATCH_SIZE` values.
+    :rtype: iterator of lists
+    """
+    values = list(values)
+    for start in range(0, len(values), IN_BATCH_SIZE):
+        yield values[start:start + IN_BATCH_SIZE]
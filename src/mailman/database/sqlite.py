@@ -24,10 +24,34 @@ __all__ = [
 
 import os
 
+from lazr.config import as_timedelta
+from mailman.config import config
 from mailman.database.base import SABaseDatabase
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool
 from urllib.parse import urlparse
 
 
+def _keyword(*keywords):
+    def convert(value):
+        if value.lower() not in keywords:
+            raise ValueError(value)
+        return value.lower()
+    return convert
+
+
+# The pragmas set on every new connection, and the functions which turn
+# their configured values into SQL.  The values are spliced into the pragma
+# statements, so anything else is rejected.
+PRAGMAS = (
+    ('journal_mode',
+     _keyword('delete', 'truncate', 'persist', 'memory', 'wal', 'off')),
+    ('synchronous',
+     _keyword('off', 'normal', 'full', 'extra', '0', '1', '2', '3')),
+    ('mmap_size', int),
+    )
+
+
 
 class SQLiteDatabase(SABaseDatabase):
     """Database class for SQLite."""
@@ -43,3 +67,55 @@ class SQLiteDatabase(SABaseDatabase):
         # Ignore errors
         if fd > 0:
             os.close(fd)
+
+    def _engine_options(self):
+        """See `SABaseDatabase`."""
+        options = super(SQLiteDatabase, self)._engine_options()
+        section = config.database
+        # Writers wait this long for each other before they fail with
+        # "database is locked".
+        connect_args = dict(timeout=as_timedelta(
+            section.sqlite_busy_timeout).total_seconds())
+        if section.sqlite_cached_statements:
+            connect_args['cached_statements'] = int(
+                section.sqlite_cached_statements)
+        if options.get('poolclass', NullPool) is not NullPool:
+            # The pool hands a connection to one thread at a time, but not
+            # always to the one which opened it.
+            connect_args['check_same_thread'] = False
+        options['connect_args'] = connect_args
+        return options
+
+    def _pragmas(self):
+        """Return the statements which set the configured pragmas.
+
+        :return: The pragma statements.
+        :rtype: list of str
+        :raises ValueError: when a pragma's configured value is invalid.
+        """
+        statements = []
+        for name, convert in PRAGMAS:
+            value = getattr(config.database, 'sqlite_' + name)
+            if not value:
+                continue
+            try:
+                value = convert(value)
+            except ValueError:
+                raise ValueError(
+                    'Bad [database]sqlite_{0} value: {1}'.format(
+                        name, value)) from None
+            statements.append('PRAGMA {0} = {1}'.format(name, value))
+        return statements
+
+    def _configure_engine(self, engine):
+        """See `SABaseDatabase`."""
+        # Check the pragmas before the first connection is made.
+        statements = self._pragmas()
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+            finally:
+                cursor.close()
+        event.listen(engine, 'connect', set_pragmas)
@@ -0,0 +1,117 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the database engine and connection pool options."""
+
+__all__ = [
+    'TestEngineOptions',
+    'TestSQLitePragmas',
+    ]
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mailman.database.sqlite import SQLiteDatabase
+from mailman.testing.helpers import configuration
+from mailman.testing.layers import ConfigLayer
+from sqlalchemy.pool import QueuePool
+
+
+
+
+class TestEngineOptions(unittest.TestCase):
+    """Test the engine and connection pool options."""
+
+    layer = ConfigLayer
+
+    def test_defaults(self):
+        # Only SQLite's busy timeout is set by default.
+        self.assertEqual(SQLiteDatabase()._engine_options(),
+                         dict(connect_args=dict(timeout=5)))
+
+    @configuration('database', pool_class='sqlalchemy.pool.QueuePool',
+                   pool_size=3, max_overflow=2, pool_timeout='10s',
+                   pool_recycle='1h', pool_pre_ping='yes',
+                   sqlite_busy_timeout='30s', sqlite_cached_statements=500)
+    def test_pool_options(self):
+        self.assertEqual(SQLiteDatabase()._engine_options(), dict(
+            poolclass=QueuePool, pool_size=3, max_overflow=2,
+            pool_timeout=10, pool_recycle=3600, pool_pre_ping=True,
+            connect_args=dict(timeout=30, cached_statements=500,
+                              check_same_thread=False)))
+
+
+
+
+class TestSQLitePragmas(unittest.TestCase):
+    """Test the pragmas set on SQLite connections."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self._url = 'sqlite:///' + os.path.join(tempdir, 'test.db')
+
+    def _pragmas(self):
+        database = SQLiteDatabase()
+        database.initialize()
+        self.addCleanup(database.engine.dispose)
+        with database.engine.connect() as connection:
+            return [connection.execute('PRAGMA ' + name).scalar()
+                    for name in ('journal_mode', 'synchronous',
+                                 'busy_timeout')]
+
+    def test_defaults(self):
+        # SQLite's default synchronous setting depends on how it was built,
+        # so only the other defaults are checked.
+        with configuration('database', url=self._url,
+                           sqlite_synchronous='full'):
+            journal_mode, synchronous, busy_timeout = self._pragmas()
+        self.assertEqual(journal_mode, 'delete')
+        # FULL
+        self.assertEqual(synchronous, 2)
+        self.assertEqual(busy_timeout, 5000)
+
+    def test_tuned(self):
+        with configuration('database', url=self._url,
+                           pool_class='sqlalchemy.pool.QueuePool',
+                           sqlite_journal_mode='wal',
+                           sqlite_synchronous='normal',
+                           sqlite_mmap_size=1048576,
+                           sqlite_busy_timeout='30s'):
+            journal_mode, synchronous, busy_timeout = self._pragmas()
+        self.assertEqual(journal_mode, 'wal')
+        # NORMAL
+        self.assertEqual(synchronous, 1)
+        self.assertEqual(busy_timeout, 30000)
+
+    def test_bad_values(self):
+        # Pragma values which SQLite doesn't know are rejected before they
+        # get anywhere near an SQL statement.
+        for name, value in (('sqlite_journal_mode', 'wal; DROP TABLE user'),
+                            ('sqlite_synchronous', 'sometimes'),
+                            ('sqlite_mmap_size', '1e6')):
+            with configuration('database', url=self._url, **{name: value}):
+                with self.assertRaises(ValueError) as cm:
+                    SQLiteDatabase().initialize()
+            self.assertEqual(
+                str(cm.exception),
+                'Bad [database]{0} value: {1}'.format(name, value))
@@ -160,3 +160,16 @@ class TestSchemaManager(unittest.TestCase):
             self.schema_mgr.setup_database()
             self.assertFalse(alembic_command.stamp.called)
             self.assertTrue(alembic_command.upgrade.called)
+
+    def test_queue_entry_table(self):
+        # Upgrading a database from before the database switchboard creates
+        # the queue entry and body tables.
+        Model.metadata.create_all(config.db.engine)
+        Model.metadata.tables['queueentry'].drop(config.db.engine)
+        Model.metadata.tables['queuebody'].drop(config.db.engine)
+        alembic.command.stamp(alembic_cfg, '2bb9b382198')
+        self.assertFalse(self._table_exists('queueentry'))
+        self.assertFalse(self._table_exists('queuebody'))
+        self.schema_mgr.setup_database()
+        self.assertTrue(self._table_exists('queueentry'))
+        self.assertTrue(self._table_exists('queuebody'))
@@ -24,6 +24,7 @@ attributes.
 """
 
 __all__ = [
+    'LazyMessage',
     'Message',
     'MultipartDigestMessage',
     'OwnerNotification',
@@ -31,16 +32,24 @@ __all__ = [
     ]
 
 
+import re
 import email
 import email.message
+import email.parser
 import email.utils
 
+from email.generator import BytesGenerator
 from email.header import Header
+from io import BytesIO
 from email.mime.multipart import MIMEMultipart
 from mailman.config import config
 
 
 COMMASPACE = ', '
+# The end of a message's header block.
+HEADER_END = re.compile(br'\n\r?\n')
+# Any line ending, for converting them all to the same one.
+LINE_END = re.compile(br'\r\n|\r(?!\n)|\n')
 VERSION = tuple(int(v) for v in email.__version__.split('.'))
 
 
@@ -69,6 +78,44 @@ class Message(email.message.Message):
         # There's really nothing to check; there's nothing newer than email
         # 4.0.1 at the moment.
 
+    def __getstate__(self):
+        # The flattened message is not worth pickling or copying.
+        values = self.__dict__.copy()
+        values.pop('_flattened', None)
+        return values
+
+    def flattened(self, linesep=None):
+        """Return the message as bytes, ready to be sent.
+
+        The message is only flattened when it has changed since the last
+        time, so that e.g. the chunks of a bulk delivery and the logging of
+        its size share the work.  Headers are not rewrapped.
+
+        :param linesep: The line ending to convert all line endings to, e.g.
+            CRLF for SMTP.  By default, the line endings are left as they
+            are, which is usually LF.
+        :type linesep: str
+        :return: The message.
+        :rtype: bytes
+        """
+        state = _flattened_state(self)
+        cached = self.__dict__.get('_flattened')
+        if cached is None or cached[0] != state:
+            # The generator adds a boundary to multiparts which have none.
+            data = self._flatten()
+            cached = (_flattened_state(self), {None: data})
+            self.__dict__['_flattened'] = cached
+        converted = cached[1]
+        if linesep not in converted:
+            converted[linesep] = LINE_END.sub(
+                linesep.encode('ascii'), converted[None])
+        return converted[linesep]
+
+    def _flatten(self):
+        fp = BytesIO()
+        BytesGenerator(fp, mangle_from_=False, maxheaderlen=0).flatten(self)
+        return fp.getvalue()
+
     @property
     def sender(self):
         """The address considered to be the author of the email.
@@ -130,6 +177,146 @@ class Message(email.message.Message):
         return clean_senders
 
 
+
+class LazyMessage(Message):
+    """A message whose body is only parsed when it is needed.
+
+    The headers are parsed right away, but the body is kept as raw bytes
+    until something looks at the message's payload.  Messages which only
+    have their headers examined and changed can thus be written out again
+    without ever parsing or regenerating a possibly huge body.
+    """
+
+    def __init__(self):
+        super(LazyMessage, self).__init__()
+        # The raw bytes of the whole message while the body is unparsed,
+        # otherwise None.
+        self._raw = None
+        self._body_start = None
+        # The headers as parsed from the raw bytes and the offset of their
+        # end, or None if the raw header block can't be reused.
+        self._raw_headers = []
+        self._header_end = None
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Create a message from its RFC 5322 bytes, parsing only headers.
+
+        :param data: The message.
+        :type data: bytes
+        :return: The message, with an unparsed body.
+        :rtype: `LazyMessage`
+        """
+        # Even in headers only mode, the parser reads the body line by line,
+        # so only give it the part up to the first empty line.
+        if data.startswith((b'\n', b'\r\n')):
+            end = 0
+        else:
+            match = HEADER_END.search(data)
+            end = (len(data) if match is None else match.end())
+        parsed = email.parser.BytesParser(Message).parsebytes(
+            data[:end], headersonly=True)
+        # The parser also ends the headers at the first line which isn't a
+        # header, and decodes the raw bytes as ASCII with surrogate escapes.
+        rest = parsed._payload.encode('ascii', 'surrogateescape')
+        msg = cls()
+        msg._headers = parsed._headers
+        msg._unixfrom = parsed._unixfrom
+        msg.defects = parsed.defects
+        msg._raw = data
+        msg._body_start = end - len(rest)
+        if len(rest) == 0 and end > 0:
+            msg._raw_headers = list(parsed._headers)
+            msg._header_end = (end if match is None else match.start() + 1)
+        return msg
+
+    @property
+    def _payload(self):
+        # The email package accesses the payload directly in many places, so
+        # this is where the body gets parsed.
+        if self.__dict__['_raw'] is not None:
+            parsed = email.message_from_bytes(self._raw, Message)
+            for name in ('preamble', 'epilogue'):
+                if name in parsed.__dict__:
+                    self.__dict__[name] = parsed.__dict__[name]
+            self.__dict__['defects'] = parsed.defects
+            self._payload = parsed._payload
+        return self.__dict__['_payload']
+
+    @_payload.setter
+    def _payload(self, payload):
+        self.__dict__['_raw'] = None
+        self.__dict__['_payload'] = payload
+
+    @property
+    def raw_body(self):
+        """The unparsed body, as bytes, or None if it has been parsed."""
+        if self.__dict__['_raw'] is None:
+            return None
+        return self._raw[self._body_start:]
+
+    def unparsed_bytes(self):
+        """Return the message's bytes without parsing the body.
+
+        The raw header block is reused if headers were only added to the
+        message, so only the new ones have to be generated.
+
+        :return: The message, or None if the body has been parsed.
+        :rtype: bytes
+        """
+        if self.__dict__['_raw'] is None:
+            return None
+        headers = self._headers
+        count = len(self._raw_headers)
+        if (self._header_end is not None and
+                headers[:count] == self._raw_headers):
+            parts = [self._raw[:self._header_end]]
+            headers = headers[count:]
+            separator = self._raw[self._header_end:self._body_start]
+        else:
+            parts = []
+            separator = b'\n'
+        policy = self.policy.clone(max_line_length=0)
+        parts.extend(policy.fold_binary(name, value)
+                     for name, value in headers)
+        parts.append(separator)
+        parts.append(self.raw_body)
+        return b''.join(parts)
+
+    def _flatten(self):
+        data = self.unparsed_bytes()
+        if data is None:
+            return super(LazyMessage, self)._flatten()
+        return data
+
+
+
+def _flattened_state(msg):
+    """Return everything the flattened message depends on.
+
+    Any change to a header or payload of the message or its subparts
+    changes the returned value.  Unchanged strings and subparts are the very
+    same objects, so comparing the values is much cheaper than flattening
+    the message again.
+    """
+    state = []
+    parts = [msg]
+    while parts:
+        part = parts.pop()
+        values = vars(part)
+        # Don't parse a lazy body to look at it.
+        payload = values.get('_payload')
+        state.append((
+            part, tuple(part._headers), payload, values.get('_raw'),
+            values.get('_unixfrom'), values.get('_charset'),
+            values.get('_default_type'), values.get('policy'),
+            values.get('preamble'), values.get('epilogue')))
+        if isinstance(payload, list):
+            state.append(tuple(payload))
+            parts.extend(payload)
+    return state
+
+
 
 class MultipartDigestMessage(MIMEMultipart, Message):
     """Mix-in class for MIME digest messages."""
@@ -168,7 +355,9 @@ class UserNotification(Message):
 
         This function also accepts arbitrary keyword arguments.  The key/value
         pairs for **kws is added to the metadata dictionary associated with
-        the enqueued message.
+        the enqueued message.  Unless a `priority` is given, the message is
+        enqueued in the high priority lane, so that it isn't held up behind
+        list traffic.
         """
         # Since we're crafting the message from whole cloth, let's make sure
         # this message has a Message-ID.
@@ -192,6 +381,7 @@ class UserNotification(Message):
             recipients=self.recipients,
             nodecorate=True,
             reduced_list_headers=True,
+            priority='high',
             )
         if mlist is not None:
             enqueue_kws['listid'] = mlist.list_id
@@ -222,10 +412,13 @@ class OwnerNotification(UserNotification):
         # Not imported at module scope to avoid import loop
         virginq = config.switchboards['virgin']
         # The message metadata better have a `recip' attribute
-        virginq.enqueue(self,
-                        listid=mlist.list_id,
-                        recipients=self.recipients,
-                        nodecorate=True,
-                        reduced_list_headers=True,
-                        envsender=self._sender,
-                        **_kws)
+        enqueue_kws = dict(
+            listid=mlist.list_id,
+            recipients=self.recipients,
+            nodecorate=True,
+            reduced_list_headers=True,
+            envsender=self._sender,
+            priority='high',
+            )
+        enqueue_kws.update(_kws)
+        virginq.enqueue(self, **enqueue_kws)
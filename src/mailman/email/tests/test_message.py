@@ -18,18 +18,25 @@
 """Test the message API."""
 
 __all__ = [
+    'TestFlattening',
+    'TestLazyMessage',
     'TestMessage',
     'TestMessageSubclass',
     ]
 
 
+import copy
+import pickle
 import unittest
 
+from email.mime.text import MIMEText
 from email.parser import FeedParser
 from mailman.app.lifecycle import create_list
-from mailman.email.message import Message, UserNotification
-from mailman.testing.helpers import get_queue_messages
+from mailman.email.message import LazyMessage, Message, UserNotification
+from mailman.testing.helpers import (
+    get_queue_messages, specialized_message_from_string as mfs)
 from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
 
 
 
@@ -88,3 +95,134 @@ Test content
         except TypeError as error:
             self.fail(error)
         self.assertEqual(filename, u'd\xe9jeuner.txt')
+
+
+
+
+class TestLazyMessage(unittest.TestCase):
+    def setUp(self):
+        self._raw = b"""\
+Message-ID: <blah@example.com>
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+Preamble.
+--BOUNDARY
+Content-Type: text/plain
+
+First part.
+--BOUNDARY--
+"""
+
+    def test_headers_only(self):
+        msg = LazyMessage.from_bytes(self._raw)
+        self.assertEqual(msg['message-id'], '<blah@example.com>')
+        self.assertEqual(msg.get_content_type(), 'multipart/mixed')
+        self.assertEqual(msg.raw_body, self._raw.split(b'\n\n', 1)[1])
+
+    def test_body_is_parsed_on_demand(self):
+        msg = LazyMessage.from_bytes(self._raw)
+        parts = msg.get_payload()
+        self.assertIsNone(msg.raw_body)
+        self.assertEqual(len(parts), 1)
+        self.assertEqual(parts[0].get_payload(), 'First part.')
+        self.assertEqual(msg.preamble, 'Preamble.')
+        self.assertEqual(msg.as_bytes(), self._raw)
+
+    def test_setting_the_payload(self):
+        msg = LazyMessage.from_bytes(self._raw)
+        msg.set_payload('Replaced.')
+        self.assertIsNone(msg.raw_body)
+        self.assertEqual(msg.get_payload(), 'Replaced.')
+
+    def test_unparsed_bytes(self):
+        msg = LazyMessage.from_bytes(self._raw)
+        self.assertEqual(msg.unparsed_bytes(), self._raw)
+        # Added headers are generated, the others are reused.
+        msg['X-Added'] = 'yes'
+        self.assertEqual(msg.unparsed_bytes(), self._raw.replace(
+            b'\n\n', b'\nX-Added: yes\n\n', 1))
+        # Changed headers are all generated.
+        del msg['message-id']
+        self.assertEqual(
+            msg.unparsed_bytes(),
+            b'Content-Type: multipart/mixed; boundary="BOUNDARY"\n'
+            b'X-Added: yes\n\n' + msg.raw_body)
+        msg.get_payload()
+        self.assertIsNone(msg.unparsed_bytes())
+
+    def test_flattened(self):
+        # Flattening a lazy message doesn't parse its body.
+        msg = LazyMessage.from_bytes(self._raw)
+        self.assertEqual(msg.flattened(), self._raw)
+        self.assertIsNotNone(msg.raw_body)
+
+
+
+
+class TestFlattening(unittest.TestCase):
+    """Test the cache of the flattened message."""
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Subject: A very long subject which goes on and on and on and on and on and on
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+First part.
+--BOUNDARY--
+""")
+
+    def test_flattened(self):
+        # Long headers are not rewrapped.
+        self.assertEqual(self._msg.flattened(),
+                         self._msg.as_string().encode('ascii'))
+
+    def test_flattened_once(self):
+        with patch.object(Message, '_flatten',
+                          side_effect=Message._flatten,
+                          autospec=True) as flatten:
+            first = self._msg.flattened()
+            second = self._msg.flattened()
+        self.assertIs(first, second)
+        self.assertEqual(flatten.call_count, 1)
+
+    def test_generated_boundary(self):
+        # Flattening a multipart without a boundary gives it one, which
+        # doesn't count as a change.
+        msg = Message()
+        msg.set_type('multipart/mixed')
+        msg.set_payload([])
+        msg.attach(MIMEText('First part.'))
+        self.assertIs(msg.flattened(), msg.flattened())
+        self.assertIsNotNone(msg.get_boundary())
+
+    def test_header_changes(self):
+        self._msg.flattened()
+        self._msg['X-Added'] = 'yes'
+        self.assertIn(b'X-Added: yes\n', self._msg.flattened())
+        self._msg.replace_header('x-added', 'no')
+        self.assertIn(b'X-Added: no\n', self._msg.flattened())
+        del self._msg['x-added']
+        self.assertNotIn(b'X-Added', self._msg.flattened())
+
+    def test_payload_changes(self):
+        self._msg.flattened()
+        part = self._msg.get_payload(0)
+        part.set_payload('Changed part.')
+        self.assertIn(b'Changed part.', self._msg.flattened())
+        part['X-Part'] = 'yes'
+        self.assertIn(b'X-Part: yes\n', self._msg.flattened())
+        self._msg.attach(MIMEText('Second part.'))
+        self.assertIn(b'Second part.', self._msg.flattened())
+        self._msg.set_boundary('CHANGED')
+        self.assertIn(b'--CHANGED--', self._msg.flattened())
+
+    def test_not_pickled(self):
+        self._msg.flattened()
+        self.assertNotIn('_flattened', pickle.loads(pickle.dumps(
+            self._msg)).__dict__)
+        self.assertNotIn('_flattened', copy.deepcopy(self._msg).__dict__)
@@ -21,6 +21,7 @@ __all__ = [
     'Decorate',
     'decorate',
     'decorate_template',
+    'member_substitutions',
     ]
 
 
@@ -42,11 +43,15 @@ log = logging.getLogger('mailman.error')
 
 
 
-def process(mlist, msg, msgdata):
-    """Decorate the message with headers and footers."""
-    # Digests and Mailman-craft messages should not get additional headers.
-    if msgdata.get('isdigest') or msgdata.get('nodecorate'):
-        return
+def member_substitutions(msgdata):
+    """Return the personalized substitutions for the recipient.
+
+    :param msgdata: The message metadata, with the recipient and the
+        recipient's membership, if any.
+    :type msgdata: dictionary
+    :return: The substitutions for the decoration templates.
+    :rtype: dictionary
+    """
     d = {}
     member = msgdata.get('member')
     if member is not None:
@@ -59,6 +64,16 @@ def process(mlist, msg, msgdata):
                           if member.user.display_name
                           else member.address.original_email)
         d['user_optionsurl'] = member.options_url
+    return d
+
+
+
+def process(mlist, msg, msgdata):
+    """Decorate the message with headers and footers."""
+    # Digests and Mailman-craft messages should not get additional headers.
+    if msgdata.get('isdigest') or msgdata.get('nodecorate'):
+        return
+    d = member_substitutions(msgdata)
     # These strings are descriptive for the log file and shouldn't be i18n'd
     d.update(msgdata.get('decoration-data', {}))
     try:
@@ -30,6 +30,8 @@ __all__ = [
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.interfaces.handler import IHandler
+from mailman.mta.shards import split_recipients
+from uuid import uuid4
 from zope.interface import implementer
 
 
@@ -43,4 +45,20 @@ class ToOutgoing:
 
     def process(self, mlist, msg, msgdata):
         """See `IHandler`."""
-        config.switchboards['out'].enqueue(msg, msgdata, listid=mlist.list_id)
+        outq = config.switchboards['out']
+        recipients = msgdata.get('recipients')
+        count = int(config.mta.recipient_shards)
+        if (count > 1 and recipients and
+                len(recipients) >= int(config.mta.shard_min_recipients)):
+            # Split the recipients into shards which different outgoing
+            # runners deliver in parallel.  They share the unique id of the
+            # posting, by which their deliveries are logged together.
+            posting = uuid4().hex
+            parts = split_recipients(recipients, count)
+            shards = [
+                dict(recipients=part, shard=(index, len(parts)),
+                     posting=posting)
+                for index, part in enumerate(parts)]
+            outq.enqueue_shards(msg, shards, msgdata, listid=mlist.list_id)
+        else:
+            outq.enqueue(msg, msgdata, listid=mlist.list_id)
@@ -18,6 +18,7 @@
 """Interface for list storage, deleting, and finding."""
 
 __all__ = [
+    'IListIndex',
     'IListManager',
     'ListAlreadyExistsError',
     'ListCreatedEvent',
@@ -148,3 +149,49 @@ class IListManager(Interface):
     name_components = Attribute(
         """An iterator over the 2-tuple of (list_name, mail_host) for all
         mailing lists managed by this list manager.""")
+
+
+
+class IListIndex(Interface):
+    """A cached, in-process index of the ids of all mailing lists.
+
+    Hot paths such as the LMTP runner must decide for every recipient whether
+    it names a mailing list.  The index answers this without a database query
+    per lookup.  It is seeded from the database, updated by the list creation
+    and deletion events, and reloaded when another process changed the set of
+    mailing lists.
+    """
+
+    def exists(list_id):
+        """Return whether the mailing list exists.
+
+        :param list_id: The list id of the mailing list,
+            e.g. `mylist.example.com`.
+        :type list_id: str
+        :return: True if the mailing list exists.
+        :rtype: bool
+        """
+
+    def has_name(fqdn_listname):
+        """Return whether the mailing list exists.
+
+        :param fqdn_listname: The fully qualified name of the mailing list,
+            e.g. `mylist@example.com`.
+        :type fqdn_listname: str
+        :return: True if the mailing list exists.
+        :rtype: bool
+        """
+
+    def load():
+        """Seed the index from the database.
+
+        This is done implicitly by the first lookup, but long running
+        processes may call it at start up.
+        """
+
+    def invalidate():
+        """Force every process to reload its index on the next lookup.
+
+        Use this when the mailing lists changed without the list creation and
+        deletion events being notified, e.g. when the database is reset.
+        """
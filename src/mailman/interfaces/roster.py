@@ -68,6 +68,20 @@ class IRoster(Interface):
         :rtype: `IMember` or None
         """
 
+    def get_members(emails):
+        """Get the members for many addresses at once.
+
+        This is like calling ``get_member()`` for each email address, but
+        the members are looked up in a few queries, along with their
+        addresses, users and preferences.
+
+        :param emails: The email addresses to search for.
+        :type emails: iterable of strings
+        :return: The members found, keyed by their email address.  Email
+            addresses which are not subscribed are missing.
+        :rtype: dictionary
+        """
+
     def get_memberships(email):
         """Get the memberships for the given address.
 
@@ -80,6 +80,16 @@ class IRunner(Interface):
         :rtype: int
         """
 
+    def _next_files():
+        """Return the queue files to process in this iteration.
+
+        Can be overridden by subclasses, e.g. to leave files which are not
+        yet due in the queue.
+
+        :return: The base names of the files, in the order to process them.
+        :rtype: list of str
+        """
+
     def _process_one_file(msg, msgdata):
         """Process one queue file.
 
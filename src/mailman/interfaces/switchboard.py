@@ -49,6 +49,19 @@ class ISwitchboard(Interface):
         The base name of the message file is returned.
         """
 
+    def enqueue_shards(_msg, shards, _metadata=None, **_kws):
+        """Store the message once for each of its shards.
+
+        Every shard is a dictionary of metadata, typically with a part of the
+        message's recipients, which is added to a copy of the given metadata
+        and takes precedence over it.  The keyword arguments take precedence
+        over both.  The shards are spread evenly over the slices of the
+        queue, and share a single copy of the message where the switchboard
+        supports it.
+
+        The base names of the shards' message files are returned.
+        """
+
     def dequeue(filebase):
         """Return the message and metadata contained in the named file.
 
@@ -67,6 +80,34 @@ class ISwitchboard(Interface):
         a preservation file instead of being unlinked.
         """
 
+    def requeue(filebase):
+        """Put a dequeued message file back into the queue.
+
+        This is the opposite of .dequeue(); the backup file for filebase is
+        renamed back to a message file, so that it will be dequeued again.
+        """
+
+    def sync():
+        """Sync the files written since the last sync to disk.
+
+        This only does something if the switchboard's durability is
+        `batched`; with `strict` durability every file is synced as it is
+        written, and with `relaxed` durability files are never synced.
+        """
+
+    def wait(timeout=None):
+        """Block until a new message file may be available.
+
+        This returns as soon as a new .pck file lands in the queue directory,
+        or when the timeout expires, whichever comes first.  Files which
+        arrived since the previous call are reported immediately.  Spurious
+        wakeups are possible, so callers must still check `files`.
+
+        timeout is the maximum number of seconds to wait, or None to wait
+        forever.  Returns True if a new file may be available and False if
+        the timeout expired.
+        """
+
     files = Attribute(
         """An iterator over all the .pck files in the queue directory.
 
@@ -81,6 +122,43 @@ class ISwitchboard(Interface):
         returned.
         """
 
+    def next_files(count=None):
+        """Return the oldest .pck files in the queue, in FIFO order.
+
+        Files in the high and low priority lanes are returned as if they had
+        been enqueued one priority head start earlier or later, respectively.
+
+        Unlike `files`, this does not list the queue directory every time.
+        Instead, an in-memory index of the queue is kept up to date with the
+        files this switchboard enqueues and dequeues, and with the changes
+        reported by the directory watcher.  The directory is only rescanned
+        when the watcher cannot say what changed.
+
+        count is the maximum number of file bases to return, or None to
+        return all of them.
+        """
+
+    def backlog():
+        """Return the size of the queue and when its head was enqueued.
+
+        Like `next_files()`, this does not list the queue directory every
+        time, so it is cheap enough to call for every incoming message.
+        Like `files`, only the files in this switchboard's slice of the queue
+        are counted.
+
+        Returned is a 2-tuple of the number of .pck files and the time the
+        file next in line was enqueued, in seconds since the epoch.  The
+        time is None if the queue is empty.
+        """
+
+    def lane_depths():
+        """Return the number of .pck files in each priority lane.
+
+        Like `files`, this only counts the files in this switchboard's slice
+        of the queue.  Returned is a dictionary mapping the names of all
+        lanes to their counts.
+        """
+
     def recover_backup_files():
         """Move all backup files to active message files.
 
@@ -75,6 +75,20 @@ class IUserManager(Interface):
         :rtype: `IUser`.
         """
 
+    def get_users(emails):
+        """Get the users that control many email addresses at once.
+
+        This is like calling ``get_user()`` for each email address, but the
+        users are looked up in a single query per batch of addresses, along
+        with their preferences.
+
+        :param emails: The email addresses to look up.
+        :type emails: iterable of str
+        :return: The users found, keyed by the email addresses as given.
+            Email addresses which no user controls are missing.
+        :rtype: dict
+        """
+
     def get_user_by_id(user_id):
         """Get the user associated with the given id.
 
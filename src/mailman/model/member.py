@@ -63,6 +63,10 @@ class Member(Model):
     preferences = relationship('Preferences')
     user_id = Column(Integer, ForeignKey('user.id'))
     _user = relationship('User')
+    _mailing_list = relationship(
+        'MailingList',
+        primaryjoin='foreign(Member.list_id) == MailingList._list_id',
+        uselist=False, viewonly=True, load_on_pending=True)
 
     def __init__(self, role, list_id, subscriber):
         self._member_id = uid_factory.new_uid()
@@ -96,8 +100,7 @@ class Member(Model):
     @property
     def mailing_list(self):
         """See `IMember`."""
-        list_manager = getUtility(IListManager)
-        return list_manager.get_by_list_id(self.list_id)
+        return self._mailing_list
 
     @property
     def member_id(self):
@@ -133,7 +136,7 @@ class Member(Model):
         """See `IMember`."""
         return (self._user
                 if self._address is None
-                else getUtility(IUserManager).get_user(self._address.email))
+                else self._address.user)
 
     @property
     def subscriber(self):
@@ -0,0 +1,64 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The database switchboard's queue entries."""
+
+__all__ = [
+    'queue_bodies',
+    'queue_entries',
+    ]
+
+
+from mailman.database.model import Model
+from sqlalchemy import (
+    Boolean, Column, Float, Index, Integer, LargeBinary, Table, Unicode)
+
+
+# There are no model classes, since entries are only ever handled in bulk by
+# the switchboard.  The tables are used in Mailman's database, except with
+# SQLite, where each queue has a database of its own.
+queue_entries = Table(
+    'queueentry', Model.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('queue', Unicode, nullable=False),
+    Column('filebase', Unicode, nullable=False, unique=True),
+    # The key by which entries are processed in FIFO order; see
+    # `mailman.core.switchboard.sort_key()`.
+    Column('received', Float, nullable=False),
+    Column('bucket', Integer, nullable=False),
+    Column('message', LargeBinary, nullable=False),
+    Column('metadata', LargeBinary, nullable=False),
+    Column('owner', Unicode),
+    Column('lease_expires', Float),
+    Column('dequeued', Boolean, nullable=False, default=False),
+    Column('bak_count', Integer, nullable=False, default=0),
+    Index('ix_queueentry_queue_received', 'queue', 'received'),
+    )
+
+
+
+# The message shared by all the shards of a message is stored only once.  The
+# shards' entries hold the key of their message instead, and the message is
+# deleted when the last of its shards is finished.
+queue_bodies = Table(
+    'queuebody', Model.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('key', Unicode, nullable=False, unique=True),
+    Column('message', LargeBinary, nullable=False),
+    # The number of shards which are not finished yet.
+    Column('shards', Integer, nullable=False),
+    )
@@ -34,12 +34,14 @@ __all__ = [
     ]
 
 
+from mailman.database.model import in_batches
 from mailman.database.transaction import dbconnection
 from mailman.interfaces.member import DeliveryMode, MemberRole
 from mailman.interfaces.roster import IRoster
 from mailman.model.address import Address
 from mailman.model.member import Member
 from sqlalchemy import and_, or_
+from sqlalchemy.orm import contains_eager, joinedload
 from zope.interface import implementer
 
 
@@ -113,7 +115,8 @@ class AbstractRoster:
             Member.list_id == self._mlist.list_id,
             Member.role == self.role,
             Address.email==email,
-            Member.user_id == User.id)
+            Member.user_id == User.id,
+            User._preferred_address_id == Address.id)
         return members_a.union(members_u).all()
 
     def get_member(self, email):
@@ -132,6 +135,48 @@ class AbstractRoster:
                 if memberships[0]._address is not None
                 else memberships[1])
 
+    @dbconnection
+    def get_members(self, store, emails):
+        """See ``IRoster``."""
+        # Avoid circular imports.
+        from mailman.model.user import User
+        # Load everything a member's properties and preferences need along
+        # with the members, so they don't query the database again.
+        options = (
+            joinedload(Member.preferences),
+            joinedload(Member._mailing_list),
+            )
+        members = {}
+        for batch in in_batches(set(emails)):
+            # Here are the members subscribed with their preferred address.
+            # Explicit address subscriptions take precedence over them.
+            members_u = store.query(Member).join(Member._user).join(
+                User._preferred_address).filter(
+                    Member.list_id == self._mlist.list_id,
+                    Member.role == self.role,
+                    Address.email.in_(batch)).options(
+                        contains_eager(Member._user).joinedload(
+                            User.preferences),
+                        contains_eager(Member._user).contains_eager(
+                            User._preferred_address).joinedload(
+                                Address.preferences),
+                        *options)
+            for member in members_u:
+                members[member._user.preferred_address.email] = member
+            # Here are the members subscribed with an explicit address.
+            members_a = store.query(Member).join(Member._address).filter(
+                Member.list_id == self._mlist.list_id,
+                Member.role == self.role,
+                Address.email.in_(batch)).options(
+                    contains_eager(Member._address).joinedload(
+                        Address.preferences),
+                    contains_eager(Member._address).joinedload(
+                        Address.user).joinedload(User.preferences),
+                    *options)
+            for member in members_a:
+                members[member._address.email] = member
+        return members
+
     def get_memberships(self, email):
         """See ``IRoster``."""
         memberships = self._get_all_memberships(email)
@@ -203,6 +248,15 @@ class AdministratorRoster(AbstractRoster):
             raise AssertionError(
                 'Too many matching member results: {0}'.format(results))
 
+    def get_members(self, emails):
+        """See `IRoster`."""
+        members = {}
+        for email in set(emails):
+            member = self.get_member(email)
+            if member is not None:
+                members[email] = member
+        return members
+
 
 
 class DeliveryMemberRoster(AbstractRoster):
@@ -328,6 +382,15 @@ class Memberships:
                 'Too many matching member results: {0}'.format(
                     results.count()))
 
+    def get_members(self, emails):
+        """See `IRoster`."""
+        members = {}
+        for email in set(emails):
+            member = self.get_member(email)
+            if member is not None:
+                members[email] = member
+        return members
+
     @dbconnection
     def get_memberships(self, store, address):
         """See `IRoster`."""
@@ -170,6 +170,32 @@ class TestMembershipsRoster(unittest.TestCase):
             [member.address.email for member in memberships],
             ['anne@example.com'])
 
+    def test_get_members(self):
+        # Anne is subscribed as a user to one list, and with her explicit
+        # address to the other one.  Bart is not subscribed.
+        user_manager = getUtility(IUserManager)
+        user_manager.create_address('bart@example.com')
+        self._ant.subscribe(self._anne)
+        self._bee.subscribe(self._anne.preferred_address)
+        for mlist in (self._ant, self._bee):
+            members = mlist.members.get_members(
+                ['anne@example.com', 'bart@example.com', 'cris@example.com'])
+            self.assertEqual(list(members), ['anne@example.com'])
+            self.assertEqual(members['anne@example.com'],
+                             mlist.members.get_member('anne@example.com'))
+            self.assertEqual(members['anne@example.com'].user, self._anne)
+
+    def test_get_members_explicit_address(self):
+        # Like get_member(), get_members() returns the explicit address
+        # membership of an address which is subscribed twice.
+        self._ant.subscribe(self._anne)
+        self._ant.subscribe(self._anne.preferred_address)
+        members = self._ant.members.get_members(['anne@example.com'])
+        member = members['anne@example.com']
+        self.assertEqual(member.subscriber, self._anne.preferred_address)
+        self.assertEqual(member,
+                         self._ant.members.get_member('anne@example.com'))
+
     def test_subscribed_as_user_and_address(self):
         # Anne subscribes to a mailing list twice, once as a user and once
         # with an explicit address.  She has two memberships.
@@ -82,6 +82,20 @@ class TestUserManager(unittest.TestCase):
         other_user = self._usermanager.make_user('anne@example.com')
         self.assertIs(user, other_user)
 
+    def test_get_users(self):
+        # Anne and Bart are users, Cris only has an address and Dave is not
+        # known at all.
+        anne = self._usermanager.make_user('anne@example.com')
+        bart = self._usermanager.make_user('bart@example.com')
+        self._usermanager.create_address('cris@example.com')
+        users = self._usermanager.get_users([
+            'anne@example.com', 'Bart@example.com', 'cris@example.com',
+            'dave@example.com'])
+        self.assertEqual(users, {
+            'anne@example.com': anne,
+            'Bart@example.com': bart,
+            })
+
     def test_get_user_by_id(self):
         original = self._usermanager.make_user('anne@example.com')
         copy = self._usermanager.get_user_by_id(original.user_id)
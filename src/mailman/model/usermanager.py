@@ -22,6 +22,7 @@ __all__ = [
     ]
 
 
+from mailman.database.model import in_batches
 from mailman.database.transaction import dbconnection
 from mailman.interfaces.address import ExistingAddressError
 from mailman.interfaces.usermanager import IUserManager
@@ -29,6 +30,7 @@ from mailman.model.address import Address
 from mailman.model.member import Member
 from mailman.model.preferences import Preferences
 from mailman.model.user import User
+from sqlalchemy.orm import joinedload
 from zope.interface import implementer
 
 
@@ -80,6 +82,22 @@ class UserManager:
             return None
         return addresses.one().user
 
+    @dbconnection
+    def get_users(self, store, emails):
+        """See `IUserManager`."""
+        emails = set(emails)
+        users = {}
+        for batch in in_batches(set(email.lower() for email in emails)):
+            addresses = store.query(Address).filter(
+                Address.email.in_(batch)).options(
+                    joinedload(Address.user).joinedload(User.preferences))
+            for address in addresses:
+                if address.user is not None:
+                    users[address.email] = address.user
+        return dict((email, users[email.lower()])
+                    for email in emails
+                    if email.lower() in users)
+
     @dbconnection
     def get_user_by_id(self, store, user_id):
         """See `IUserManager`."""
@@ -0,0 +1,140 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Back pressure from the queues on incoming mail."""
+
+__all__ = [
+    'BackPressure',
+    ]
+
+
+import time
+
+from lazr.config import as_timedelta
+from mailman.config import config
+
+
+
+
+class BackPressure:
+    """Whether the queues are too backed up to accept more incoming mail.
+
+    Once any of the watched queues holds the high watermark of files, or its
+    head has waited for the high watermark age, incoming mail is rejected
+    until all the queues are back down to the low watermarks.  The gap
+    between the watermarks keeps the state from flapping.
+    """
+
+    def __init__(self, switchboards, high, low, high_age=0, low_age=0,
+                 interval=1):
+        """Create the back pressure of the queues.
+
+        :param switchboards: The switchboards of the watched queues.
+        :type switchboards: sequence of `ISwitchboard`
+        :param high: Rejecting starts at this many files in any queue, or 0
+            to disable the check.
+        :type high: int
+        :param low: Rejecting stops at this many files in all queues.
+        :type low: int
+        :param high_age: Rejecting starts when any queue's head has waited
+            for this many seconds, or 0 to disable the check.
+        :type high_age: float
+        :param low_age: Rejecting stops when all the queues' heads have waited
+            for at most this many seconds.
+        :type low_age: float
+        :param interval: The queues are checked at most once every this many
+            seconds.
+        :type interval: float
+        """
+        self.switchboards = switchboards
+        self.high = high
+        self.low = min(low, high)
+        self.high_age = high_age
+        self.low_age = min(low_age, high_age)
+        self.interval = interval
+        # The reason mail is rejected, i.e. `depth` or `age`, or None.
+        self.rejecting = None
+        self._checked = None
+        self._backlogs = {}
+
+    @classmethod
+    def from_config(cls):
+        """Create the back pressure from the `[mta]` configuration.
+
+        :return: The back pressure, or None if both of its checks are
+            disabled.
+        :rtype: `BackPressure`
+        """
+        high = int(config.mta.lmtp_high_watermark)
+        high_age = as_timedelta(config.mta.lmtp_high_age).total_seconds()
+        if high == 0 and high_age == 0:
+            return None
+        switchboards = [config.switchboards[name] for name in
+                        config.mta.lmtp_backpressure_queues.split()]
+        return cls(switchboards, high,
+                   int(config.mta.lmtp_low_watermark),
+                   high_age,
+                   as_timedelta(config.mta.lmtp_low_age).total_seconds(),
+                   as_timedelta(
+                       config.mta.lmtp_backpressure_interval).total_seconds())
+
+    def check(self):
+        """Check the queues, unless they were checked very recently.
+
+        :return: The reason incoming mail must be rejected, i.e. `depth` or
+            `age`, or None if it is accepted.
+        :rtype: str or None
+        """
+        right_now = time.time()
+        if (self._checked is not None and
+                right_now - self._checked < self.interval):
+            return self.rejecting
+        self._checked = right_now
+        depth = age = 0
+        for switchboard in self.switchboards:
+            count, when = switchboard.backlog()
+            waited = (0 if when is None else max(right_now - when, 0))
+            self._backlogs[switchboard.name] = (count, waited)
+            depth = max(depth, count)
+            age = max(age, waited)
+        over_depth = (self.high > 0 and depth >= self.high)
+        over_age = (self.high_age > 0 and age >= self.high_age)
+        if over_depth:
+            self.rejecting = 'depth'
+        elif over_age:
+            self.rejecting = 'age'
+        elif self.rejecting is not None:
+            # Keep rejecting until the queues are down to the low watermarks.
+            if self.high > 0 and depth > self.low:
+                self.rejecting = 'depth'
+            elif self.high_age > 0 and age > self.low_age:
+                self.rejecting = 'age'
+            else:
+                self.rejecting = None
+        return self.rejecting
+
+    def states(self):
+        """Return the state of the watched queues.
+
+        :return: The number of files in each queue, how long its head has
+            waited in seconds, and whether incoming mail is rejected, ordered
+            by queue.
+        :rtype: list of dictionaries
+        """
+        return [dict(queue=name, depth=count, age=round(waited, 3),
+                     rejecting=self.rejecting is not None)
+                for name, (count, waited) in sorted(self._backlogs.items())]
@@ -23,19 +23,35 @@ __all__ = [
     ]
 
 
+import re
 import copy
+import time
+import uuid
 import socket
 import logging
 import smtplib
 
 from mailman.config import config
+from mailman.email.message import LazyMessage
 from mailman.interfaces.mta import IMailTransportAgentDelivery
-from mailman.mta.connection import Connection
+from mailman.interfaces.usermanager import IUserManager
+from mailman.mta.connection import Connection, ConnectionPool
+from mailman.mta.smarthosts import Smarthosts
+from mailman.mta.throttle import DeliveryThrottle
+from zope.component import getUtility
 from zope.interface import implementer
 
 
+CRLF = '\r\n'
+EMPTYBYTES = b''
 log = logging.getLogger('mailman.smtp')
 
+# Only values which come out the same wherever they are spliced into a
+# message can be filled into template slots.  Values with non-ASCII
+# characters or line breaks would need encoding or folding, and decorations
+# strip the spaces at the end of lines.
+SPLICEABLE = re.compile(r'[\x21-\x7e]([\x20-\x7e]*[\x21-\x7e])?$')
+
 
 
 @implementer(IMailTransportAgentDelivery)
@@ -43,13 +59,23 @@ class BaseDelivery:
     """Base delivery class."""
 
     def __init__(self):
-        """Create a basic deliverer."""
+        """Create a basic deliverer.
+
+        The deliverer uses the connection pool shared in this thread if there
+        is one, and otherwise opens a connection of its own.  The outcome of
+        every SMTP session is recorded by the delivery throttle shared in
+        this thread, if there is one.
+        """
+        self._throttle = DeliveryThrottle.current()
+        self._connection = ConnectionPool.current()
+        if self._connection is not None:
+            return
         username = (config.mta.smtp_user if config.mta.smtp_user else None)
         password = (config.mta.smtp_pass if config.mta.smtp_pass else None)
         self._connection = Connection(
             config.mta.smtp_host, int(config.mta.smtp_port),
             int(config.mta.max_sessions_per_connection),
-            username, password)
+            username, password, Smarthosts.from_config())
 
     def _deliver_to_recipients(self, mlist, msg, msgdata, recipients):
         """Low-level delivery to a set of recipients.
@@ -68,9 +94,10 @@ class BaseDelivery:
         # Do the actual sending.
         sender = self._get_sender(mlist, msg, msgdata)
         message_id = msg['message-id']
+        start = time.time()
         try:
             refused = self._connection.sendmail(
-                sender, recipients, msg.as_string())
+                sender, recipients, msg.flattened(CRLF))
         except smtplib.SMTPRecipientsRefused as error:
             log.error('%s recipients refused: %s', message_id, error)
             refused = error.recipients
@@ -91,6 +118,8 @@ class BaseDelivery:
                 # recipient -> (code, error)
                 (recipient, (444, error))
                 for recipient in recipients)
+        if self._throttle is not None:
+            self._throttle.record(recipients, refused, time.time() - start)
         return refused
 
     def _get_sender(self, mlist, msg, msgdata):
@@ -130,12 +159,26 @@ class IndividualDelivery(BaseDelivery):
     The core concept here is that for each recipient, the deliver() method
     iterates over the list of registered callbacks, each of which have a
     chance to modify the message before final delivery.
+
+    Most callbacks only fill in a few values for each recipient, such as the
+    recipient's address in the To header.  Such callbacks can also be
+    registered in `slots`, mapping the callback to a pair of functions.  The
+    first one is called as `values(mlist, msgdata)` and returns a dictionary
+    of the recipient's values, all strings.  The second one is called as
+    `fill(mlist, msg, msgdata, values)` and does the callback's work with
+    the given values.  When all callbacks are registered there, the message
+    is flattened once into a template with slots for those values, and
+    every recipient's message is spliced together from it.  Recipients
+    whose values can't be spliced, and messages which don't come out the
+    same with different values, e.g. because the callbacks encode them or
+    change the MIME structure, are still crafted one by one.
     """
 
     def __init__(self):
         """See `BaseDelivery`."""
         super(IndividualDelivery, self).__init__()
         self.callbacks = []
+        self.slots = {}
 
     def deliver(self, mlist, msg, msgdata):
         """See `IMailTransportAgentDelivery`.
@@ -146,25 +189,155 @@ class IndividualDelivery(BaseDelivery):
         """
         refused = {}
         recipients = msgdata.get('recipients', set())
+        # The templates for this message, keyed by the names of the values
+        # the recipients have, or None if the callbacks can't be templated.
+        templates = ({}
+                     if all(callback in self.slots
+                            for callback in self.callbacks)
+                     else None)
+        # Look up the recipients' memberships and users all at once, along
+        # with their preferences, instead of querying the database for every
+        # recipient.
+        members = mlist.members.get_members(recipients)
+        users = getUtility(IUserManager).get_users(recipients)
         for recipient in recipients:
             log.debug('IndividualDelivery to: %s', recipient)
-            # Make a copy of the original messages and operator on it, since
-            # we're going to munge it repeatedly for each recipient.
-            message_copy = copy.deepcopy(msg)
             msgdata_copy = msgdata.copy()
             # Squirrel the current recipient away in the message metadata.
             # That way the subclass's _get_sender() override can encode the
             # recipient address in the sender, e.g. for VERP.
             msgdata_copy['recipient'] = recipient
-            # See if the recipient is a member of the mailing list, and if so,
-            # squirrel this information away for use by other modules, such as
-            # the header/footer decorator.  XXX 2012-03-05 this is probably
-            # highly inefficient on the database.
-            member = mlist.members.get_member(recipient)
-            msgdata_copy['member'] = member
-            for callback in self.callbacks:
-                callback(mlist, message_copy, msgdata_copy)
+            # If the recipient is a member of the mailing list, squirrel this
+            # information away for use by other modules, such as the
+            # header/footer decorator.  The same goes for the user controlling
+            # the recipient's address, which is None for unknown addresses.
+            msgdata_copy['member'] = members.get(recipient)
+            msgdata_copy['user'] = users.get(recipient)
+            message_copy = None
+            if templates is not None:
+                message_copy = self._splice(
+                    mlist, msg, msgdata_copy, templates)
+            if message_copy is None:
+                # Make a copy of the original messages and operator on it,
+                # since we're going to munge it repeatedly for each
+                # recipient.
+                message_copy = copy.deepcopy(msg)
+                for callback in self.callbacks:
+                    callback(mlist, message_copy, msgdata_copy)
             status = self._deliver_to_recipients(
                 mlist, message_copy, msgdata_copy, [recipient])
             refused.update(status)
         return refused
+
+    def _splice(self, mlist, msg, msgdata, templates):
+        """Splice the recipient's message together from a template.
+
+        :param mlist: The mailing list being delivered to.
+        :type mlist: `IMailingList`
+        :param msg: The original message being delivered.
+        :type msg: `Message`
+        :param msgdata: The message metadata for this recipient.
+        :type msgdata: dictionary
+        :param templates: The templates made so far for this message, which
+            gets the template for this recipient's values added if needed.
+        :type templates: dictionary
+        :return: The recipient's message, or None if it can't be spliced.
+        :rtype: `LazyMessage`
+        """
+        values = []
+        for callback in self.callbacks:
+            recipient_values = self.slots[callback][0](mlist, msgdata)
+            for value in recipient_values.values():
+                if not isinstance(value, str) or not SPLICEABLE.match(value):
+                    return None
+            values.append(recipient_values)
+        shape = tuple(tuple(sorted(names)) for names in values)
+        if shape not in templates:
+            templates[shape] = _Template.make(
+                self, mlist, msg, msgdata, shape)
+        template = templates[shape]
+        if template is None:
+            return None
+        return LazyMessage.from_bytes(template.render(values))
+
+
+
+class _Template:
+    """A flattened message with slots for each recipient's values."""
+
+    def __init__(self, parts):
+        # The parts are literal bytes and (callback index, value name) slots.
+        self._parts = parts
+
+    @classmethod
+    def make(cls, delivery, mlist, msg, msgdata, shape):
+        """Flatten the message with unique markers for the values.
+
+        The message is flattened twice, with markers of different lengths.
+        The template is only good if it renders the second message exactly
+        when filled in with the second set of markers, which proves the
+        values end up unchanged wherever they are spliced in.
+
+        :param delivery: The delivery filling in the values.
+        :type delivery: `IndividualDelivery`
+        :param mlist: The mailing list being delivered to.
+        :type mlist: `IMailingList`
+        :param msg: The original message being delivered.
+        :type msg: `Message`
+        :param msgdata: The message metadata for a recipient.
+        :type msgdata: dictionary
+        :param shape: The names of the values for each callback.
+        :type shape: tuple of tuples
+        :return: The template, or None if the values can't be spliced.
+        :rtype: `_Template`
+        """
+        token = uuid.uuid4().hex
+        flattened = []
+        for padding in ('', 'x' * 16):
+            markers = [
+                dict(('{0}s{1}v{2}{3}e'.format(token, index, count, padding),
+                      name)
+                     for count, name in enumerate(names))
+                for index, names in enumerate(shape)]
+            message = copy.deepcopy(msg)
+            data = msgdata.copy()
+            for callback, callback_markers in zip(delivery.callbacks, markers):
+                fill = delivery.slots[callback][1]
+                fill(mlist, message, data, dict(
+                    (name, marker)
+                    for marker, name in callback_markers.items()))
+            flattened.append((markers, message.flattened()))
+        (markers, data), (other_markers, other_data) = flattened
+        slots = {}
+        for index, callback_markers in enumerate(markers):
+            for marker, name in callback_markers.items():
+                slots[marker.encode('ascii')] = (index, name)
+        if len(slots) == 0:
+            parts = [data]
+        else:
+            pattern = re.compile(b'(' + b'|'.join(
+                re.escape(marker) for marker in slots) + b')')
+            parts = [(part if index % 2 == 0 else slots[part])
+                     for index, part in enumerate(pattern.split(data))]
+        template = cls(parts)
+        other_values = [
+            dict((name, marker)
+                 for marker, name in callback_markers.items())
+            for callback_markers in other_markers]
+        if template.render(other_values) != other_data:
+            log.debug('%s can not be templated', msg.get('message-id'))
+            return None
+        return template
+
+    def render(self, values):
+        """Fill in the values.
+
+        :param values: The values for each callback.
+        :type values: sequence of dictionaries
+        :return: The message.
+        :rtype: bytes
+        """
+        return EMPTYBYTES.join(
+            (part if isinstance(part, bytes)
+             else values[part[0]][part[1]].encode('ascii'))
+            for part in self._parts)
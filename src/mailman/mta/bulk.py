@@ -22,44 +22,53 @@ __all__ = [
     ]
 
 
-from mailman.mta.base import BaseDelivery
-
-
-# A mapping of top-level domains to bucket numbers.  The zeroth bucket is
-# reserved for everything else.  At one time, these were the most common
-# domains.
-CHUNKMAP = dict(
-    com=1,
-    net=2,
-    org=2,
-    edu=3,
-    us=3,
-    ca=3,
-    )
+from concurrent.futures import ThreadPoolExecutor
+from mailman.mta.base import BaseDelivery, CRLF
+from mailman.mta.connection import ConnectionPool
+from mailman.mta.destinations import Destinations
 
 
 
 class BulkDelivery(BaseDelivery):
     """Deliver messages to the MSA in as few sessions as possible."""
 
-    def __init__(self, max_recipients=None):
+    def __init__(self, max_recipients=None, max_threads=None,
+                 destinations=None):
         """See `BaseDelivery`.
 
         :param max_recipients: The maximum number of recipients per delivery
             chunk.  None, zero or less means to group all recipients into one
             big chunk.
         :type max_recipients: integer
+        :param max_threads: The maximum number of chunks to deliver at the
+            same time, each in its own thread and over its own connection.
+            None, zero or one means to deliver the chunks one after another.
+        :type max_threads: integer
+        :param destinations: How to group the recipients by destination,
+            and the destinations' limits.  None groups the recipients by
+            domain, without limits.
+        :type destinations: `Destinations`
         """
         super(BulkDelivery, self).__init__()
         self._max_recipients = (max_recipients
                                 if max_recipients is not None
                                 else 0)
+        self._max_threads = (max_threads
+                             if max_threads is not None
+                             else 0)
+        self._destinations = (destinations
+                              if destinations is not None
+                              else Destinations())
 
     def chunkify(self, recipients):
         """Split a set of recipients into chunks.
 
         The `max_recipients` argument given to the constructor specifies the
-        maximum number of recipients in each chunk.
+        maximum number of recipients in each chunk, and the `max_recipients`
+        limit of a destination the maximum number of its recipients in each
+        chunk.  The recipients of a destination are kept together in as few
+        chunks as possible, and destinations too small to fill a chunk share
+        chunks, largest first.
 
         :param recipients: The set of recipient email addresses
         :type recipients: sequence of email address strings
@@ -68,40 +77,114 @@ class BulkDelivery(BaseDelivery):
             contain fewer, and no packing is guaranteed.
         :rtype: list of sets of strings
         """
-        if self._max_recipients <= 0:
-            yield set(recipients)
-            return
-        # This algorithm was originally suggested by Chuq Von Rospach.  Start
-        # by splitting the recipient addresses into top-level domain buckets,
-        # using the "most common" domains.  Everything else ends up in the
-        # zeroth bucket.
-        by_bucket = {}
+        by_destination = {}
         for address in recipients:
-            localpart, at, domain = address.partition('@')
-            domain_parts = domain.split('.')
-            bucket_number = CHUNKMAP.get(domain_parts[-1], 0)
-            by_bucket.setdefault(bucket_number, set()).add(address)
-        # Fill chunks by sorting the tld values by length.
-        chunk = set()
-        for tld_chunk in sorted(by_bucket.values(), key=len, reverse=True):
-            while tld_chunk:
-                chunk.add(tld_chunk.pop())
-                if len(chunk) == self._max_recipients:
-                    yield chunk
-                    chunk = set()
-            # Every tld bucket starts a new chunk, but only if non-empty
-            if len(chunk) > 0:
-                yield chunk
-                chunk = set()
-        # Be sure to include the last chunk, but only if it's non-empty.
-        if len(chunk) > 0:
-            yield chunk
+            destination = self._destinations.destination(address)
+            by_destination.setdefault(destination, []).append(address)
+        # Split the destinations into pieces which fit into a chunk.
+        pieces = []
+        for destination, addresses in by_destination.items():
+            addresses.sort()
+            size = self._chunk_size(destination)
+            if size <= 0:
+                size = len(addresses)
+            for start in range(0, len(addresses), size):
+                pieces.append((destination, addresses[start:start + size]))
+        # Pack the pieces into chunks, largest first, putting each one into
+        # the first chunk with enough room which doesn't already contain
+        # some of the destination's recipients.
+        pieces.sort(key=lambda piece: (-len(piece[1]), piece[0]))
+        chunks = []
+        # Each chunk's recipients and destinations.
+        entries = []
+        # The chunks before this one have no room for pieces of this size.
+        size = first = None
+        for destination, addresses in pieces:
+            if len(addresses) != size:
+                size = len(addresses)
+                first = 0
+            for index in range(first, len(entries)):
+                chunk, destinations = entries[index]
+                if not self._fits(chunk, addresses):
+                    if index == first:
+                        first += 1
+                elif destination not in destinations:
+                    break
+            else:
+                chunk, destinations = set(), set()
+                chunks.append(chunk)
+                entries.append((chunk, destinations))
+            chunk.update(addresses)
+            destinations.add(destination)
+        return chunks
+
+    def _chunk_size(self, destination):
+        # The most recipients at the destination which fit into a chunk, or
+        # zero if there is no limit.
+        sizes = [size
+                 for size in (self._max_recipients,
+                              self._destinations.limits(
+                                  destination).max_recipients)
+                 if size > 0]
+        return (min(sizes) if sizes else 0)
+
+    def _fits(self, chunk, addresses):
+        # Whether the addresses fit into the chunk.
+        return (self._max_recipients <= 0 or
+                len(chunk) + len(addresses) <= self._max_recipients)
 
     def deliver(self, mlist, msg, msgdata):
         """See `IMailTransportAgentDelivery`."""
+        chunks = list(self.chunkify(msgdata.get('recipients', set())))
+        threads = min(self._max_threads, len(chunks))
+        if threads > 1:
+            results = self._deliver_in_parallel(
+                mlist, msg, msgdata, chunks, threads)
+        else:
+            results = (
+                self._deliver_chunk(mlist, msg, msgdata, recipients)
+                for recipients in chunks)
         refused = {}
-        for recipients in self.chunkify(msgdata.get('recipients', set())):
-            chunk_refused = self._deliver_to_recipients(
-                mlist, msg, msgdata, recipients)
+        for chunk_refused in results:
             refused.update(chunk_refused)
         return refused
+
+    def _deliver_chunk(self, mlist, msg, msgdata, recipients):
+        """Deliver a chunk once its destinations have a free session.
+
+        :return: The delivery failures of the chunk.
+        :rtype: dictionary
+        """
+        destinations = set(self._destinations.destination(recipient)
+                           for recipient in recipients)
+        with self._destinations.sessions(destinations):
+            return self._deliver_to_recipients(
+                mlist, msg, msgdata, recipients)
+
+    def _deliver_in_parallel(self, mlist, msg, msgdata, chunks, threads):
+        """Deliver the chunks in a pool of threads.
+
+        Unless the deliverer already uses a shared connection pool, the
+        threads share a pool of their own, so that each thread has its own
+        connection.  A shared pool limits the number of chunks delivered at
+        the same time to its size.
+
+        :return: The delivery failures of each chunk, in the order of
+            `chunks`.
+        :rtype: list of dictionaries
+        """
+        connection = self._connection
+        if not isinstance(connection, ConnectionPool):
+            self._connection = ConnectionPool.from_config(threads)
+        try:
+            # Flatten the message once, before the threads all need it.
+            msg.flattened(CRLF)
+            with ThreadPoolExecutor(threads) as executor:
+                return list(executor.map(
+                    lambda recipients: self._deliver_chunk(
+                        mlist, msg, msgdata, recipients),
+                    chunks))
+        finally:
+            if self._connection is not connection:
+                self._connection.quit()
+                self._connection = connection
@@ -19,24 +19,32 @@
 
 __all__ = [
     'Connection',
+    'ConnectionPool',
     ]
 
 
+import time
+import socket
 import logging
 import smtplib
+import threading
 
-from lazr.config import as_boolean
+from contextlib import contextmanager
+from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
+from mailman.mta.smarthosts import Smarthost, Smarthosts
 
 
 log = logging.getLogger('mailman.smtp')
+# The connection pool shared by the deliveries made in this thread.
+_shared = threading.local()
 
 
 
 class Connection:
     """Manage a connection to the SMTP server."""
     def __init__(self, host, port, sessions_per_connection,
-                 smtp_user=None, smtp_pass=None):
+                 smtp_user=None, smtp_pass=None, smarthosts=None):
         """Create a connection manager.
 
         :param host: The host name of the SMTP server to connect to.
@@ -54,20 +62,82 @@ class Connection:
         :type smtp_user: str
         :param smtp_pass: Optional SMTP authentication password.  If given,
             `smtp_user` must also be given.
+        :param smarthosts: Optional SMTP servers to choose from every time a
+            new connection is opened.  If given, `host` and `port` are
+            ignored.
+        :type smarthosts: `Smarthosts`
         """
-        self._host = host
-        self._port = port
+        self._smarthosts = (Smarthosts([Smarthost(host, port)])
+                            if smarthosts is None
+                            else smarthosts)
+        self._smarthost = None
         self._sessions_per_connection = sessions_per_connection
         self._username = smtp_user
         self._password = smtp_pass
         self._session_count = None
         self._connection = None
 
+    @property
+    def connected(self):
+        """Whether a connection to the SMTP server is open."""
+        return self._connection is not None
+
+    def check(self, command='noop'):
+        """Check that an open connection still works.
+
+        If the SMTP server does not answer the command with a 250 reply, the
+        connection is closed, and the next send attempt opens a new one.
+
+        :param command: The SMTP command to check the connection with,
+            either `noop` or `rset`.
+        :type command: str
+        :return: False if the connection had to be closed.
+        :rtype: bool
+        """
+        if self._connection is None:
+            return True
+        try:
+            code, response = self._connection.docmd(command)
+        except (socket.error, smtplib.SMTPException) as error:
+            log.debug('Connection check failed: %s', error)
+            code = None
+        if code == 250:
+            return True
+        self._drop()
+        return False
+
+    def _drop(self):
+        """Close a connection which the SMTP server may have given up on."""
+        try:
+            self._connection.close()
+        except socket.error:
+            pass
+        self._connection = None
+
     def _connect(self):
-        """Open a new connection."""
-        self._connection = smtplib.SMTP()
-        log.debug('Connecting to %s:%s', self._host, self._port)
-        self._connection.connect(self._host, self._port)
+        """Open a new connection.
+
+        A smarthost which can't be connected to is marked down, and the next
+        one is tried, until all of them have been tried.
+        """
+        tried = set()
+        while True:
+            smarthost = self._smarthosts.choose(tried)
+            connection = smtplib.SMTP()
+            log.debug('Connecting to %s', smarthost.name)
+            try:
+                connection.connect(smarthost.host, smarthost.port)
+            except (socket.error, smtplib.SMTPException) as error:
+                connection.close()
+                self._smarthosts.failed(smarthost, error)
+                tried.add(smarthost)
+                if len(tried) == len(self._smarthosts):
+                    raise
+                continue
+            break
+        self._smarthosts.connected(smarthost)
+        self._connection = connection
+        self._smarthost = smarthost
         if self._username is not None and self._password is not None:
             log.debug('Logging in')
             self._connection.login(self._username, self._password)
@@ -85,11 +155,18 @@ class Connection:
             log.debug('envsender: %s, recipients: %s, size(msgtext): %s',
                       envsender, recipients, len(msgtext))
             results = self._connection.sendmail(envsender, recipients, msgtext)
+        except (socket.error, smtplib.SMTPServerDisconnected) as error:
+            # The smarthost went away, so give it a rest.
+            self._smarthosts.failed(self._smarthost, error, connecting=False)
+            self.quit()
+            raise
         except smtplib.SMTPException:
             # For safety, close this connection.  The next send attempt will
             # automatically re-open it.  Pass the exception on up.
             self.quit()
             raise
+        self._smarthosts.delivered(
+            self._smarthost, recipients, results, len(msgtext))
         # This session has been successfully completed.
         self._session_count -= 1
         # By testing exactly for equality to 0, we automatically handle the
@@ -105,6 +182,152 @@ class Connection:
             return
         try:
             self._connection.quit()
-        except smtplib.SMTPException:
+        except (socket.error, smtplib.SMTPException):
             pass
         self._connection = None
+
+
+
+
+class ConnectionPool:
+    """A pool of connections to the SMTP servers, shared by deliveries.
+
+    Deliveries made while the pool is `shared()` borrow one of its
+    connections for every SMTP session instead of opening their own, so the
+    cost of connecting and authenticating is paid once per connection
+    rather than once per message.  A pool has the same `sendmail()` and
+    `quit()` methods as a `Connection`.
+    """
+
+    def __init__(self, host, port, sessions_per_connection,
+                 smtp_user=None, smtp_pass=None,
+                 size=1, idle_timeout=0, check='noop', smarthosts=None):
+        """Create a connection pool.
+
+        :param host: The host name of the SMTP server to connect to.
+        :type host: string
+        :param port: The port number of the SMTP server to connect to.
+        :type port: integer
+        :param sessions_per_connection: The number of SMTP sessions per
+            connection; see `Connection`.
+        :type sessions_per_connection: integer
+        :param smtp_user: Optional SMTP authentication user name.
+        :type smtp_user: str
+        :param smtp_pass: Optional SMTP authentication password.
+        :type smtp_pass: str
+        :param size: The largest number of connections to open.  Sessions
+            wait for a connection when all of them are in use.
+        :type size: integer
+        :param idle_timeout: Connections which have not been used for this
+            many seconds are closed.  Zero means they are never closed.
+        :type idle_timeout: float
+        :param check: The SMTP command an open connection is checked with
+            before it is reused, either `noop` or `rset`, or `none` to reuse
+            connections unchecked.
+        :type check: str
+        :param smarthosts: Optional SMTP servers to spread the connections
+            over.  If given, `host` and `port` are ignored.
+        :type smarthosts: `Smarthosts`
+        """
+        assert size > 0, 'Bad pool size: {0}'.format(size)
+        assert check in ('noop', 'rset', 'none'), (
+            'Bad connection check: {0}'.format(check))
+        if smarthosts is None:
+            smarthosts = Smarthosts([Smarthost(host, port)])
+        self._args = (host, port, sessions_per_connection,
+                      smtp_user, smtp_pass, smarthosts)
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._check = check
+        self._lock = threading.Condition()
+        # The connections nobody is using, each with the time it was last
+        # used.  The most recently used connection is at the end.
+        self._idle = []
+        self._in_use = 0
+
+    @classmethod
+    def from_config(cls, size=None):
+        """Create a connection pool from the `[mta]` configuration.
+
+        :param size: The size of the pool, overriding the configured
+            `connection_pool_size`.
+        :type size: integer
+        :return: The connection pool, or None if pooling is disabled.
+        :rtype: `ConnectionPool`
+        """
+        if size is None:
+            size = int(config.mta.connection_pool_size)
+        if size == 0:
+            return None
+        return cls(config.mta.smtp_host, int(config.mta.smtp_port),
+                   int(config.mta.max_sessions_per_connection),
+                   config.mta.smtp_user if config.mta.smtp_user else None,
+                   config.mta.smtp_pass if config.mta.smtp_pass else None,
+                   size,
+                   as_timedelta(
+                       config.mta.connection_idle_timeout).total_seconds(),
+                   config.mta.connection_check,
+                   Smarthosts.from_config())
+
+    @staticmethod
+    def current():
+        """Return the pool shared by deliveries in this thread, or None."""
+        return getattr(_shared, 'pool', None)
+
+    @contextmanager
+    def shared(self):
+        """Share this pool with the deliveries made in this thread."""
+        outer = getattr(_shared, 'pool', None)
+        _shared.pool = self
+        try:
+            yield self
+        finally:
+            _shared.pool = outer
+
+    def _checkout(self):
+        with self._lock:
+            while len(self._idle) == 0 and self._in_use >= self._size:
+                self._lock.wait()
+            self._in_use += 1
+            if len(self._idle) == 0:
+                return Connection(*self._args)
+            connection, last_used = self._idle.pop()
+        if (self._idle_timeout > 0 and
+                time.time() - last_used > self._idle_timeout):
+            connection.quit()
+        elif self._check != 'none':
+            connection.check(self._check)
+        return connection
+
+    def _checkin(self, connection):
+        with self._lock:
+            self._idle.append((connection, time.time()))
+            self._in_use -= 1
+            self._lock.notify()
+
+    def sendmail(self, envsender, recipients, msgtext):
+        """Send a message over one of the pool's connections.
+
+        See `Connection.sendmail()`.
+        """
+        connection = self._checkout()
+        try:
+            return connection.sendmail(envsender, recipients, msgtext)
+        finally:
+            self._checkin(connection)
+
+    def expire(self):
+        """Close the connections which have been idle for too long."""
+        if self._idle_timeout <= 0:
+            return
+        deadline = time.time() - self._idle_timeout
+        with self._lock:
+            for connection, last_used in self._idle:
+                if last_used < deadline:
+                    connection.quit()
+
+    def quit(self):
+        """Close all the connections nobody is using."""
+        with self._lock:
+            for connection, last_used in self._idle:
+                connection.quit()
@@ -24,6 +24,7 @@ __all__ = [
 
 
 from mailman.config import config
+from mailman.handlers.decorate import member_substitutions
 from mailman.mta.verp import VERPDelivery
 
 
@@ -38,6 +39,21 @@ class DecoratingMixin:
         # Do not decorate a message more than once.
         msgdata['nodecorate'] = True
 
+    def decoration_values(self, mlist, msgdata):
+        """Return the recipient's values for `decorate()`."""
+        if msgdata.get('isdigest') or msgdata.get('nodecorate'):
+            return {}
+        return member_substitutions(msgdata)
+
+    def decorate_with(self, mlist, msg, msgdata, values):
+        """Add headers and footers personalized with the given values."""
+        decoration_data = dict(values)
+        decoration_data.update(msgdata.get('decoration-data', {}))
+        decorator = config.handlers['decorate']
+        decorator.process(mlist, msg, dict(
+            msgdata, member=None, **{'decoration-data': decoration_data}))
+        msgdata['nodecorate'] = True
+
 
 
 class DecoratingDelivery(DecoratingMixin, VERPDelivery):
@@ -47,3 +63,5 @@ class DecoratingDelivery(DecoratingMixin, VERPDelivery):
         """See `IndividualDelivery`."""
         super(DecoratingDelivery, self).__init__()
         self.callbacks.append(self.decorate)
+        self.slots[self.decorate] = (self.decoration_values,
+                                     self.decorate_with)
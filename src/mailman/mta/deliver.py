@@ -33,6 +33,8 @@ from mailman.mta.personalized import PersonalizedMixin
 from mailman.mta.verp import VERPMixin
 from mailman.mta.base import IndividualDelivery
 from mailman.mta.bulk import BulkDelivery
+from mailman.mta.destinations import Destinations
+from mailman.mta.shards import tally_shard
 from mailman.utilities.string import expand
 
 
@@ -60,6 +62,11 @@ class Deliver(VERPMixin, DecoratingMixin, PersonalizedMixin,
             self.decorate,
             self.personalize_to,
             ])
+        self.slots.update({
+            self.avoid_duplicates: (self.copy_values, self.mark_copy),
+            self.decorate: (self.decoration_values, self.decorate_with),
+            self.personalize_to: (self.to_values, self.replace_to),
+            })
 
 
 
@@ -78,7 +85,9 @@ def deliver(mlist, msg, msgdata):
     elif mlist.personalize != Personalization.none:
         agent = Deliver()
     else:
-        agent = BulkDelivery(int(config.mta.max_recipients))
+        agent = BulkDelivery(int(config.mta.max_recipients),
+                             int(config.mta.max_delivery_threads),
+                             Destinations.from_config())
     log.debug('Using agent: %s', agent)
     # Keep track of the original recipients and the original sender for
     # logging purposes.
@@ -92,7 +101,7 @@ def deliver(mlist, msg, msgdata):
     # Log this posting.
     size = getattr(msg, 'original_size', msgdata.get('original_size'))
     if size is None:
-        size = len(msg.as_string())
+        size = len(msg.flattened())
     substitutions = dict(
         msgid       = msg.get('message-id', 'n/a'),
         listname    = mlist.fqdn_listname,
@@ -104,24 +113,22 @@ def deliver(mlist, msg, msgdata):
         smtpcode    = 'n/a',
         smtpmsg     = 'n/a',
         )
-    template = config.logging.smtp.every
-    if template.lower() != 'no':
-        log.info('%s', expand(template, substitutions))
-    if refused:
-        template = config.logging.smtp.refused
-        if template.lower() != 'no':
-            log.info('%s', expand(template, substitutions))
+    # The shards of a posting are logged as one posting, once the last of
+    # them has been delivered.  Retries are logged on their own.
+    shard = msgdata.pop('shard', None)
+    if shard is None:
+        totals = None
     else:
-        # Log the successful post, but if it was not destined to the mailing
-        # list (e.g. to the owner or admin), print the actual recipients
-        # instead of just the number.
-        if not msgdata.get('tolist', False):
-            recips = msg.get_all('to', [])
-            recips.extend(msg.get_all('cc', []))
-            substitutions['recips'] = COMMA.join(recips)
-        template = config.logging.smtp.success
-        if template.lower() != 'no':
-            log.info('%s', expand(template, substitutions))
+        totals = tally_shard(msgdata['posting'], shard, t0, t1,
+                             len(original_recipients), len(refused))
+        if totals is not None:
+            substitutions.update(
+                recip       = totals['recipients'],
+                time        = totals['time'],
+                refused     = totals['refused'],
+                )
+    if shard is None or totals is not None:
+        _log_posting(msg, msgdata, substitutions)
     # Process any failed deliveries.
     temporary_failures = []
     permanent_failures = []
@@ -153,3 +160,24 @@ def deliver(mlist, msg, msgdata):
     # Return the results
     if temporary_failures or permanent_failures:
         raise SomeRecipientsFailed(temporary_failures, permanent_failures)
+
+
+def _log_posting(msg, msgdata, substitutions):
+    template = config.logging.smtp.every
+    if template.lower() != 'no':
+        log.info('%s', expand(template, substitutions))
+    if substitutions['refused'] > 0:
+        template = config.logging.smtp.refused
+        if template.lower() != 'no':
+            log.info('%s', expand(template, substitutions))
+    else:
+        # Log the successful post, but if it was not destined to the mailing
+        # list (e.g. to the owner or admin), print the actual recipients
+        # instead of just the number.
+        if not msgdata.get('tolist', False):
+            recips = msg.get_all('to', [])
+            recips.extend(msg.get_all('cc', []))
+            substitutions['recips'] = COMMA.join(recips)
+        template = config.logging.smtp.success
+        if template.lower() != 'no':
+            log.info('%s', expand(template, substitutions))
@@ -0,0 +1,174 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Recipient destinations and their delivery limits."""
+
+__all__ = [
+    'Destinations',
+    'Limits',
+    ]
+
+
+import fnmatch
+import threading
+
+from collections import namedtuple
+from contextlib import ExitStack, contextmanager
+from mailman.config import config
+from mailman.utilities.modules import find_name
+
+
+# The delivery limits of a destination.  Zero means no limit.
+Limits = namedtuple('Limits', 'name max_recipients max_sessions')
+NO_LIMITS = Limits(None, 0, 0)
+
+# The semaphores limiting the sessions delivering to a destination at the
+# same time in this process, keyed by the name of the limits.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+
+class Destinations:
+    """Group recipients by destination and look up the destinations' limits.
+
+    A recipient's destination is the domain of its address, unless a
+    resolver maps the domain to something else, e.g. the host name of its
+    most preferred MX, which groups the domains served by the same mail
+    servers together.
+    """
+
+    def __init__(self, resolver=None, limits=()):
+        """Create a destination grouping.
+
+        :param resolver: A callable mapping a lower cased domain to the name
+            of its destination.  None groups recipients by their domain.
+        :type resolver: callable
+        :param limits: The limits of the destinations, each with the
+            shell-style patterns of the destinations or domains it applies
+            to.  The first matching limits apply to a destination.
+        :type limits: sequence of (patterns, `Limits`) pairs
+        """
+        self._resolver = resolver
+        self._limits = list(limits)
+        # Resolving domains may be expensive, and the same domains come up
+        # again and again.
+        self._destinations = {}
+        self._destination_limits = {}
+
+    @classmethod
+    def from_config(cls):
+        """Create the destination grouping from the configuration.
+
+        The resolver is `[mta]destination_resolver`, and the limits are
+        those of the `[destination.*]` sections.
+
+        :return: The destination grouping.
+        :rtype: `Destinations`
+        """
+        resolver = config.mta.destination_resolver.strip()
+        limits = []
+        for section in config.destination_configs:
+            patterns = section.domains.split()
+            if len(patterns) == 0:
+                continue
+            name = section.name.partition('.')[2]
+            limits.append((patterns, Limits(
+                name, int(section.max_recipients),
+                int(section.max_sessions))))
+        return cls(find_name(resolver) if resolver else None, limits)
+
+    def destination(self, address):
+        """Return the destination of an email address.
+
+        :param address: The recipient's email address.
+        :type address: str
+        :return: The name of the recipient's destination.
+        :rtype: str
+        """
+        domain = address.rpartition('@')[2].lower()
+        try:
+            return self._destinations[domain]
+        except KeyError:
+            pass
+        destination = (domain
+                       if self._resolver is None
+                       else self._resolver(domain))
+        self._destinations[domain] = destination
+        # The limits for a resolved destination can also be given for one of
+        # the domains it serves.
+        if self._destination_limits.get(destination, NO_LIMITS) is NO_LIMITS:
+            self._destination_limits[destination] = self._match(
+                destination, domain)
+        return destination
+
+    def _match(self, *names):
+        for patterns, limits in self._limits:
+            for name in names:
+                if any(fnmatch.fnmatchcase(name, pattern)
+                       for pattern in patterns):
+                    return limits
+        return NO_LIMITS
+
+    def limits(self, destination):
+        """Return the delivery limits of a destination.
+
+        :param destination: A destination returned by `destination()`.
+        :type destination: str
+        :return: The destination's limits.
+        :rtype: `Limits`
+        """
+        limits = self._destination_limits.get(destination)
+        if limits is None:
+            limits = self._match(destination)
+            self._destination_limits[destination] = limits
+        return limits
+
+    @contextmanager
+    def sessions(self, destinations):
+        """Wait for a free session for every destination, and hold them.
+
+        The sessions are limited by the `max_sessions` of the destinations'
+        limits, for all the deliveries made by this process.
+
+        :param destinations: The destinations the session delivers to.
+        :type destinations: iterable of str
+        """
+        semaphores = {}
+        for destination in destinations:
+            limits = self.limits(destination)
+            if limits.max_sessions > 0:
+                semaphores[limits.name] = _semaphore(limits)
+        with ExitStack() as stack:
+            # Always acquire the semaphores in the same order, so that
+            # sessions waiting for each other's destinations can't deadlock.
+            for name in sorted(semaphores):
+                semaphore = semaphores[name]
+                semaphore.acquire()
+                stack.callback(semaphore.release)
+            yield
+
+
+
+def _semaphore(limits):
+    """Return the process wide semaphore for the limits' sessions."""
+    with _sessions_lock:
+        size, semaphore = _sessions.get(limits.name, (None, None))
+        if size != limits.max_sessions:
+            semaphore = threading.BoundedSemaphore(limits.max_sessions)
+            _sessions[limits.name] = (limits.max_sessions, semaphore)
+        return semaphore
@@ -47,20 +47,31 @@ class PersonalizedMixin:
         if the recipient is a user registered with Mailman, the recipient's
         real name too.
         """
+        self.replace_to(mlist, msg, msgdata, self.to_values(mlist, msgdata))
+
+    def to_values(self, mlist, msgdata):
+        """Return the recipient's values for `personalize_to()`."""
         # Personalize the To header if the list requests it.
         if mlist.personalize != Personalization.full:
-            return
+            return {}
         recipient = msgdata['recipient']
-        user_manager = getUtility(IUserManager)
-        user = user_manager.get_user(recipient)
-        if user is None:
-            msg.replace_header('To', recipient)
+        if 'user' in msgdata:
+            # The user was looked up along with the other recipients'.
+            user = msgdata['user']
         else:
-            # Convert the unicode name to an email-safe representation.
-            # Create a Header instance for the name so that it's properly
-            # encoded for email transport.
-            name = Header(user.display_name).encode()
-            msg.replace_header('To', formataddr((name, recipient)))
+            user = getUtility(IUserManager).get_user(recipient)
+        if user is None:
+            return dict(to=recipient)
+        # Convert the unicode name to an email-safe representation.  Create a
+        # Header instance for the name so that it's properly encoded for email
+        # transport.
+        name = Header(user.display_name).encode()
+        return dict(to=formataddr((name, recipient)))
+
+    def replace_to(self, mlist, msg, msgdata, values):
+        """Replace the To header with the given values."""
+        if 'to' in values:
+            msg.replace_header('To', values['to'])
 
 
 
@@ -71,3 +82,4 @@ class PersonalizedDelivery(PersonalizedMixin, VERPDelivery):
         """See `IndividualDelivery`."""
         super(PersonalizedDelivery, self).__init__()
         self.callbacks.append(self.personalize_to)
+        self.slots[self.personalize_to] = (self.to_values, self.replace_to)
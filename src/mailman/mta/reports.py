@@ -0,0 +1,102 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Delivery state reports of the outgoing and LMTP runners.
+
+Each outgoing runner process periodically saves the state of its delivery
+machinery, e.g. its delivery throttle, to JSON files in the data directory,
+so that other processes like the REST runner can report on it.  The LMTP
+runner likewise saves the state of its back pressure.
+"""
+
+__all__ = [
+    'read_reports',
+    'report_file',
+    'write_report',
+    ]
+
+
+import os
+import glob
+import json
+
+from mailman.config import config
+
+
+
+def report_file(name, slice=None, runner='out'):
+    """Return the file a runner saves a report in.
+
+    :param name: The name of the report, e.g. `throttle`.
+    :type name: str
+    :param slice: The runner's slice number.
+    :type slice: int or None
+    :param runner: The name of the runner, e.g. `out`.
+    :type runner: str
+    :return: The path to the report file.
+    :rtype: str
+    """
+    return os.path.join(config.DATA_DIR, '{0}-{1}-{2}.json'.format(
+        name, runner, 0 if slice is None else slice))
+
+
+
+def write_report(path, entries):
+    """Write a report.
+
+    The file is replaced atomically, so readers never see a partial report.
+
+    :param path: The report file.
+    :type path: str
+    :param entries: The report's entries.
+    :type entries: list of dictionaries
+    """
+    tmp_path = '{0}.tmp'.format(path)
+    with open(tmp_path, 'w') as fp:
+        json.dump(entries, fp)
+    os.replace(tmp_path, path)
+
+
+
+def read_reports(name, key, runner='out'):
+    """Read the reports saved by all the runners of a kind.
+
+    :param name: The name of the report.
+    :type name: str
+    :param key: The name of the entries' key to order them by.
+    :type key: str
+    :param runner: The name of the runners, e.g. `out`.
+    :type runner: str
+    :return: The entries of all the reports, each with the slice of the
+        runner which saved it, ordered by key and slice.
+    :rtype: list of dictionaries
+    """
+    entries = []
+    prefix = '{0}-{1}-'.format(name, runner)
+    for path in glob.glob(os.path.join(config.DATA_DIR, prefix + '*.json')):
+        slice = os.path.basename(path)[len(prefix):-5]
+        try:
+            with open(path) as fp:
+                report = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            # The runner has just stopped.
+            continue
+        for entry in report:
+            entry['slice'] = int(slice)
+            entries.append(entry)
+    entries.sort(key=lambda entry: (entry[key], entry['slice']))
+    return entries
@@ -0,0 +1,146 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Sharding the recipients of large postings.
+
+A posting to many recipients can be split into shards, each with a part of
+the recipients, which are queued separately and delivered in parallel by
+different outgoing runners.  Each shard's delivery is tallied in the data
+directory, so that the posting is still logged once, when its last shard has
+been delivered.
+"""
+
+__all__ = [
+    'split_recipients',
+    'tally_shard',
+    ]
+
+
+import os
+import json
+import time
+import shutil
+
+from mailman.config import config
+from mailman.utilities.filesystem import makedirs
+
+
+# The tallies of postings whose shards never all got delivered, e.g. because
+# one of them was discarded, are removed after this many seconds.
+FORGET_AFTER = 86400
+
+
+
+def split_recipients(recipients, count):
+    """Split the recipients of a posting into shards.
+
+    The recipients are ordered by domain before they are split, so that each
+    domain's recipients mostly end up in the same shard, where they can be
+    chunked together.
+
+    :param recipients: The recipients of the posting.
+    :type recipients: iterable of str
+    :param count: The number of shards.
+    :type count: int
+    :return: Up to `count` non-empty sets of recipients, fewer if there are
+        fewer recipients.
+    :rtype: list of sets
+    """
+    ordered = sorted(
+        recipients,
+        key=lambda address: address.rpartition('@')[::-1])
+    size, extra = divmod(len(ordered), count)
+    shards = []
+    start = 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        if end > start:
+            shards.append(set(ordered[start:end]))
+        start = end
+    return shards
+
+
+
+def tally_shard(posting, shard, started, finished, recipients, refused):
+    """Tally the delivery of one shard of a posting.
+
+    Every shard writes its counters to the posting's directory.  The shard
+    which completes the set claims the directory by renaming it, so exactly
+    one process gets the totals, even if several shards finish at once.
+
+    :param posting: The unique id shared by the shards of the posting.
+    :type posting: str
+    :param shard: The index of this shard and the number of shards.
+    :type shard: (int, int)
+    :param started: When the shard's delivery started.
+    :type started: float
+    :param finished: When the shard's delivery finished.
+    :type finished: float
+    :param recipients: The number of recipients of the shard.
+    :type recipients: int
+    :param refused: The number of recipients the shard's delivery failed for.
+    :type refused: int
+    :return: None while other shards are still to be delivered.  Otherwise a
+        dictionary with the posting's total number of `recipients` and
+        `refused` recipients, and the `time` it took from the start of the
+        first shard's delivery to the end of the last one's.
+    :rtype: dict or None
+    """
+    index, count = shard
+    tallies = os.path.join(config.DATA_DIR, 'shards')
+    directory = os.path.join(tallies, posting)
+    makedirs(directory)
+    path = os.path.join(directory, '{0}.json'.format(index))
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(dict(started=started, finished=finished,
+                       recipients=recipients, refused=refused), fp)
+    os.replace(path + '.tmp', path)
+    names = [name for name in os.listdir(directory)
+             if name.endswith('.json')]
+    if len(names) < count:
+        return None
+    claimed = os.path.join(tallies, '.' + posting)
+    try:
+        os.rename(directory, claimed)
+    except FileNotFoundError:
+        # Another shard got there first.
+        return None
+    counters = []
+    for name in names:
+        with open(os.path.join(claimed, name)) as fp:
+            counters.append(json.load(fp))
+    shutil.rmtree(claimed)
+    _forget(tallies)
+    return dict(
+        recipients=sum(counter['recipients'] for counter in counters),
+        refused=sum(counter['refused'] for counter in counters),
+        time=(max(counter['finished'] for counter in counters) -
+              min(counter['started'] for counter in counters)),
+        )
+
+
+
+def _forget(tallies):
+    # Remove the tallies which have not been touched for too long.
+    expired = time.time() - FORGET_AFTER
+    for name in os.listdir(tallies):
+        directory = os.path.join(tallies, name)
+        try:
+            if os.stat(directory).st_mtime < expired:
+                shutil.rmtree(directory)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,248 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Weighted smarthosts with failover."""
+
+__all__ = [
+    'Smarthost',
+    'Smarthosts',
+    ]
+
+
+import time
+import logging
+import threading
+
+from lazr.config import as_timedelta
+from mailman.config import config
+
+
+log = logging.getLogger('mailman.smtp')
+
+# The smarthosts of the current configuration, shared by all the connections
+# made by this process, so that they agree on which smarthosts are down.
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+
+class Smarthost:
+    """An SMTP server to deliver to, with its delivery counters."""
+
+    def __init__(self, host, port, weight=1):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.name = '{0}:{1}'.format(host, port)
+        # For the smooth weighted round robin.
+        self.current_weight = 0
+        # The time until which the smarthost is not used, or None when it is
+        # up.
+        self.down_until = None
+        self.last_error = None
+        self.connections = 0
+        self.connect_errors = 0
+        self.sessions = 0
+        self.session_errors = 0
+        self.recipients = 0
+        self.refused = 0
+        self.bytes = 0
+
+    def __repr__(self):
+        return '<Smarthost {0} weight {1}>'.format(self.name, self.weight)
+
+    def as_dict(self):
+        return dict(
+            name=self.name,
+            host=self.host,
+            port=self.port,
+            weight=self.weight,
+            up=self.down_until is None,
+            down_until=self.down_until,
+            last_error=self.last_error,
+            connections=self.connections,
+            connect_errors=self.connect_errors,
+            sessions=self.sessions,
+            session_errors=self.session_errors,
+            recipients=self.recipients,
+            refused=self.refused,
+            bytes=self.bytes,
+            )
+
+
+
+class Smarthosts:
+    """Spread connections over weighted smarthosts.
+
+    Every new connection goes to the next smarthost in a smooth weighted
+    round robin, so that each smarthost gets its share of the connections,
+    evenly interleaved with the others.  A smarthost which can't be
+    connected to is marked down, and is passed over until its cool-off
+    period is over.  When all of them are down, the one which has been down
+    the longest is tried anyway.
+    """
+
+    def __init__(self, hosts, cool_off=60, clock=time.time):
+        """Create a smarthost balancer.
+
+        :param hosts: The smarthosts.
+        :type hosts: sequence of `Smarthost`, with positive weights
+        :param cool_off: The number of seconds a smarthost which failed is
+            not used for.
+        :type cool_off: float
+        :param clock: The function returning the current time in seconds.
+        :type clock: callable
+        """
+        assert len(hosts) > 0, 'No smarthosts'
+        assert all(host.weight > 0 for host in hosts), (
+            'Bad smarthost weights: {0}'.format(hosts))
+        self.hosts = list(hosts)
+        self._cool_off = cool_off
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.started = clock()
+
+    def __len__(self):
+        return len(self.hosts)
+
+    @classmethod
+    def from_config(cls):
+        """Return the smarthosts of the configuration.
+
+        The smarthosts are those of the `[smarthost.*]` sections, or
+        `[mta]smtp_host` and `smtp_port` if there are none.  The same
+        configuration always gives the same smarthosts in a process.
+
+        :return: The smarthosts.
+        :rtype: `Smarthosts`
+        """
+        hosts = []
+        for section in config.smarthost_configs:
+            if section.host.strip() and int(section.weight) > 0:
+                hosts.append((section.host.strip(), int(section.port),
+                              int(section.weight)))
+        if len(hosts) == 0:
+            hosts.append((config.mta.smtp_host, int(config.mta.smtp_port), 1))
+        cool_off = as_timedelta(
+            config.mta.smarthost_cool_off).total_seconds()
+        key = (tuple(hosts), cool_off)
+        with _shared_lock:
+            smarthosts = _shared.get(key)
+            if smarthosts is None:
+                smarthosts = _shared[key] = cls(
+                    [Smarthost(*host) for host in hosts], cool_off)
+            return smarthosts
+
+    def choose(self, exclude=()):
+        """Choose the smarthost for a new connection.
+
+        :param exclude: Smarthosts which must not be chosen, e.g. because
+            they were just tried.
+        :type exclude: collection of `Smarthost`
+        :return: The smarthost, or None if all of them are excluded.
+        :rtype: `Smarthost`
+        """
+        with self._lock:
+            now = self._clock()
+            candidates = []
+            for host in self.hosts:
+                if host in exclude:
+                    continue
+                if host.down_until is not None and host.down_until <= now:
+                    host.down_until = None
+                candidates.append(host)
+            if len(candidates) == 0:
+                return None
+            up = [host for host in candidates if host.down_until is None]
+            if len(up) == 0:
+                return min(candidates, key=lambda host: host.down_until)
+            total = 0
+            chosen = None
+            for host in up:
+                host.current_weight += host.weight
+                total += host.weight
+                if (chosen is None or
+                        host.current_weight > chosen.current_weight):
+                    chosen = host
+            chosen.current_weight -= total
+            return chosen
+
+    def connected(self, host):
+        """Record a new connection to a smarthost.
+
+        :param host: The smarthost.
+        :type host: `Smarthost`
+        """
+        with self._lock:
+            host.connections += 1
+            host.down_until = None
+
+    def failed(self, host, error, connecting=True):
+        """Record a connection error, and mark the smarthost down.
+
+        :param host: The smarthost.
+        :type host: `Smarthost`
+        :param error: The error.
+        :type error: Exception
+        :param connecting: Whether the error happened while connecting, as
+            opposed to during an SMTP session.
+        :type connecting: bool
+        """
+        with self._lock:
+            if connecting:
+                host.connect_errors += 1
+            else:
+                host.session_errors += 1
+            host.last_error = str(error)
+            host.down_until = self._clock() + self._cool_off
+        log.error('Smarthost %s is down for %s seconds: %s',
+                  host.name, self._cool_off, error)
+
+    def delivered(self, host, recipients, refused, size):
+        """Record an SMTP session with a smarthost.
+
+        :param host: The smarthost.
+        :type host: `Smarthost`
+        :param recipients: The recipients of the session.
+        :type recipients: sequence of str
+        :param refused: The recipients the smarthost refused.
+        :type refused: dictionary
+        :param size: The size of the message in bytes.
+        :type size: int
+        """
+        with self._lock:
+            host.sessions += 1
+            host.recipients += len(recipients)
+            host.refused += len(refused)
+            host.bytes += size
+
+    def states(self):
+        """Return the state and counters of all the smarthosts.
+
+        The counters start at the `since` time, so dividing them by the time
+        since then gives the smarthosts' throughput.
+
+        :return: The smarthosts' states, in configuration order.
+        :rtype: list of dictionaries
+        """
+        with self._lock:
+            states = []
+            for host in self.hosts:
+                state = host.as_dict()
+                state['since'] = self.started
+                states.append(state)
+            return states
@@ -0,0 +1,136 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the back pressure from the queues on incoming mail."""
+
+__all__ = [
+    'TestBackPressure',
+    ]
+
+
+import time
+import unittest
+
+from mailman.config import config
+from mailman.mta.backpressure import BackPressure
+from mailman.testing.helpers import configuration
+from mailman.testing.layers import ConfigLayer
+
+
+
+
+class FakeSwitchboard:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.when = None
+
+    def backlog(self):
+        return self.count, self.when
+
+
+
+
+class TestBackPressure(unittest.TestCase):
+    """Test the back pressure from the queues."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._in = FakeSwitchboard('in')
+        self._out = FakeSwitchboard('out')
+        self._pressure = BackPressure(
+            [self._in, self._out], 10, 5, 60, 30, interval=0)
+
+    def test_accepting(self):
+        self._in.count = 9
+        self.assertIsNone(self._pressure.check())
+
+    def test_depth(self):
+        # Mail is rejected from the high watermark on, until all the queues
+        # are down to the low watermark.
+        self._out.count = 10
+        self.assertEqual(self._pressure.check(), 'depth')
+        self._out.count = 6
+        self.assertEqual(self._pressure.check(), 'depth')
+        self._out.count = 5
+        self.assertIsNone(self._pressure.check())
+
+    def test_age(self):
+        self._in.count = 1
+        self._in.when = time.time() - 61
+        self.assertEqual(self._pressure.check(), 'age')
+        self._in.when = time.time() - 31
+        self.assertEqual(self._pressure.check(), 'age')
+        self._in.when = time.time() - 29
+        self.assertIsNone(self._pressure.check())
+
+    def test_depth_takes_precedence(self):
+        self._in.count = 10
+        self._in.when = time.time() - 61
+        self.assertEqual(self._pressure.check(), 'depth')
+        self._in.count = 1
+        self.assertEqual(self._pressure.check(), 'age')
+
+    def test_disabled_age(self):
+        pressure = BackPressure([self._in], 10, 5, interval=0)
+        self._in.count = 1
+        self._in.when = 0
+        self.assertIsNone(pressure.check())
+
+    def test_interval(self):
+        # The queues are not checked again within the interval.
+        pressure = BackPressure([self._in], 10, 5, interval=60)
+        self.assertIsNone(pressure.check())
+        self._in.count = 10
+        self.assertIsNone(pressure.check())
+        pressure._checked -= 60
+        self.assertEqual(pressure.check(), 'depth')
+
+    def test_states(self):
+        self._in.count = 10
+        self._in.when = time.time() - 2
+        self._pressure.check()
+        inq, outq = self._pressure.states()
+        self.assertEqual(inq['queue'], 'in')
+        self.assertEqual(inq['depth'], 10)
+        self.assertAlmostEqual(inq['age'], 2, delta=1)
+        self.assertTrue(inq['rejecting'])
+        self.assertEqual(outq, dict(queue='out', depth=0, age=0,
+                                    rejecting=True))
+
+    def test_from_config(self):
+        pressure = BackPressure.from_config()
+        self.assertEqual(
+            [switchboard.name for switchboard in pressure.switchboards],
+            ['in', 'pipeline', 'out'])
+        self.assertEqual(pressure.high, 10000)
+        self.assertEqual(pressure.low, 8000)
+        self.assertEqual(pressure.high_age, 0)
+        self.assertEqual(pressure.interval, 1)
+
+    @configuration('mta', lmtp_backpressure_queues='in',
+                   lmtp_high_age='10m', lmtp_low_age='5m')
+    def test_configured_age(self):
+        pressure = BackPressure.from_config()
+        self.assertEqual(pressure.switchboards, [config.switchboards['in']])
+        self.assertEqual(pressure.high_age, 600)
+        self.assertEqual(pressure.low_age, 300)
+
+    @configuration('mta', lmtp_high_watermark=0)
+    def test_disabled(self):
+        self.assertIsNone(BackPressure.from_config())
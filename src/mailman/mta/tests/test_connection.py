@@ -19,15 +19,33 @@
 
 __all__ = [
     'TestConnection',
+    'TestConnectionPool',
     ]
 
 
+import time
+import socket
 import unittest
+import threading
 
+from mailman.app.lifecycle import create_list
 from mailman.config import config
-from mailman.mta.connection import Connection
+from mailman.mta.bulk import BulkDelivery
+from mailman.mta.connection import Connection, ConnectionPool
+from mailman.runners.outgoing import OutgoingRunner
+from mailman.testing.helpers import (
+    make_testable_runner, specialized_message_from_string as mfs)
 from mailman.testing.layers import SMTPLayer
 from smtplib import SMTPAuthenticationError
+from unittest.mock import patch
+
+
+MESSAGE = """\
+From: anne@example.com
+To: bart@example.com
+Subject: aardvarks
+
+"""
 
 
 
@@ -49,3 +67,106 @@ Subject: aardvarks
 """)
         self.assertEqual(cm.exception.smtp_code, 571)
         self.assertEqual(cm.exception.smtp_error, b'Bad authentication')
+
+
+
+
+class TestConnectionPool(unittest.TestCase):
+    """Test sharing SMTP connections between deliveries."""
+
+    layer = SMTPLayer
+
+    def _make_pool(self, sessions_per_connection=0, **kws):
+        pool = ConnectionPool(
+            config.mta.smtp_host, int(config.mta.smtp_port),
+            sessions_per_connection, **kws)
+        self.addCleanup(pool.quit)
+        return pool
+
+    def _send(self, pool, count=1):
+        for i in range(count):
+            pool.sendmail('anne@example.com', ['bart@example.com'], MESSAGE)
+
+    def test_connection_is_reused(self):
+        pool = self._make_pool()
+        self._send(pool, 5)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 5)
+
+    def test_sessions_per_connection(self):
+        # The session limit still applies to pooled connections.
+        pool = self._make_pool(2)
+        self._send(pool, 5)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 3)
+
+    def test_idle_timeout(self):
+        # A connection which has been idle for too long is reopened.
+        pool = self._make_pool(idle_timeout=60)
+        self._send(pool)
+        later = time.time() + 61
+        with patch('mailman.mta.connection.time.time', return_value=later):
+            self._send(pool)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+
+    def test_expire(self):
+        pool = self._make_pool(idle_timeout=60)
+        self._send(pool)
+        pool.expire()
+        connection, last_used = pool._idle[0]
+        self.assertTrue(connection.connected)
+        later = time.time() + 61
+        with patch('mailman.mta.connection.time.time', return_value=later):
+            pool.expire()
+        self.assertFalse(connection.connected)
+
+    def test_broken_connection_is_reopened(self):
+        # A connection which the server has dropped fails the check before
+        # it is reused, so the message still gets through.
+        pool = self._make_pool()
+        self._send(pool)
+        connection, last_used = pool._idle[0]
+        connection._connection.sock.shutdown(socket.SHUT_RDWR)
+        self._send(pool)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 2)
+
+    def test_size(self):
+        # When all the connections are in use, sessions wait for one to be
+        # returned to the pool.
+        pool = self._make_pool(size=1)
+        connection = pool._checkout()
+        sent = threading.Event()
+        def send():
+            self._send(pool)
+            sent.set()
+        thread = threading.Thread(target=send)
+        thread.start()
+        self.assertFalse(sent.wait(0.2))
+        pool._checkin(connection)
+        self.assertTrue(sent.wait(5))
+        thread.join()
+
+    def test_shared(self):
+        # Deliveries use the pool which is shared in their thread.
+        pool = self._make_pool()
+        with pool.shared():
+            self.assertIs(BulkDelivery()._connection, pool)
+        self.assertIsInstance(BulkDelivery()._connection, Connection)
+
+    def test_outgoing_runner(self):
+        # The outgoing runner delivers all its messages over one connection.
+        create_list('test@example.com')
+        outq = config.switchboards['out']
+        for i in range(5):
+            msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <{}>
+
+""".format(i))
+            outq.enqueue(msg, listid='test.example.com',
+                         recipients=['bart@example.com'])
+        runner = make_testable_runner(OutgoingRunner, 'out')
+        runner.run()
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 5)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
@@ -19,21 +19,33 @@
 
 __all__ = [
     'TestIndividualDelivery',
+    'TestLineEndings',
+    'TestParallelBulkDelivery',
     ]
 
 
 import os
+import re
+import time
 import shutil
+import smtplib
 import tempfile
 import unittest
+import threading
 
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.interfaces.mailinglist import Personalization
-from mailman.mta.deliver import Deliver
+from mailman.mta.bulk import BulkDelivery
+from mailman.mta.connection import ConnectionPool
+from mailman.email.message import LazyMessage, Message
+from mailman.mta.deliver import Deliver, deliver
+from mailman.mta.destinations import Destinations, Limits
 from mailman.testing.helpers import (
-    specialized_message_from_string as mfs, subscribe)
-from mailman.testing.layers import ConfigLayer
+    configuration, specialized_message_from_string as mfs, subscribe)
+from mailman.testing.layers import ConfigLayer, SMTPLayer
+from sqlalchemy import event
+from unittest.mock import patch
 
 
 
@@ -51,6 +63,27 @@ class DeliverTester(Deliver):
         return []
 
 
+class SlowBulkTester(BulkDelivery):
+    # Keep track of how many chunks are delivered at the same time, and
+    # refuse the recipients at example.net.
+    def __init__(self, *args):
+        super(SlowBulkTester, self).__init__(*args)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most_active = 0
+
+    def _deliver_to_recipients(self, mlist, msg, msgdata, recipients):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        return dict((recipient, (550, 'No such user'))
+                    for recipient in recipients
+                    if recipient.endswith('@example.net'))
+
+
 
 class TestIndividualDelivery(unittest.TestCase):
     """Test personalized delivery details."""
@@ -132,3 +165,277 @@ name     : Anne Person
 options  : http://example.com/anne@example.org
 
 """)
+
+    def _count_queries(self, recipients):
+        # Return the number of database statements executed delivering the
+        # message to the recipients.
+        statements = []
+        def count(*args):
+            statements.append(args)
+        event.listen(config.db.engine, 'before_cursor_execute', count)
+        try:
+            DeliverTester().deliver(
+                self._mlist, self._msg, dict(recipients=recipients))
+        finally:
+            event.remove(config.db.engine, 'before_cursor_execute', count)
+        return len(statements)
+
+    def test_prefetched_recipients(self):
+        # The recipients' members, users and preferences are looked up all
+        # at once, so the number of queries doesn't grow with the number of
+        # recipients.  The decorations still look up the list's domain.
+        self._mlist.personalize = Personalization.full
+        recipients = ['anne@example.org']
+        for name in ('Bart', 'Cris', 'Dave', 'Elle'):
+            email = '{}@example.org'.format(name.lower())
+            subscribe(self._mlist, name, email=email)
+            recipients.append(email)
+        config.db.commit()
+        # Reload the mailing list, which the commit expired.
+        self._mlist.list_id
+        self.assertEqual(self._count_queries(recipients[:1]),
+                         self._count_queries(recipients))
+        self.assertEqual(len(_deliveries), 6)
+        _mlist, _msg, _msgdata, _recipients = _deliveries[-1]
+        self.assertEqual(_msg['to'], 'Elle Person <elle@example.org>')
+        self.assertIn(b'name     : Elle Person', _msg.flattened())
+
+    def _deliver_both_ways(self, msgdata):
+        # Deliver the message from templates and by crafting every message,
+        # and return both sets of messages.
+        deliveries = []
+        for templated in (True, False):
+            del _deliveries[:]
+            agent = DeliverTester()
+            if not templated:
+                agent.slots.clear()
+            refused = agent.deliver(self._mlist, self._msg, msgdata.copy())
+            self.assertEqual(len(refused), 0)
+            deliveries.append(dict(
+                (_recipients[0], _msg)
+                for _mlist, _msg, _msgdata, _recipients in _deliveries))
+        return deliveries
+
+    def test_templated_delivery(self):
+        # Messages spliced together from a template are exactly the same as
+        # the ones crafted for every recipient.
+        self._mlist.personalize = Personalization.full
+        subscribe(self._mlist, 'Bart', email='bart@example.org')
+        msgdata = dict(recipients=['anne@example.org', 'bart@example.org',
+                                   'cris@example.org'],
+                       verp=True,
+                       **{'add-dup-header': {'bart@example.org': True}})
+        templated, crafted = self._deliver_both_ways(msgdata)
+        self.assertEqual(sorted(templated), sorted(crafted))
+        for recipient, msg in templated.items():
+            self.assertIsInstance(msg, LazyMessage)
+            self.assertEqual(msg.flattened(), crafted[recipient].flattened())
+        bart = templated['bart@example.org']
+        self.assertEqual(bart['to'], 'Bart Person <bart@example.org>')
+        self.assertEqual(bart['x-mailman-copy'], 'yes')
+        self.assertIn(b'name     : Bart Person', bart.flattened())
+        # Cris is not a member, so her footer is not filled in.
+        cris = templated['cris@example.org']
+        self.assertEqual(cris['to'], 'cris@example.org')
+        self.assertIsNone(cris['x-mailman-copy'])
+        self.assertIn(b'name     : $user_name', cris.flattened())
+
+    def test_unspliceable_values(self):
+        # Values which would have to be encoded are not spliced in, so those
+        # recipients get crafted messages.
+        subscribe(self._mlist, 'B\xe4rt', email='bart@example.org')
+        msgdata = dict(recipients=['anne@example.org', 'bart@example.org'])
+        templated, crafted = self._deliver_both_ways(msgdata)
+        self.assertIsInstance(templated['anne@example.org'], LazyMessage)
+        self.assertNotIsInstance(templated['bart@example.org'], LazyMessage)
+        for recipient, msg in templated.items():
+            self.assertEqual(msg.flattened(), crafted[recipient].flattened())
+
+    def test_encoded_decorations(self):
+        # The decorations of this message are base64 encoded, so it can't be
+        # templated.
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Content-Type: text/plain; charset="utf-8"
+Content-Transfer-Encoding: base64
+
+Q2Fmw6kK
+""")
+        msgdata = dict(recipients=['anne@example.org'])
+        templated, crafted = self._deliver_both_ways(msgdata)
+        msg = templated['anne@example.org']
+        self.assertNotIsInstance(msg, LazyMessage)
+        self.assertEqual(msg['content-transfer-encoding'], 'base64')
+        self.assertEqual(
+            msg.flattened(), crafted['anne@example.org'].flattened())
+
+
+
+
+class TestParallelBulkDelivery(unittest.TestCase):
+    """Test delivering the chunks of a bulk delivery in parallel."""
+
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Message-ID: <ant>
+
+""")
+        self._recipients = set(
+            'person{}@example.{}'.format(i, ('net' if i % 3 == 0 else 'org'))
+            for i in range(12))
+
+    def test_parallelism_cap(self):
+        agent = SlowBulkTester(2, 3)
+        refused = agent.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(agent.most_active, 3)
+        # The refused recipients of all the chunks are merged.
+        self.assertEqual(sorted(refused), [
+            'person0@example.net', 'person3@example.net',
+            'person6@example.net', 'person9@example.net',
+            ])
+        self.assertEqual(refused['person0@example.net'],
+                         (550, 'No such user'))
+
+    def test_no_threads(self):
+        agent = SlowBulkTester(2)
+        refused = agent.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(agent.most_active, 1)
+        self.assertEqual(len(refused), 4)
+
+    def test_destination_sessions(self):
+        # The chunks for a destination limited to one session at a time are
+        # delivered one after another, even with threads to spare.
+        destinations = Destinations(limits=[
+            (['example.net'], Limits('test_net', 0, 1)),
+            (['example.org'], Limits('test_org', 0, 1)),
+            ])
+        agent = SlowBulkTester(2, 3, destinations)
+        refused = agent.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(agent.most_active, 2)
+        self.assertEqual(len(refused), 4)
+
+    def test_parallel_delivery(self):
+        # Every chunk is delivered over one of the threads' connections.
+        agent = BulkDelivery(2, 3)
+        refused = agent.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(refused, {})
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 6)
+        delivered = set()
+        for message in messages:
+            delivered.update(message['x-rcptto'].split(', '))
+        self.assertEqual(delivered, self._recipients)
+        self.assertLessEqual(SMTPLayer.smtpd.get_connection_count(), 3)
+        # The threads' connections are closed afterward.
+        self.assertNotIsInstance(agent._connection, ConnectionPool)
+
+    def test_shared_pool(self):
+        # The threads use a shared connection pool, which limits the number
+        # of connections.
+        pool = ConnectionPool(
+            config.mta.smtp_host, int(config.mta.smtp_port), 0, size=1)
+        self.addCleanup(pool.quit)
+        with pool.shared():
+            agent = BulkDelivery(2, 3)
+        agent.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertIs(agent._connection, pool)
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 6)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
+
+    @configuration('mta', max_recipients=2)
+    def test_flattened_once(self):
+        # The message is flattened once for all the chunks and for logging
+        # its size.
+        del self._msg.original_size
+        with patch.object(Message, '_flatten',
+                          side_effect=Message._flatten,
+                          autospec=True) as flatten:
+            deliver(self._mlist, self._msg,
+                    dict(recipients=self._recipients))
+        self.assertEqual(flatten.call_count, 1)
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 6)
+
+
+
+
+class TestLineEndings(unittest.TestCase):
+    """Test that messages are sent with CRLF line endings."""
+
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        subscribe(self._mlist, 'Anne', email='anne@example.org')
+        subscribe(self._mlist, 'Bart', email='bart@example.org')
+        self._recipients = ['anne@example.org', 'bart@example.org']
+        self._template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._template_dir)
+        path = os.path.join(self._template_dir,
+                            'site', 'en', 'member-footer.txt')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            print('name: $user_name', file=fp)
+        config.push('templates', """
+        [paths.testing]
+        template_dir: {0}
+        """.format(self._template_dir))
+        self.addCleanup(config.pop, 'templates')
+        self._mlist.footer_uri = 'mailman:///member-footer.txt'
+
+    def _sent(self, msg, msgdata):
+        # Return the message bytes handed to the SMTP connection.
+        with patch.object(smtplib.SMTP, 'sendmail',
+                          side_effect=smtplib.SMTP.sendmail,
+                          autospec=True) as sendmail:
+            deliver(self._mlist, msg, msgdata)
+        self.assertGreater(sendmail.call_count, 0)
+        return [call[0][3] for call in sendmail.call_args_list]
+
+    def _assert_crlf(self, sent):
+        for data in sent:
+            self.assertIsInstance(data, bytes)
+            self.assertIsNone(re.search(b'[^\\r]\\n|\\r[^\\n]', data))
+            self.assertIn(b'\r\n\r\n', data)
+
+    def test_bulk_delivery(self):
+        msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+
+A message
+with lines.
+""")
+        self._assert_crlf(self._sent(
+            msg, dict(recipients=set(self._recipients))))
+
+    def test_templated_delivery(self):
+        # The recipients' messages are spliced together from a template, and
+        # the body of the message is never parsed.
+        self._mlist.personalize = Personalization.full
+        msg = LazyMessage.from_bytes(b"""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+
+A message\r
+with mixed
+line endings.
+""")
+        sent = self._sent(msg, dict(recipients=self._recipients, verp=True))
+        self.assertEqual(len(sent), 2)
+        self._assert_crlf(sent)
+        self.assertIn(b'name: Bart Person\r\n', sent[1])
@@ -0,0 +1,125 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test recipient destinations and their limits."""
+
+__all__ = [
+    'TestDestinations',
+    ]
+
+
+import unittest
+import threading
+
+from mailman.mta.destinations import Destinations, Limits
+from mailman.testing.helpers import configuration
+from mailman.testing.layers import ConfigLayer
+
+
+
+def resolver(domain):
+    # Pretend that example.net and example.org share a mail server.
+    if domain in ('example.net', 'example.org'):
+        return 'mx.example.net'
+    return domain
+
+
+
+class TestDestinations(unittest.TestCase):
+    """Test recipient destinations."""
+
+    layer = ConfigLayer
+
+    def test_domain(self):
+        # Without a resolver, the destination is the lower cased domain.
+        destinations = Destinations()
+        self.assertEqual(destinations.destination('anne@Example.COM'),
+                         'example.com')
+        self.assertEqual(destinations.limits('example.com'),
+                         Limits(None, 0, 0))
+
+    def test_resolver_is_cached(self):
+        # The resolver is only asked once about every domain.
+        calls = []
+        def counting_resolver(domain):
+            calls.append(domain)
+            return resolver(domain)
+        destinations = Destinations(counting_resolver)
+        for address in ('anne@example.org', 'bart@example.net',
+                        'cris@example.org', 'dave@example.com'):
+            destinations.destination(address)
+        self.assertEqual(calls, ['example.org', 'example.net', 'example.com'])
+        self.assertEqual(destinations.destination('elle@example.org'),
+                         'mx.example.net')
+
+    def test_limits(self):
+        # The first limits matching a destination apply.
+        limits = Limits('net', 10, 2)
+        destinations = Destinations(limits=[
+            (['*.net', 'example.org'], limits),
+            (['*'], Limits('rest', 20, 0)),
+            ])
+        self.assertEqual(destinations.limits('example.net'), limits)
+        self.assertEqual(destinations.limits('example.org'), limits)
+        self.assertEqual(destinations.limits('example.com').name, 'rest')
+
+    def test_limits_of_resolved_domain(self):
+        # The limits of a resolved destination can be given for one of its
+        # domains.
+        limits = Limits('org', 10, 2)
+        destinations = Destinations(resolver, [(['example.org'], limits)])
+        destinations.destination('anne@example.net')
+        destinations.destination('bart@example.org')
+        self.assertEqual(destinations.limits('mx.example.net'), limits)
+
+    @configuration('mta',
+                   destination_resolver=(
+                       'mailman.mta.tests.test_destinations.resolver'))
+    @configuration('destination.example',
+                   domains='mx.example.net example.com',
+                   max_recipients=10, max_sessions=2)
+    def test_from_config(self):
+        destinations = Destinations.from_config()
+        self.assertEqual(destinations.destination('anne@example.org'),
+                         'mx.example.net')
+        self.assertEqual(destinations.limits('mx.example.net'),
+                         Limits('example', 10, 2))
+        self.assertEqual(destinations.limits('example.com'),
+                         Limits('example', 10, 2))
+        self.assertEqual(destinations.limits('example.edu'),
+                         Limits(None, 0, 0))
+
+    def test_sessions(self):
+        # A session for a destination with a session limit waits until
+        # another session ends.
+        destinations = Destinations(limits=[
+            (['example.com'], Limits('test_sessions', 0, 1)),
+            ])
+        started = threading.Event()
+        def session():
+            with destinations.sessions(['example.com', 'example.org']):
+                started.set()
+        with destinations.sessions(['example.com']):
+            thread = threading.Thread(target=session)
+            thread.start()
+            self.assertFalse(started.wait(0.1))
+        thread.join()
+        self.assertTrue(started.is_set())
+        # Destinations without a session limit don't wait.
+        with destinations.sessions(['example.com']):
+            with destinations.sessions(['example.org']):
+                pass
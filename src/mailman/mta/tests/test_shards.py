@@ -0,0 +1,137 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test sharding the recipients of large postings."""
+
+__all__ = [
+    'TestShardedDelivery',
+    'TestSplitRecipients',
+    'TestTallyShard',
+    ]
+
+
+import os
+import time
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.handlers.to_outgoing import ToOutgoing
+from mailman.mta.shards import split_recipients, tally_shard
+from mailman.runners.outgoing import OutgoingRunner
+from mailman.testing.helpers import (
+    LogFileMark, configuration, get_queue_messages, make_testable_runner,
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer, SMTPLayer
+
+
+
+class TestSplitRecipients(unittest.TestCase):
+    """Test splitting recipients into shards."""
+
+    def test_even_shards(self):
+        recipients = ['anne@b.example.com', 'bart@a.example.com',
+                      'cris@b.example.com', 'dave@a.example.com',
+                      'elly@c.example.com']
+        # The recipients are grouped by domain.
+        self.assertEqual(
+            split_recipients(recipients, 2),
+            [{'bart@a.example.com', 'dave@a.example.com',
+              'anne@b.example.com'},
+             {'cris@b.example.com', 'elly@c.example.com'}])
+
+    def test_fewer_recipients_than_shards(self):
+        self.assertEqual(
+            split_recipients(['anne@example.com', 'bart@example.com'], 4),
+            [{'anne@example.com'}, {'bart@example.com'}])
+
+
+
+class TestTallyShard(unittest.TestCase):
+    """Test adding up the deliveries of shards."""
+
+    layer = ConfigLayer
+
+    def test_totals(self):
+        # Only the last shard gets the totals.
+        self.assertIsNone(tally_shard('posting', (1, 3), 1002, 1010, 10, 1))
+        self.assertIsNone(tally_shard('posting', (0, 3), 1000, 1005, 10, 0))
+        self.assertEqual(tally_shard('posting', (2, 3), 1001, 1008, 9, 2),
+                         dict(recipients=29, refused=3, time=10))
+        self.assertEqual(
+            os.listdir(os.path.join(config.DATA_DIR, 'shards')), [])
+
+    def test_forget(self):
+        # The tallies of postings which never complete are removed
+        # eventually.
+        tally_shard('incomplete', (0, 2), 1000, 1005, 10, 0)
+        tallies = os.path.join(config.DATA_DIR, 'shards')
+        old = time.time() - 2 * 86400
+        os.utime(os.path.join(tallies, 'incomplete'), (old, old))
+        tally_shard('complete', (0, 1), 1000, 1005, 10, 0)
+        self.assertEqual(os.listdir(tallies), [])
+
+
+
+class TestShardedDelivery(unittest.TestCase):
+    """Test the delivery of sharded postings."""
+
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._recipients = set(
+            '{0}@example.org'.format(name)
+            for name in ('anne', 'bart', 'cris', 'dave', 'elly'))
+
+    @configuration('mta', recipient_shards=2, shard_min_recipients=5)
+    def test_shards(self):
+        # A posting to at least shard_min_recipients recipients is split
+        # into shards, which are logged as one posting.
+        ToOutgoing().process(
+            self._mlist, self._msg,
+            dict(recipients=self._recipients, tolist=True))
+        self.assertEqual(len(config.switchboards['out'].files), 2)
+        mark = LogFileMark('mailman.smtp')
+        make_testable_runner(OutgoingRunner, 'out').run()
+        self.assertEqual(
+            sorted(len(message['x-rcptto'].split(','))
+                   for message in SMTPLayer.smtpd.messages),
+            [2, 3])
+        # The shared message is gone with the last shard.
+        self.assertEqual(
+            os.listdir(config.switchboards['out'].queue_directory), [])
+        lines = [line for line in mark.read().splitlines()
+                 if '<ant> smtp to test@example.com' in line]
+        self.assertEqual(len(lines), 1)
+        self.assertIn('for 5 recips', lines[0])
+
+    @configuration('mta', recipient_shards=2, shard_min_recipients=6)
+    def test_small_posting(self):
+        # Postings to fewer recipients are not split.
+        ToOutgoing().process(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        items = get_queue_messages('out')
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].msgdata['recipients'], self._recipients)
+        self.assertNotIn('shard', items[0].msgdata)
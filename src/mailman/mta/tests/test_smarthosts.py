@@ -0,0 +1,217 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test weighted smarthosts with failover."""
+
+__all__ = [
+    'TestSmarthostDelivery',
+    'TestSmarthosts',
+    ]
+
+
+import os
+import socket
+import unittest
+
+from mailman.config import config
+from mailman.mta.connection import Connection, ConnectionPool
+from mailman.mta.reports import read_reports, report_file, write_report
+from mailman.mta.smarthosts import Smarthost, Smarthosts
+from mailman.testing.helpers import configuration
+from mailman.testing.layers import ConfigLayer, SMTPLayer
+
+
+MESSAGE = """\
+From: anne@example.com
+To: bart@example.com
+Subject: aardvarks
+
+"""
+
+
+
+class Clock:
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+
+
+def closed_port():
+    # Return a local port nobody listens on.
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+
+class TestSmarthosts(unittest.TestCase):
+    """Test choosing smarthosts."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._clock = Clock()
+        self._smarthosts = Smarthosts(
+            [Smarthost('a.example.com', 25, 5),
+             Smarthost('b.example.com', 25, 1),
+             Smarthost('c.example.com', 25, 1)],
+            cool_off=60, clock=self._clock)
+        self._a, self._b, self._c = self._smarthosts.hosts
+
+    def _choose(self, count):
+        return ''.join(self._smarthosts.choose().host[0]
+                       for i in range(count))
+
+    def test_weighted_round_robin(self):
+        # Every smarthost gets its share of the connections, interleaved
+        # with the others.
+        self.assertEqual(self._choose(14), 'aabacaa' * 2)
+
+    def test_cool_off(self):
+        # A smarthost which failed is passed over until its cool-off period
+        # is over.
+        self._smarthosts.failed(self._a, OSError('Connection refused'))
+        self.assertEqual(self._choose(4), 'bcbc')
+        self._clock.time += 60
+        self.assertEqual(self._choose(7), 'aabacaa')
+        state = self._smarthosts.states()[0]
+        self.assertTrue(state['up'])
+        self.assertEqual(state['connect_errors'], 1)
+        self.assertEqual(state['last_error'], 'Connection refused')
+
+    def test_all_down(self):
+        # When all smarthosts are down, the one which has been down the
+        # longest is tried anyway.
+        self._smarthosts.failed(self._b, OSError('Oops'))
+        self._clock.time += 10
+        self._smarthosts.failed(self._a, OSError('Oops'))
+        self._smarthosts.failed(self._c, OSError('Oops'))
+        self.assertIs(self._smarthosts.choose(), self._b)
+        # Smarthosts can also be excluded, e.g. because they were just tried.
+        self.assertIs(self._smarthosts.choose([self._b]), self._a)
+        self.assertIsNone(self._smarthosts.choose(self._smarthosts.hosts))
+
+    def test_counters(self):
+        # Sessions and their recipients are counted per smarthost.
+        self._smarthosts.connected(self._b)
+        self._smarthosts.delivered(
+            self._b, ['anne@example.com', 'bart@example.com'], {}, 100)
+        self._smarthosts.delivered(
+            self._b, ['cris@example.com'],
+            {'cris@example.com': (450, 'Busy')}, 50)
+        self._smarthosts.failed(self._b, OSError('Reset'), connecting=False)
+        state = self._smarthosts.states()[1]
+        self.assertEqual(
+            [state[key] for key in ('connections', 'sessions', 'recipients',
+                                    'refused', 'bytes', 'session_errors',
+                                    'since')],
+            [1, 2, 3, 1, 150, 1, 1000.0])
+        self.assertEqual(state['down_until'], 1060.0)
+
+    def test_from_config(self):
+        # Without [smarthost.*] sections, the one smarthost is the
+        # configured SMTP host.
+        smarthosts = Smarthosts.from_config()
+        self.assertEqual([host.name for host in smarthosts.hosts],
+                         ['localhost:9025'])
+        # The same configuration gives the same smarthosts.
+        self.assertIs(Smarthosts.from_config(), smarthosts)
+
+    @configuration('smarthost.relay1', host='relay1.example.com', weight=3)
+    @configuration('smarthost.relay2', host='relay2.example.com', port=2525)
+    @configuration('smarthost.relay3', host='relay3.example.com', weight=0)
+    def test_configured_smarthosts(self):
+        # Smarthosts with a weight of 0 are not used.
+        smarthosts = Smarthosts.from_config()
+        self.assertEqual(
+            sorted((host.name, host.weight) for host in smarthosts.hosts),
+            [('relay1.example.com:25', 3), ('relay2.example.com:2525', 1)])
+
+    def test_reports(self):
+        # The reports of all the outgoing runners are read back together.
+        write_report(report_file('smarthosts', 1), self._smarthosts.states())
+        self.addCleanup(os.remove, report_file('smarthosts', 1))
+        other = Smarthosts([Smarthost('b.example.com', 25)])
+        write_report(report_file('smarthosts'), other.states())
+        self.addCleanup(os.remove, report_file('smarthosts'))
+        self.assertEqual(
+            [(state['name'], state['slice'])
+             for state in read_reports('smarthosts', 'name')],
+            [('a.example.com:25', 1), ('b.example.com:25', 0),
+             ('b.example.com:25', 1), ('c.example.com:25', 1)])
+
+
+
+class TestSmarthostDelivery(unittest.TestCase):
+    """Test delivering to smarthosts."""
+
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._smarthosts = Smarthosts(
+            [Smarthost('localhost', closed_port(), 10),
+             Smarthost(config.mta.smtp_host, int(config.mta.smtp_port))])
+        self._down, self._up = self._smarthosts.hosts
+
+    def test_failover(self):
+        # A smarthost which can't be connected to is marked down, and the
+        # connection is opened to the next one.
+        connection = Connection(None, None, 0, smarthosts=self._smarthosts)
+        self.addCleanup(connection.quit)
+        connection.sendmail(
+            'anne@example.com', ['bart@example.com'], MESSAGE)
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 1)
+        down, up = self._smarthosts.states()
+        self.assertFalse(down['up'])
+        self.assertEqual(down['connect_errors'], 1)
+        self.assertEqual(down['sessions'], 0)
+        self.assertTrue(up['up'])
+        self.assertEqual(up['connections'], 1)
+        self.assertEqual(up['sessions'], 1)
+        self.assertEqual(up['recipients'], 1)
+        self.assertEqual(up['bytes'], len(MESSAGE))
+        # The next connection doesn't try the smarthost which is down.
+        self.assertIs(self._smarthosts.choose(), self._up)
+
+    def test_all_down(self):
+        # When no smarthost can be connected to, the error is raised.
+        smarthosts = Smarthosts([Smarthost('localhost', closed_port())])
+        connection = Connection(None, None, 0, smarthosts=smarthosts)
+        with self.assertRaises(ConnectionRefusedError):
+            connection.sendmail(
+                'anne@example.com', ['bart@example.com'], MESSAGE)
+        self.assertFalse(smarthosts.states()[0]['up'])
+
+    def test_pool(self):
+        # The pool's connections are spread over the smarthosts.
+        smarthosts = Smarthosts(
+            [Smarthost(config.mta.smtp_host, int(config.mta.smtp_port)),
+             Smarthost('127.0.0.1', int(config.mta.smtp_port))])
+        pool = ConnectionPool(None, None, 0, size=2, smarthosts=smarthosts)
+        self.addCleanup(pool.quit)
+        # Check out two connections at the same time.
+        first = pool._checkout()
+        second = pool._checkout()
+        for connection in (first, second):
+            connection.sendmail(
+                'anne@example.com', ['bart@example.com'], MESSAGE)
+            pool._checkin(connection)
+        self.assertEqual(
+            [state['connections'] for state in smarthosts.states()], [1, 1])
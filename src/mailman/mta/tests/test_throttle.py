@@ -0,0 +1,257 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test adaptive delivery throttling."""
+
+__all__ = [
+    'TestDeliveryThrottle',
+    'TestThrottledDelivery',
+    ]
+
+
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.mta.bulk import BulkDelivery
+from mailman.mta.destinations import Destinations
+from mailman.mta.throttle import DeliveryThrottle
+from mailman.runners.outgoing import OutgoingRunner
+from mailman.testing.helpers import (
+    configuration, get_queue_messages, make_testable_runner,
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer, SMTPLayer
+from mailman.utilities.datetime import now
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: aardvarks
+Message-ID: <{}>
+
+"""
+
+
+
+class Clock:
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+
+
+class TestDeliveryThrottle(unittest.TestCase):
+    """Test the delivery throttle."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._clock = Clock()
+        self._throttle = DeliveryThrottle(
+            initial_rate=2, min_rate=0.5, max_rate=4, increase=1,
+            decrease=0.5, clock=self._clock)
+
+    def _state(self, destination):
+        for state in self._throttle.states():
+            if state['destination'] == destination:
+                return state
+        return None
+
+    def test_unthrottled(self):
+        # Destinations which never pushed back are not throttled.
+        recipients = ['anne@example.com', 'bart@example.com']
+        self._throttle.record(recipients, {}, 0.1)
+        self.assertEqual(self._throttle.admit(recipients * 10),
+                         (recipients * 10, [], None))
+        state = self._state('example.com')
+        self.assertFalse(state['throttled'])
+        self.assertEqual(state['delivered'], 2)
+
+    def test_deferral_throttles(self):
+        # A temporary failure throttles the recipient's destination, and
+        # only that destination.
+        self._throttle.record(
+            ['anne@example.com', 'bart@example.org'],
+            {'anne@example.com': (452, 'Too many recipients')}, 0.1)
+        admitted, delayed, delay = self._throttle.admit(
+            ['cris@example.com', 'dave@example.org'])
+        self.assertEqual(admitted, ['dave@example.org'])
+        self.assertEqual(delayed, ['cris@example.com'])
+        self.assertEqual(delay, 0.5)
+        state = self._state('example.com')
+        self.assertTrue(state['throttled'])
+        self.assertEqual(state['rate'], 2)
+        self.assertEqual(state['deferred'], 1)
+        self.assertEqual(state['deferral_ratio'], 0.2)
+        self.assertFalse(self._state('example.org')['throttled'])
+
+    def test_token_bucket(self):
+        # A throttled destination's recipients are admitted at its rate.
+        self._throttle.record(
+            ['anne@example.com'], {'anne@example.com': (421, 'Busy')}, 0.1)
+        recipients = ['bart@example.com', 'cris@example.com']
+        self._clock.time += 0.5
+        self.assertEqual(self._throttle.admit(recipients),
+                         (['bart@example.com'], ['cris@example.com'], 0.5))
+        # The bucket holds no more than a second's worth of tokens.
+        self._clock.time += 60
+        recipients.append('dave@example.com')
+        self.assertEqual(self._throttle.admit(recipients),
+                         (recipients[:2], recipients[2:], 0.5))
+
+    def test_multiplicative_decrease(self):
+        # Pushing back again divides the rate, down to the minimum rate.
+        refused = {'anne@example.com': (450, 'Greylisted')}
+        for rate in (2, 1, 0.5, 0.5):
+            self._throttle.record(['anne@example.com'], refused, 0.1)
+            self.assertEqual(self._state('example.com')['rate'], rate)
+
+    def test_additive_increase(self):
+        # Sessions without push back raise the rate, until the destination
+        # is no longer throttled.
+        self._throttle.record(
+            ['anne@example.com'], {'anne@example.com': (450, 'Busy')}, 0.1)
+        self._throttle.record(['anne@example.com'], {}, 0.1)
+        self.assertEqual(self._state('example.com')['rate'], 3)
+        self._throttle.record(['anne@example.com'], {}, 0.1)
+        state = self._state('example.com')
+        self.assertFalse(state['throttled'])
+        self.assertIsNone(state['rate'])
+        self.assertEqual(state['delivered'], 2)
+
+    def test_other_failures(self):
+        # Permanent failures, and failures to talk to the SMTP server at
+        # all, are not the destination pushing back.
+        self._throttle.record(
+            ['anne@example.com', 'bart@example.com'],
+            {'anne@example.com': (550, 'No such user'),
+             'bart@example.com': (444, 'Connection refused')}, 0.1)
+        state = self._state('example.com')
+        self.assertFalse(state['throttled'])
+        self.assertEqual(state['failed'], 2)
+        self.assertEqual(state['deferred'], 0)
+
+    def test_latency(self):
+        # Slow sessions count as push back when there is a latency limit.
+        self._throttle.record(['anne@example.com'], {}, 10)
+        self._throttle.record(['anne@example.com'], {}, 20)
+        state = self._state('example.com')
+        self.assertFalse(state['throttled'])
+        self.assertEqual(state['latency'], 12)
+        throttle = DeliveryThrottle(max_latency=5, clock=self._clock)
+        throttle.record(['anne@example.com'], {}, 1)
+        self.assertEqual(throttle.admit(['anne@example.com'])[1], [])
+        throttle.record(['anne@example.com'], {}, 10)
+        self.assertEqual(throttle.admit(['anne@example.com'])[1],
+                         ['anne@example.com'])
+
+    def test_destinations(self):
+        # Recipients are throttled by their destination, not their domain.
+        def resolver(domain):
+            return 'mx.example.net'
+        throttle = DeliveryThrottle(Destinations(resolver))
+        throttle.record(
+            ['anne@example.com'], {'anne@example.com': (421, 'Busy')}, 0.1)
+        self.assertEqual(throttle.admit(['bart@example.org'])[1],
+                         ['bart@example.org'])
+        self.assertEqual(throttle.states()[0]['destination'],
+                         'mx.example.net')
+
+    def test_expire(self):
+        # Unthrottled destinations are forgotten after an hour of disuse.
+        self._throttle.record(['anne@example.com'], {}, 0.1)
+        self._throttle.record(
+            ['bart@example.org'], {'bart@example.org': (421, 'Busy')}, 0.1)
+        self._clock.time += 3601
+        self._throttle.expire()
+        self.assertEqual([state['destination']
+                          for state in self._throttle.states()],
+                         ['example.org'])
+
+    def test_disabled(self):
+        # Throttling is disabled by default.
+        self.assertIsNone(DeliveryThrottle.from_config())
+
+    @configuration('mta', throttle_deliveries='yes')
+    def test_enabled(self):
+        self.assertIsInstance(DeliveryThrottle.from_config(), DeliveryThrottle)
+
+
+
+class TestThrottledDelivery(unittest.TestCase):
+    """Test throttling deliveries to the fake SMTP server."""
+
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+
+    def test_deliveries_are_recorded(self):
+        # Deliveries record the SMTP server's answers with the throttle
+        # which is shared in their thread.
+        throttle = DeliveryThrottle()
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 452))
+        with throttle.shared():
+            refused = BulkDelivery().deliver(
+                self._mlist, mfs(MESSAGE.format('first')),
+                dict(recipients=['anne@example.com']))
+            self.assertEqual(list(refused), ['anne@example.com'])
+            refused = BulkDelivery().deliver(
+                self._mlist, mfs(MESSAGE.format('second')),
+                dict(recipients=['bart@example.com', 'cris@example.org']))
+            self.assertEqual(refused, {})
+        states = throttle.states()
+        self.assertEqual(
+            [(state['destination'], state['rate'], state['delivered'],
+              state['deferred'])
+             for state in states],
+            [('example.com', 11, 1, 1), ('example.org', None, 1, 0)])
+        self.assertIsNotNone(states[0]['latency'])
+
+    @configuration('mta', throttle_deliveries='yes',
+                   throttle_initial_rate='0.1')
+    def test_outgoing_runner(self):
+        # Once a destination pushes back, the outgoing runner delays its
+        # recipients.
+        outq = config.switchboards['out']
+        outq.enqueue(mfs(MESSAGE.format('first')), listid='test.example.com',
+                     recipients=['anne@example.com'])
+        outq.enqueue(mfs(MESSAGE.format('second')), listid='test.example.com',
+                     recipients=['cris@example.com', 'dave@example.org'])
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 452))
+        runner = make_testable_runner(OutgoingRunner, 'out')
+        runner.run()
+        self.assertEqual(
+            sorted((str(message['message-id']), message['x-rcptto'])
+                   for message in SMTPLayer.smtpd.messages),
+            [('<second>', 'dave@example.org')])
+        retries = get_queue_messages('retry', sort_on='message-id')
+        self.assertEqual(len(retries), 2)
+        # The recipient which got the temporary failure is retried as
+        # usual.
+        self.assertEqual(retries[0].msgdata['recipients'],
+                         ['anne@example.com'])
+        self.assertEqual(retries[0].msgdata['retries'], 1)
+        # The throttled recipient waits for its turn.
+        self.assertEqual(retries[1].msgdata['recipients'],
+                         ['cris@example.com'])
+        self.assertGreater(retries[1].msgdata['deliver_after'], now())
+        self.assertNotIn('last_recip_count', retries[1].msgdata)
+        self.assertNotIn('retries', retries[1].msgdata)
@@ -0,0 +1,290 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Adaptive per-destination delivery throttling."""
+
+__all__ = [
+    'DeliveryThrottle',
+    ]
+
+
+import time
+import threading
+
+from contextlib import contextmanager
+from lazr.config import as_boolean, as_timedelta
+from mailman.config import config
+from mailman.mta.destinations import Destinations
+
+
+# How much weight the latest session gets in the moving averages.
+ALPHA = 0.2
+# Destinations which are not throttled are forgotten when nothing has been
+# delivered to them for this many seconds.
+FORGET_AFTER = 3600
+# The delivery throttle shared by the deliveries made in this thread.
+_shared = threading.local()
+
+
+
+def is_deferral(code):
+    """Is the SMTP code a destination pushing back?
+
+    Code 444 is used for failures to talk to the SMTP server at all, which
+    say nothing about the recipients' destination.
+    """
+    return 400 <= code < 500 and code != 444
+
+
+
+class _Destination:
+    """The delivery state of one destination."""
+
+    def __init__(self, name, now):
+        self.name = name
+        # The recipients per second delivered to this destination, or None
+        # when the destination is not throttled.
+        self.rate = None
+        self.tokens = 0.0
+        self.refilled = now
+        self.last_used = now
+        self.sessions = 0
+        self.delivered = 0
+        self.deferred = 0
+        self.failed = 0
+        self.deferral_ratio = 0.0
+        self.latency = None
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(max(self.rate, 1.0),
+                              self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def as_dict(self):
+        return dict(
+            destination=self.name,
+            throttled=self.rate is not None,
+            rate=self.rate,
+            sessions=self.sessions,
+            delivered=self.delivered,
+            deferred=self.deferred,
+            failed=self.failed,
+            deferral_ratio=self.deferral_ratio,
+            latency=self.latency,
+            last_used=self.last_used,
+            )
+
+
+
+class DeliveryThrottle:
+    """Slow down deliveries to destinations which push back.
+
+    Every destination starts out unthrottled.  When an SMTP session gets
+    temporary (4xx) failures for some of a destination's recipients, or
+    takes longer than the latency limit, the destination is throttled: its
+    rate is cut to the initial rate, or multiplied by the decrease factor if
+    it was already throttled.  Every session without push back raises the
+    rate by the increase, and the destination is unthrottled again when the
+    rate reaches the maximum rate.  A throttled destination's recipients are
+    admitted through a token bucket filled at its rate.
+    """
+
+    def __init__(self, destinations=None, initial_rate=10.0, min_rate=0.1,
+                 max_rate=100.0, increase=1.0, decrease=0.5, max_latency=0,
+                 clock=time.time):
+        """Create a delivery throttle.
+
+        :param destinations: The grouping of recipients by destination.
+            None groups recipients by their domain.
+        :type destinations: `Destinations`
+        :param initial_rate: The recipients per second a destination is
+            limited to when it first pushes back.
+        :type initial_rate: float
+        :param min_rate: The lowest rate a destination is limited to.
+        :type min_rate: float
+        :param max_rate: The rate at which a destination is unthrottled.
+        :type max_rate: float
+        :param increase: The recipients per second a session without push
+            back adds to the destination's rate.
+        :type increase: float
+        :param decrease: The factor the rate of a throttled destination is
+            multiplied by when it pushes back again.
+        :type decrease: float
+        :param max_latency: Sessions which take longer than this many
+            seconds count as push back.  Zero means they never do.
+        :type max_latency: float
+        :param clock: The function returning the current time in seconds.
+        :type clock: callable
+        """
+        assert 0 < min_rate <= initial_rate <= max_rate, (
+            'Bad throttle rates: {0}, {1}, {2}'.format(
+                min_rate, initial_rate, max_rate))
+        assert 0 < decrease < 1, 'Bad throttle decrease: {0}'.format(decrease)
+        self._destinations = (Destinations()
+                              if destinations is None
+                              else destinations)
+        self._initial_rate = initial_rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._increase = increase
+        self._decrease = decrease
+        self._max_latency = max_latency
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._states = {}
+
+    @classmethod
+    def from_config(cls):
+        """Create a delivery throttle from the `[mta]` configuration.
+
+        :return: The delivery throttle, or None if throttling is disabled.
+        :rtype: `DeliveryThrottle`
+        """
+        if not as_boolean(config.mta.throttle_deliveries):
+            return None
+        return cls(Destinations.from_config(),
+                   float(config.mta.throttle_initial_rate),
+                   float(config.mta.throttle_min_rate),
+                   float(config.mta.throttle_max_rate),
+                   float(config.mta.throttle_increase),
+                   float(config.mta.throttle_decrease),
+                   as_timedelta(
+                       config.mta.throttle_max_latency).total_seconds())
+
+    @staticmethod
+    def current():
+        """Return the throttle shared by deliveries in this thread."""
+        return getattr(_shared, 'throttle', None)
+
+    @contextmanager
+    def shared(self):
+        """Share this throttle with the deliveries made in this thread."""
+        outer = getattr(_shared, 'throttle', None)
+        _shared.throttle = self
+        try:
+            yield self
+        finally:
+            _shared.throttle = outer
+
+    def admit(self, recipients):
+        """Decide which recipients can be delivered to now.
+
+        :param recipients: The recipients of a message.
+        :type recipients: sequence of str
+        :return: The recipients which can be delivered to now, the
+            recipients which must wait, and the number of seconds until the
+            first of the waiting recipients can be admitted, or None if none
+            of them have to wait.
+        :rtype: 3-tuple of (list, list, float)
+        """
+        admitted = []
+        delayed = []
+        delay = None
+        with self._lock:
+            now = self._clock()
+            for recipient in recipients:
+                state = self._states.get(
+                    self._destinations.destination(recipient))
+                if state is None or state.rate is None:
+                    admitted.append(recipient)
+                    continue
+                state.refill(now)
+                if state.tokens >= 1:
+                    state.tokens -= 1
+                    admitted.append(recipient)
+                    continue
+                delayed.append(recipient)
+                wait = (1 - state.tokens) / state.rate
+                if delay is None or wait < delay:
+                    delay = wait
+        return admitted, delayed, delay
+
+    def record(self, recipients, refused, seconds):
+        """Record the outcome of an SMTP session.
+
+        :param recipients: The recipients the session delivered to.
+        :type recipients: sequence of str
+        :param refused: The refused recipients, as returned by
+            `smtplib.SMTP.sendmail()`.
+        :type refused: dictionary
+        :param seconds: How long the session took.
+        :type seconds: float
+        """
+        # destination -> [recipients, deferred, failed]
+        counts = {}
+        for recipient in recipients:
+            destination = self._destinations.destination(recipient)
+            count = counts.setdefault(destination, [0, 0, 0])
+            count[0] += 1
+            if recipient in refused:
+                if is_deferral(refused[recipient][0]):
+                    count[1] += 1
+                else:
+                    count[2] += 1
+        slow = 0 < self._max_latency < seconds
+        with self._lock:
+            now = self._clock()
+            for destination, (total, deferred, failed) in counts.items():
+                state = self._states.get(destination)
+                if state is None:
+                    state = self._states[destination] = _Destination(
+                        destination, now)
+                state.last_used = now
+                state.sessions += 1
+                state.delivered += total - deferred - failed
+                state.deferred += deferred
+                state.failed += failed
+                state.deferral_ratio += ALPHA * (
+                    deferred / total - state.deferral_ratio)
+                state.latency = (seconds
+                                 if state.latency is None
+                                 else state.latency + ALPHA * (
+                                     seconds - state.latency))
+                if deferred > 0 or slow:
+                    # Back off multiplicatively, and make the next recipient
+                    # wait for a fresh token.
+                    rate = (self._initial_rate
+                            if state.rate is None
+                            else state.rate * self._decrease)
+                    state.rate = max(self._min_rate, rate)
+                    state.tokens = 0.0
+                    state.refilled = now
+                elif state.rate is not None and total > failed:
+                    state.refill(now)
+                    state.rate += self._increase
+                    if state.rate >= self._max_rate:
+                        state.rate = None
+
+    def expire(self):
+        """Forget the unthrottled destinations which have not been used."""
+        with self._lock:
+            deadline = self._clock() - FORGET_AFTER
+            for destination, state in list(self._states.items()):
+                if state.rate is None and state.last_used < deadline:
+                    del self._states[destination]
+
+    def states(self):
+        """Return the state of all the destinations.
+
+        :return: The destinations' rates, counters and moving averages,
+            ordered by destination.
+        :rtype: list of dictionaries
+        """
+        with self._lock:
+            return [self._states[destination].as_dict()
+                    for destination in sorted(self._states)]
@@ -84,10 +84,19 @@ class VERPMixin:
         already received this message, as calculated by Message-ID.  See
         `AvoidDuplicates.py`_ for details.
         """
-        recipient = msgdata['recipient']
+        self.mark_copy(mlist, msg, msgdata, self.copy_values(mlist, msgdata))
+
+    def copy_values(self, mlist, msgdata):
+        """Return the recipient's values for `avoid_duplicates()`."""
+        if msgdata['recipient'] in msgdata.get('add-dup-header', {}):
+            return dict(copy='yes')
+        return {}
+
+    def mark_copy(self, mlist, msg, msgdata, values):
+        """Flag the message as a copy with the given values."""
         del msg['x-mailman-copy']
-        if recipient in msgdata.get('add-dup-header', {}):
-            msg['X-Mailman-Copy'] = 'yes'
+        if 'copy' in values:
+            msg['X-Mailman-Copy'] = values['copy']
 
 
 
@@ -98,3 +107,4 @@ class VERPDelivery(VERPMixin, IndividualDelivery):
         """See `IndividualDelivery`."""
         super(VERPDelivery, self).__init__()
         self.callbacks.append(self.avoid_duplicates)
+        self.slots[self.avoid_duplicates] = (self.copy_values, self.mark_copy)
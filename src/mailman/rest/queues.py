@@ -47,6 +47,7 @@ class _QueuesBase(CollectionMixin):
             directory=switchboard.queue_directory,
             count=len(files),
             files=files,
+            lanes=switchboard.lane_depths(),
             self_link=path_to('queues/{}'.format(name)),
             )
 
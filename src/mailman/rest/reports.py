@@ -0,0 +1,52 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""<api>/system/throttle, <api>/system/smarthosts, and
+<api>/system/backpressure."""
+
+__all__ = [
+    'DeliveryReport',
+    ]
+
+
+from mailman.mta.reports import read_reports
+from mailman.rest.helpers import CollectionMixin, etag, okay, paginate, path_to
+
+
+
+class DeliveryReport(CollectionMixin):
+    """The entries of a delivery report of all the runners of a kind."""
+
+    def __init__(self, name, key, runner='out'):
+        self._name = name
+        self._key = key
+        self._runner = runner
+
+    def _resource_as_dict(self, entry):
+        """See `CollectionMixin`."""
+        return entry
+
+    @paginate
+    def _get_collection(self, request):
+        """See `CollectionMixin`."""
+        return read_reports(self._name, self._key, self._runner)
+
+    def on_get(self, request, response):
+        """<api>/system/<report>"""
+        resource = self._make_collection(request)
+        resource['self_link'] = path_to('system/{0}'.format(self._name))
+        okay(response, etag(resource))
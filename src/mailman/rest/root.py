@@ -38,6 +38,7 @@ from mailman.rest.lists import AList, AllLists, Styles
 from mailman.rest.members import AMember, AllMembers, FindMembers
 from mailman.rest.preferences import ReadOnlyPreferences
 from mailman.rest.queues import AQueue, AQueueFile, AllQueues
+from mailman.rest.reports import DeliveryReport
 from mailman.rest.templates import TemplateFinder
 from mailman.rest.users import AUser, AllUsers
 from zope.component import getUtility
@@ -154,6 +155,18 @@ class TopLevel:
             if len(segments) <= 2:
                 return SystemConfiguration(*segments[1:]), []
             return BadRequest(), []
+        elif segments[0] == 'throttle':
+            if len(segments) > 1:
+                return BadRequest(), []
+            return DeliveryReport('throttle', 'destination'), []
+        elif segments[0] == 'smarthosts':
+            if len(segments) > 1:
+                return BadRequest(), []
+            return DeliveryReport('smarthosts', 'name'), []
+        elif segments[0] == 'backpressure':
+            if len(segments) > 1:
+                return BadRequest(), []
+            return DeliveryReport('backpressure', 'queue', 'lmtp'), []
         else:
             return NotFound(), []
 
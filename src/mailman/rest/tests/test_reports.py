@@ -0,0 +1,138 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the delivery report resources."""
+
+__all__ = [
+    'TestBackPressure',
+    'TestSmarthosts',
+    'TestThrottle',
+    ]
+
+
+import os
+import unittest
+
+from mailman.mta.backpressure import BackPressure
+from mailman.mta.reports import report_file, write_report
+from mailman.mta.smarthosts import Smarthost, Smarthosts
+from mailman.mta.throttle import DeliveryThrottle
+from mailman.testing.helpers import call_api
+from mailman.testing.layers import RESTLayer
+from urllib.error import HTTPError
+
+
+
+class TestThrottle(unittest.TestCase):
+    layer = RESTLayer
+
+    def test_no_throttles(self):
+        # Without running outgoing runners, there is nothing to report.
+        json, response = call_api('http://localhost:9001/3.0/system/throttle')
+        self.assertEqual(json['total_size'], 0)
+        self.assertEqual(json['self_link'],
+                         'http://localhost:9001/3.0/system/throttle')
+
+    def test_throttles(self):
+        # The states saved by the outgoing runners are reported.
+        throttle = DeliveryThrottle()
+        throttle.record(
+            ['anne@example.com', 'bart@example.org'],
+            {'anne@example.com': (452, 'Too many recipients')}, 0.5)
+        write_report(report_file('throttle', 2), throttle.states())
+        self.addCleanup(os.remove, report_file('throttle', 2))
+        json, response = call_api('http://localhost:9001/3.0/system/throttle')
+        self.assertEqual(json['total_size'], 2)
+        com, org = json['entries']
+        self.assertEqual(com['destination'], 'example.com')
+        self.assertEqual(com['slice'], 2)
+        self.assertTrue(com['throttled'])
+        self.assertEqual(com['rate'], 10)
+        self.assertEqual(com['deferred'], 1)
+        self.assertEqual(com['latency'], 0.5)
+        self.assertEqual(org['destination'], 'example.org')
+        self.assertFalse(org['throttled'])
+        self.assertIsNone(org['rate'])
+        self.assertEqual(org['delivered'], 1)
+
+    def test_bad_path(self):
+        with self.assertRaises(HTTPError) as cm:
+            call_api('http://localhost:9001/3.0/system/throttle/example.com')
+        self.assertEqual(cm.exception.code, 400)
+
+
+
+class TestSmarthosts(unittest.TestCase):
+    layer = RESTLayer
+
+    def test_smarthosts(self):
+        # The smarthost counters saved by the outgoing runners are reported.
+        smarthosts = Smarthosts([Smarthost('relay1.example.com', 25, 2),
+                                 Smarthost('relay2.example.com', 2525)])
+        relay1, relay2 = smarthosts.hosts
+        smarthosts.connected(relay1)
+        smarthosts.delivered(relay1, ['anne@example.com', 'bart@example.com'],
+                             {'bart@example.com': (550, 'No such user')}, 100)
+        smarthosts.failed(relay2, OSError('Connection refused'))
+        write_report(report_file('smarthosts'), smarthosts.states())
+        self.addCleanup(os.remove, report_file('smarthosts'))
+        json, response = call_api(
+            'http://localhost:9001/3.0/system/smarthosts')
+        self.assertEqual(json['total_size'], 2)
+        self.assertEqual(json['self_link'],
+                         'http://localhost:9001/3.0/system/smarthosts')
+        first, second = json['entries']
+        self.assertEqual(first['name'], 'relay1.example.com:25')
+        self.assertEqual(first['slice'], 0)
+        self.assertEqual(first['weight'], 2)
+        self.assertTrue(first['up'])
+        self.assertEqual(first['connections'], 1)
+        self.assertEqual(first['sessions'], 1)
+        self.assertEqual(first['recipients'], 2)
+        self.assertEqual(first['refused'], 1)
+        self.assertEqual(first['bytes'], 100)
+        self.assertEqual(second['name'], 'relay2.example.com:2525')
+        self.assertFalse(second['up'])
+        self.assertEqual(second['connect_errors'], 1)
+        self.assertEqual(second['last_error'], 'Connection refused')
+
+
+
+class TestBackPressure(unittest.TestCase):
+    layer = RESTLayer
+
+    def test_back_pressure(self):
+        # The state of the queues saved by the LMTP runner is reported.
+        class Switchboard:
+            name = 'in'
+            def backlog(self):
+                return 3, None
+        pressure = BackPressure([Switchboard()], 3, 1)
+        pressure.check()
+        path = report_file('backpressure', runner='lmtp')
+        write_report(path, pressure.states())
+        self.addCleanup(os.remove, path)
+        json, response = call_api(
+            'http://localhost:9001/3.0/system/backpressure')
+        self.assertEqual(json['total_size'], 1)
+        self.assertEqual(json['self_link'],
+                         'http://localhost:9001/3.0/system/backpressure')
+        entry = json['entries'][0]
+        self.assertEqual(entry['queue'], 'in')
+        self.assertEqual(entry['depth'], 3)
+        self.assertEqual(entry['age'], 0)
+        self.assertTrue(entry['rejecting'])
@@ -103,6 +103,7 @@ class TestSystemConfiguration(unittest.TestCase):
             'archiver.prototype',
             'bounces',
             'database',
+            'destination.master',
             'devmode',
             'digests',
             'language.ar',
@@ -182,6 +183,7 @@ class TestSystemConfiguration(unittest.TestCase):
             'runner.shunt',
             'runner.virgin',
             'shell',
+            'smarthost.master',
             'styles',
             'webservice',
             ])
@@ -374,13 +374,16 @@ class DigestRunner(Runner):
                 raise AssertionError(
                     'OLD recipient "{0}" unexpected delivery mode: {1}'.format(
                         address, delivery_mode))
-        # Send the digests to the virgin queue for final delivery.
+        # Send the digests to the virgin queue for final delivery.  They are
+        # bulk traffic, so let other messages go ahead of them.
         queue = config.switchboards['virgin']
         queue.enqueue(mime,
                       recipients=mime_recipients,
                       listid=mlist.list_id,
-                      isdigest=True)
+                      isdigest=True,
+                      priority='low')
         queue.enqueue(rfc1153,
                       recipients=rfc1153_recipients,
                       listid=mlist.list_id,
-                      isdigest=True)
+                      isdigest=True,
+                      priority='low')
@@ -24,14 +24,19 @@ Most mail servers can be configured to deliver local messages via 'LMTP'[1].
 This module is actually an LMTP server rather than a standard runner.
 
 The LMTP runner opens a local TCP port and waits for the mail server to
-connect to it.  The messages it receives over LMTP are very minimally parsed
-for sanity and if they look okay, they are accepted and injected into
-Mailman's incoming queue for normal processing.  If they don't look good, or
-are destined for a bogus sub-address, they are rejected right away, hopefully
-so that the peer mail server can provide better diagnostics.
+connect to it.  It is an asyncio server, which serves many sessions at the
+same time and supports pipelining[2].  The messages are processed in worker
+threads, so that a slow database doesn't stall the other sessions.  The
+messages it receives over LMTP are very minimally parsed for sanity and if
+they look okay, they are accepted and injected into Mailman's incoming queue
+for normal processing.  If they don't look good, or are destined for a bogus
+sub-address, they are rejected right away, hopefully so that the peer mail
+server can provide better diagnostics.
 
 [1] RFC 2033 Local Mail Transport Protocol
     http://www.faqs.org/rfcs/rfc2033.html
+[2] RFC 2920 SMTP Service Extension for Command Pipelining
+    http://www.faqs.org/rfcs/rfc2920.html
 """
 
 __all__ = [
@@ -39,17 +44,23 @@ __all__ = [
     ]
 
 
+import os
 import email
-import smtpd
+import socket
+import asyncio
 import logging
-import asyncore
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from email.utils import parseaddr
+from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from mailman.core.runner import Runner
-from mailman.database.transaction import transactional
-from mailman.email.message import Message
-from mailman.interfaces.listmanager import IListManager
+from mailman.database.transaction import transaction, transactional
+from mailman.email.message import LazyMessage, Message
+from mailman.interfaces.listmanager import IListIndex
+from mailman.mta.backpressure import BackPressure
+from mailman.mta.reports import report_file, write_report
 from mailman.utilities.datetime import now
 from mailman.utilities.email import add_message_hash
 from zope.component import getUtility
@@ -87,15 +98,33 @@ SUBADDRESS_QUEUES = dict(
     )
 
 DASH    = '-'
-CRLF    = '\r\n'
+ERR_421_BUSY = '421 {0} Too many sessions, closing connection'
+ERR_421_TIMEOUT = '421 {0} Timeout, closing connection'
 ERR_451 = '451 Requested action aborted: error in processing'
+ERR_451_AGE = '451 4.3.2 Queues are backed up, try again later'
+ERR_452 = '452 4.3.1 Insufficient system storage, try again later'
+ERR_500 = '500 Error: command "{0}" not recognized'
+ERR_500_LINE = '500 Error: line too long'
 ERR_501 = '501 Message has defects'
+ERR_501_LHLO = '501 Syntax: LHLO hostname'
+ERR_501_MAIL = '501 Syntax: MAIL FROM: <address>'
+ERR_501_RCPT = '501 Syntax: RCPT TO: <address>'
 ERR_502 = '502 Error: command HELO not implemented'
+ERR_503_LHLO = '503 Error: send LHLO first'
+ERR_503_MAIL = '503 Error: need MAIL command'
+ERR_503_NESTED = '503 Error: nested MAIL command'
+ERR_503_RCPT = '503 Error: need RCPT command'
 ERR_550 = '550 Requested action not taken: mailbox unavailable'
 ERR_550_MID = '550 No Message-ID header provided'
+ERR_552 = '552 Error: Too much mail data'
 
-# XXX Blech
-smtpd.__version__ = 'Python LMTP runner 1.0'
+VERSION = 'Python LMTP runner 1.0'
+# The longest line accepted, in bytes, and the most mail data.
+MAX_LINE = 65536
+MAX_DATA = 33554432
+# Stop reading from a client which has pipelined this many lines ahead, and
+# resume once they're down to the half.
+MAX_PENDING_LINES = 10000
 
 
 
@@ -127,73 +156,345 @@ def split_recipient(address):
 
 
 
-class Channel(smtpd.SMTPChannel):
-    """An LMTP channel."""
+class Channel(asyncio.Protocol):
+    """An LMTP session with one client."""
 
-    def __init__(self, server, conn, addr):
-        smtpd.SMTPChannel.__init__(self, server, conn, addr)
-        # Stash this here since the subclass uses private attributes. :(
+    def __init__(self, server):
         self._server = server
+        self._transport = None
+        self._peer = None
+        # The lines received from the client and not yet read, with None in
+        # place of lines which were too long.
+        self._lines = deque()
+        self._partial = b''
+        self._overlong = False
+        self._paused = False
+        self._arrived = asyncio.Event()
+        self._closed = False
+        # The replies which haven't been sent yet.
+        self._replies = []
+        self._greeted = False
+        self._mailfrom = None
+        self._rcpttos = []
+        # The processing of the current message, while it is going on.
+        self.processing = None
+        self.task = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._peer = transport.get_extra_info('peername')
+        server = self._server
+        if len(server.channels) >= server.max_sessions:
+            slog.error('LMTP too many sessions, rejecting %s', self._peer)
+            transport.write(
+                ERR_421_BUSY.format(server.fqdn).encode('ascii') + b'\r\n')
+            transport.close()
+            return
+        slog.debug('LMTP accept from %s', self._peer)
+        server.channels.add(self)
+        self._reply('220 {0} {1}'.format(server.fqdn, VERSION))
+        self.task = asyncio.ensure_future(self._serve())
+
+    def data_received(self, data):
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        if self._overlong and len(lines) > 0:
+            # The rest of a line whose beginning was dropped.
+            lines[0] = None
+            self._overlong = False
+        self._lines.extend(lines)
+        if len(self._partial) > MAX_LINE:
+            self._partial = b''
+            self._overlong = True
+        if len(self._lines) > MAX_PENDING_LINES and not self._paused:
+            self._transport.pause_reading()
+            self._paused = True
+        self._arrived.set()
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self._arrived.set()
+
+    def close(self):
+        """Close the session."""
+        self._flush()
+        self._transport.close()
+
+    def _reply(self, reply):
+        self._replies.append(reply.encode('utf-8') + b'\r\n')
+
+    def _flush(self):
+        if len(self._replies) > 0 and not self._transport.is_closing():
+            self._transport.write(b''.join(self._replies))
+        self._replies = []
+
+    async def _readline(self):
+        while len(self._lines) == 0:
+            # Only send the replies once the client waits for them, so that
+            # the replies to pipelined commands go out together.
+            self._flush()
+            if self._closed:
+                raise ConnectionResetError
+            self._arrived.clear()
+            await asyncio.wait_for(self._arrived.wait(), self._server.timeout)
+        line = self._lines.popleft()
+        if self._paused and len(self._lines) < MAX_PENDING_LINES // 2:
+            self._transport.resume_reading()
+            self._paused = False
+        if line is not None and line.endswith(b'\r'):
+            line = line[:-1]
+        return line
+
+    async def _serve(self):
+        try:
+            while not self._closed:
+                line = await self._readline()
+                if line is None:
+                    self._reply(ERR_500_LINE)
+                    continue
+                command, space, arg = line.decode(
+                    'utf-8', 'replace').strip().partition(' ')
+                method = getattr(self, 'lmtp_' + command.upper(), None)
+                if method is None:
+                    self._reply(ERR_500.format(command))
+                else:
+                    await method(arg.strip())
+        except asyncio.TimeoutError:
+            slog.error('LMTP session with %s timed out', self._peer)
+            self._reply(ERR_421_TIMEOUT.format(self._server.fqdn))
+            self.close()
+        except ConnectionResetError:
+            pass
+        except Exception:
+            elog.exception('LMTP session with %s', self._peer)
+            self.close()
+        finally:
+            self._server.channels.discard(self)
 
-    def smtp_LHLO(self, arg):
-        """The LMTP greeting, used instead of HELO/EHLO."""
-        smtpd.SMTPChannel.smtp_HELO(self, arg)
+    def _reset(self):
+        self._mailfrom = None
+        self._rcpttos = []
 
-    def smtp_HELO(self, arg):
+    async def lmtp_LHLO(self, arg):
+        """The LMTP greeting, used instead of HELO/EHLO."""
+        if not arg:
+            self._reply(ERR_501_LHLO)
+            return
+        self._reset()
+        self._greeted = True
+        for extension in (self._server.fqdn, 'PIPELINING'):
+            self._reply('250-' + extension)
+        self._reply('250 8BITMIME')
+
+    async def lmtp_HELO(self, arg):
         """HELO is not a valid LMTP command."""
-        self.push(ERR_502)
+        self._reply(ERR_502)
+
+    async def lmtp_MAIL(self, arg):
+        if not self._greeted:
+            self._reply(ERR_503_LHLO)
+        elif self._mailfrom is not None:
+            self._reply(ERR_503_NESTED)
+        else:
+            address = _get_address('FROM:', arg)
+            reason = self._server.check_back_pressure()
+            if address is None:
+                self._reply(ERR_501_MAIL)
+            elif reason is not None:
+                # The MTA holds on to the mail and tries again later.
+                self._reply(ERR_452 if reason == 'depth' else ERR_451_AGE)
+            else:
+                self._mailfrom = address
+                self._reply('250 OK')
+
+    async def lmtp_RCPT(self, arg):
+        if self._mailfrom is None:
+            self._reply(ERR_503_MAIL)
+        else:
+            address = _get_address('TO:', arg)
+            if not address:
+                self._reply(ERR_501_RCPT)
+            else:
+                self._rcpttos.append(address)
+                self._reply('250 OK')
+
+    async def lmtp_DATA(self, arg):
+        if len(self._rcpttos) == 0:
+            self._reply(ERR_503_RCPT)
+            return
+        self._reply('354 End data with <CR><LF>.<CR><LF>')
+        lines = []
+        size = 0
+        too_much = False
+        while True:
+            line = await self._readline()
+            if line == b'.':
+                break
+            if line is None or too_much:
+                too_much = True
+                continue
+            if line.startswith(b'.'):
+                line = line[1:]
+            size += len(line) + 1
+            if size > MAX_DATA:
+                too_much = True
+                continue
+            lines.append(line)
+        mailfrom, rcpttos = self._mailfrom, self._rcpttos
+        self._reset()
+        if too_much:
+            for to in rcpttos:
+                self._reply(ERR_552)
+            return
+        # The message is processed in a worker thread, with a database
+        # transaction of its own.
+        loop = asyncio.get_event_loop()
+        self.processing = loop.run_in_executor(
+            self._server.executor, self._server.process_message,
+            self._peer, mailfrom, rcpttos, b'\n'.join(lines))
+        try:
+            status = await self.processing
+        except Exception:
+            elog.exception('LMTP message processing')
+            status = [ERR_451 for to in rcpttos]
+        finally:
+            self.processing = None
+        # RFC 2033 requires a status code for every recipient.
+        for reply in status:
+            self._reply(reply)
+
+    async def lmtp_RSET(self, arg):
+        self._reset()
+        self._reply('250 OK')
+
+    async def lmtp_NOOP(self, arg):
+        self._reply('250 OK')
+
+    async def lmtp_QUIT(self, arg):
+        self._reply('221 Bye')
+        self.close()
 
-    ## def push(self, arg):
-    ##     import pdb; pdb.set_trace()
-    ##     return super().push(arg)
 
 
-
-class LMTPRunner(Runner, smtpd.SMTPServer):
-    # Only __init__ is called on startup. Asyncore is responsible for later
-    # connections from the MTA.  slice and numslices are ignored and are
-    # necessary only to satisfy the API.
+def _get_address(keyword, arg):
+    # Return the address of a MAIL FROM: or RCPT TO: argument, without any
+    # parameters, or None if the argument is bad.
+    if arg[:len(keyword)].upper() != keyword:
+        return None
+    address = arg[len(keyword):].strip()
+    if address.startswith('<'):
+        address, bracket, parameters = address[1:].partition('>')
+        if not bracket:
+            return None
+        return address
+    return address.split(' ', 1)[0]
+
+
+
+class LMTPRunner(Runner):
+    # Only __init__ is called on startup.  The asyncio event loop is
+    # responsible for later connections from the MTA.  slice and numslices
+    # are ignored and are necessary only to satisfy the API.
 
     is_queue_runner = False
 
     def __init__(self, name, slice=None):
-        localaddr = config.mta.lmtp_host, int(config.mta.lmtp_port)
-        # Do not call Runner's constructor because there's no QDIR to create
-        qlog.debug('LMTP server listening on %s:%s',
-                   localaddr[0], localaddr[1])
-        smtpd.SMTPServer.__init__(self, localaddr, remoteaddr=None)
         super(LMTPRunner, self).__init__(name, slice)
-
-    def handle_accept(self):
-        conn, addr = self.accept()
-        Channel(self, conn, addr)
-        slog.debug('LMTP accept from %s', addr)
+        self.fqdn = socket.getfqdn()
+        # More sessions than this are turned away.
+        self.max_sessions = int(config.mta.lmtp_max_sessions)
+        # Sessions which don't send anything for this long are closed.
+        timeout = as_timedelta(config.mta.lmtp_timeout).total_seconds()
+        self.timeout = (None if timeout == 0 else timeout)
+        # Unless the whole message is parsed, its body is passed through to
+        # the queue untouched.
+        self.parse_body = as_boolean(config.mta.lmtp_parse_body)
+        self.channels = set()
+        # The runner's concurrency is the number of messages it processes at
+        # the same time.
+        self.executor = None
+        self._loop = None
+        self._server = None
+        # While the queues are backed up, incoming mail is rejected, unless
+        # back pressure is disabled.  Its state is saved for the REST API.
+        self.back_pressure = BackPressure.from_config()
+        self._report = report_file('backpressure', runner='lmtp')
+        self._last_report = None
+        self._reporting = None
+
+    def check_back_pressure(self):
+        """Check whether the queues are too backed up for more mail.
+
+        :return: The reason incoming mail must be rejected, i.e. `depth` or
+            `age`, or None if it is accepted.
+        :rtype: str or None
+        """
+        if self.back_pressure is None:
+            return None
+        rejecting = self.back_pressure.rejecting
+        reason = self.back_pressure.check()
+        if reason != rejecting:
+            if reason is None:
+                qlog.info('LMTP accepting incoming mail again')
+            else:
+                qlog.warning('LMTP rejecting incoming mail, queue %s', reason)
+        entries = self.back_pressure.states()
+        if entries != self._last_report:
+            write_report(self._report, entries)
+            self._last_report = entries
+        return reason
+
+    def _report_back_pressure(self):
+        # Keep the report up to date, even when no mail arrives.
+        self.check_back_pressure()
+        self._reporting = self._loop.call_later(
+            max(self.back_pressure.interval, 1), self._report_back_pressure)
 
     @transactional
     def process_message(self, peer, mailfrom, rcpttos, data):
+        """Process a message received over LMTP.
+
+        This is called in one of the runner's worker threads.
+
+        :param peer: The address of the client.
+        :param mailfrom: The envelope sender.
+        :type mailfrom: str
+        :param rcpttos: The envelope recipients.
+        :type rcpttos: list of str
+        :param data: The message.
+        :type data: bytes
+        :return: The status of every recipient.
+        :rtype: list of str
+        """
         try:
-            # Refresh the list of list names every time we process a message
-            # since the set of mailing lists could have changed.
-            listnames = set(getUtility(IListManager).names)
+            # The index notices mailing lists that were created or deleted
+            # since the last message, without querying the database.
+            list_index = getUtility(IListIndex)
             # Parse the message data.  If there are any defects in the
-            # message, reject it right away; it's probably spam.
-            msg = email.message_from_string(data, Message)
+            # message, reject it right away; it's probably spam.  Usually
+            # only the headers are parsed, and the body is parsed when a
+            # handler needs it.  Its defects are not found until then.
+            if self.parse_body:
+                msg = email.message_from_bytes(data, Message)
+            else:
+                msg = LazyMessage.from_bytes(data)
         except Exception:
             elog.exception('LMTP message parsing')
             config.db.abort()
-            return CRLF.join(ERR_451 for to in rcpttos)
+            return [ERR_451 for to in rcpttos]
         # Do basic post-processing of the message, checking it for defects or
         # other missing information.
         message_id = msg.get('message-id')
         if message_id is None:
-            return ERR_550_MID
+            return [ERR_550_MID for to in rcpttos]
         if msg.defects:
-            return ERR_501
+            return [ERR_501 for to in rcpttos]
         msg.original_size = len(data)
         add_message_hash(msg)
         msg['X-MailFrom'] = mailfrom
         # RFC 2033 requires us to return a status code for every recipient.
         status = []
+        queues = set()
         # Now for each address in the recipients, parse the address to first
         # see if it's destined for a valid mailing list.  If so, then queue
         # the message to the appropriate place and record a 250 status for
@@ -205,11 +506,10 @@ class LMTPRunner(Runner, smtpd.SMTPServer):
                 local, subaddress, domain = split_recipient(to)
                 slog.debug('%s to: %s, list: %s, sub: %s, dom: %s',
                            message_id, to, local, subaddress, domain)
-                listname = '{}@{}'.format(local, domain)
-                if listname not in listnames:
+                listid = '{}.{}'.format(local, domain)
+                if not list_index.exists(listid):
                     status.append(ERR_550)
                     continue
-                listid = '{}.{}'.format(local, domain)
                 # The recipient is a valid mailing list.  Find the subaddress
                 # if there is one, and set things up to enqueue to the proper
                 # queue.
@@ -242,6 +542,7 @@ class LMTPRunner(Runner, smtpd.SMTPServer):
                 # a success status for this recipient.
                 if queue is not None:
                     config.switchboards[queue].enqueue(msg, msgdata)
+                    queues.add(queue)
                     slog.debug('%s subaddress: %s, queue: %s',
                                message_id, canonical_subaddress, queue)
                     status.append('250 Ok')
@@ -249,16 +550,61 @@ class LMTPRunner(Runner, smtpd.SMTPServer):
                 slog.exception('Queue detection: %s', msg['message-id'])
                 config.db.abort()
                 status.append(ERR_550)
-        # All done; returning this big status string should give the expected
-        # response to the LMTP client.
-        return CRLF.join(status)
+        # Queues with batched durability must not accept responsibility for
+        # the message before it is on disk.
+        for queue in queues:
+            config.switchboards[queue].sync()
+        # All done; the server replies with every recipient's status.
+        return status
 
     def run(self):
         """See `IRunner`."""
-        asyncore.loop()
+        localaddr = config.mta.lmtp_host, int(config.mta.lmtp_port)
+        # Seed the list index before the first message arrives.
+        with transaction():
+            getUtility(IListIndex).load()
+        self._loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.executor = ThreadPoolExecutor(self.concurrency)
+        try:
+            self._server = loop.run_until_complete(loop.create_server(
+                lambda: Channel(self), localaddr[0], localaddr[1],
+                reuse_address=True))
+            qlog.debug('LMTP server listening on %s:%s',
+                       localaddr[0], localaddr[1])
+            if self.back_pressure is not None:
+                self._report_back_pressure()
+            if not self._stop:
+                loop.run_forever()
+            loop.run_until_complete(self._shut_down())
+        finally:
+            self.executor.shutdown()
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    async def _shut_down(self):
+        self._server.close()
+        if self._reporting is not None:
+            self._reporting.cancel()
+            try:
+                os.remove(self._report)
+            except FileNotFoundError:
+                pass
+        # Give the messages being processed a chance to get their replies
+        # out, so that the MTA doesn't deliver them again.
+        processing = [channel.processing for channel in self.channels
+                      if channel.processing is not None]
+        if len(processing) > 0:
+            await asyncio.wait(processing, timeout=self.timeout)
+        tasks = [channel.task for channel in self.channels]
+        for channel in list(self.channels):
+            channel.close()
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+        await self._server.wait_closed()
 
     def stop(self):
         """See `IRunner`."""
-        asyncore.socket_map.clear()
-        asyncore.close_all()
-        self.close()
+        super(LMTPRunner, self).stop()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
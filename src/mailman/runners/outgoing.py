@@ -22,10 +22,13 @@ __all__ = [
     ]
 
 
+import os
+import time
 import socket
 import logging
 
-from datetime import datetime
+from contextlib import ExitStack
+from datetime import datetime, timedelta
 from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from mailman.core.runner import Runner
@@ -34,6 +37,10 @@ from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.mta import SomeRecipientsFailed
 from mailman.interfaces.pending import IPendings
 from mailman.interfaces.subscriptions import ISubscriptionService
+from mailman.mta.connection import ConnectionPool
+from mailman.mta.reports import report_file, write_report
+from mailman.mta.smarthosts import Smarthosts
+from mailman.mta.throttle import DeliveryThrottle
 from mailman.utilities.datetime import now
 from mailman.utilities.modules import find_name
 from uuid import UUID
@@ -44,6 +51,9 @@ from zope.component import getUtility
 # permanent failures.  It is a count of calls to _do_periodic()
 DEAL_WITH_PERMFAILURES_EVERY = 10
 
+# The delivery reports are saved at most this often, in seconds.
+REPORT_EVERY = 1
+
 log = logging.getLogger('mailman.error')
 smtp_log = logging.getLogger('mailman.smtp')
 debug_log = logging.getLogger('mailman.debug')
@@ -62,12 +72,30 @@ class OutgoingRunner(Runner):
         # set if there was a socket.error.
         self._logged = False
         self._retryq = config.switchboards['retry']
+        # All deliveries share the SMTP connections of this pool, unless
+        # pooling is disabled.
+        self._connections = ConnectionPool.from_config()
+        # Deliveries to destinations which push back are slowed down, unless
+        # throttling is disabled.
+        self._throttle = DeliveryThrottle.from_config()
+        # The state of the throttle and the counters of the smarthosts are
+        # saved for the REST API to report.
+        self._reports = {
+            report_file('smarthosts', slice): Smarthosts.from_config().states,
+            }
+        if self._throttle is not None:
+            self._reports[report_file('throttle', slice)] = (
+                self._throttle.states)
+        self._reported = None
+        self._last_reports = {}
 
     def _dispose(self, mlist, msg, msgdata):
-        # See if we should retry delivery of this message again.
+        # Messages which must not be delivered yet wait in the retry queue,
+        # which holds on to them until they are due.
         deliver_after = msgdata.get('deliver_after', datetime.fromtimestamp(0))
         if now() < deliver_after:
-            return True
+            self._retryq.enqueue(msg, msgdata)
+            return False
         # Calculate whether we should VERP this message or not.  The results of
         # this set the 'verp' key in the message metadata.
         interval = int(config.mta.verp_delivery_interval)
@@ -91,10 +119,33 @@ class OutgoingRunner(Runner):
         else:
             # VERP every 'interval' number of times.
             msgdata['verp'] = (mlist.post_id % interval == 0)
+        # Recipients at throttled destinations may have to wait their turn.
+        # Those are retried later, without counting as failures.
+        recipients = msgdata.get('recipients')
+        if self._throttle is not None and recipients:
+            admitted, delayed, delay = self._throttle.admit(recipients)
+            if len(delayed) > 0:
+                smtp_log.info('{0} delaying {1} throttled recipients'.format(
+                    msg.get('message-id', 'n/a'), len(delayed)))
+                delayed_msgdata = msgdata.copy()
+                delayed_msgdata['recipients'] = delayed
+                # Only the admitted recipients count for the shard's tally.
+                delayed_msgdata.pop('shard', None)
+                delayed_msgdata['deliver_after'] = (
+                    now() + timedelta(seconds=delay))
+                self._retryq.enqueue(msg, delayed_msgdata)
+                if len(admitted) == 0:
+                    return False
+                msgdata['recipients'] = admitted
         try:
             debug_log.debug('[outgoing] {0}: {1}'.format(
                 self._func, msg.get('message-id', 'n/a')))
-            self._func(mlist, msg, msgdata)
+            with ExitStack() as resources:
+                if self._connections is not None:
+                    resources.enter_context(self._connections.shared())
+                if self._throttle is not None:
+                    resources.enter_context(self._throttle.shared())
+                self._func(mlist, msg, msgdata)
             self._logged = False
         except socket.error:
             # There was a problem connecting to the SMTP server.  Log this
@@ -161,9 +212,49 @@ class OutgoingRunner(Runner):
                         # this message for a while longer.
                         deliver_until = current_time + as_timedelta(
                             config.mta.delivery_retry_period)
+                    # Back off exponentially with every retry of the same
+                    # message.
+                    retries = msgdata.get('retries', 0)
+                    first_wait = as_timedelta(config.mta.delivery_retry_wait)
+                    max_wait = as_timedelta(config.mta.delivery_retry_max_wait)
+                    wait = min(first_wait.total_seconds() * 2.0 ** retries,
+                               max_wait.total_seconds())
                     msgdata['last_recip_count'] = len(recipients)
                     msgdata['deliver_until'] = deliver_until
+                    msgdata['deliver_after'] = (
+                        current_time + timedelta(seconds=wait))
+                    msgdata['retries'] = retries + 1
                     msgdata['recipients'] = recipients
                     self._retryq.enqueue(msg, msgdata)
         # We've successfully completed handling of this message.
         return False
+
+    def _do_periodic(self):
+        """Close the SMTP connections which have been idle for too long.
+
+        Also save the delivery reports every now and then.
+        """
+        if self._connections is not None:
+            self._connections.expire()
+        if self._throttle is not None:
+            self._throttle.expire()
+        right_now = time.time()
+        if (self._reported is not None and
+                right_now - self._reported < REPORT_EVERY):
+            return
+        self._reported = right_now
+        for path, states in self._reports.items():
+            entries = states()
+            if entries != self._last_reports.get(path):
+                write_report(path, entries)
+                self._last_reports[path] = entries
+
+    def _clean_up(self):
+        """Close the pooled SMTP connections and remove the reports."""
+        if self._connections is not None:
+            self._connections.quit()
+        for path in self._reports:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -26,17 +26,42 @@ import time
 
 from mailman.config import config
 from mailman.core.runner import Runner
+from mailman.core.switchboard import split_filebase
 
 
 
 class RetryRunner(Runner):
-    """Retry delivery."""
+    """Move delayed deliveries to the out queue when they are due.
+
+    Retry queue files are named after the time their `deliver_after` comes
+    up, so the queue's index keeps them ordered by when they are due.  The
+    runner only dequeues the files which are due, and otherwise waits until
+    the next one is, or until a new file arrives which might be due sooner.
+    """
+
+    def _next_files(self):
+        """See `IRunner`."""
+        right_now = time.time()
+        files = []
+        for filebase in self.switchboard.next_files(self.files_per_iteration):
+            if split_filebase(filebase)[0] > right_now:
+                break
+            files.append(filebase)
+        return files
 
     def _dispose(self, mlist, msg, msgdata):
-        # Move the message to the out queue for another try.
+        # The message is due, so move it to the out queue for another try.
+        msgdata.pop('deliver_after', None)
         config.switchboards['out'].enqueue(msg, msgdata)
         return False
 
     def _snooze(self, filecnt):
-        # We always want to snooze.
-        time.sleep(self.sleep_float)
+        """See `IRunner`."""
+        if filecnt:
+            return
+        timeout = self.sleep_float
+        files = self.switchboard.next_files(1)
+        if len(files) > 0:
+            due = split_filebase(files[0])[0]
+            timeout = max(0, min(timeout, due - time.time()))
+        self.switchboard.wait(timeout)
@@ -67,6 +67,8 @@ class TestDigest(unittest.TestCase):
         for item in messages:
             self.assertEqual(item.msg['subject'],
                              'Test Digest, Vol 1, Issue 1')
+            # Digests are bulk traffic.
+            self.assertEqual(item.msgdata['priority'], 'low')
 
     def test_simple_message(self):
         make_digest_messages(self._mlist)
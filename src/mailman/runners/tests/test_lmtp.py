@@ -18,20 +18,32 @@
 """Tests for the LMTP server."""
 
 __all__ = [
+    'TestBugs',
+    'TestIngressParsing',
     'TestLMTP',
+    'TestLMTPServer',
     ]
 
 
 import os
+import socket
 import smtplib
 import unittest
+import threading
 
 from datetime import datetime
 from mailman.config import config
 from mailman.app.lifecycle import create_list
+from mailman.core.switchboard import read_entry
 from mailman.database.transaction import transaction
-from mailman.testing.helpers import get_lmtp_client, get_queue_messages
-from mailman.testing.layers import LMTPLayer
+from mailman.mta.backpressure import BackPressure
+from mailman.mta.reports import read_reports
+from mailman.runners.lmtp import LMTPRunner
+from mailman.testing.helpers import (
+    configuration, get_lmtp_client, get_queue_messages,
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer, LMTPLayer
+from unittest.mock import patch
 
 
 
@@ -144,6 +156,208 @@ Message-ID: <aardvark>
         self.assertEqual(cm.exception.smtp_error,
                          b'Requested action not taken: mailbox unavailable')
 
+    def test_pipelining(self):
+        # The server supports pipelining, and replies with a status for
+        # every recipient.
+        with socket.create_connection(
+                (config.mta.lmtp_host, int(config.mta.lmtp_port))) as sock:
+            replies = sock.makefile('rb')
+            self.assertTrue(replies.readline().startswith(b'220 '))
+            sock.sendall(b'LHLO remote.example.org\r\n'
+                         b'MAIL FROM:<anne@example.com>\r\n'
+                         b'RCPT TO:<test@example.com>\r\n'
+                         b'RCPT TO:<notalist@example.com>\r\n'
+                         b'DATA\r\n')
+            lines = []
+            while not lines or not lines[-1].startswith(b'354'):
+                lines.append(replies.readline())
+            self.assertIn(b'250-PIPELINING\r\n', lines)
+            self.assertEqual([line[:4] for line in lines[-4:]],
+                             [b'250 ', b'250 ', b'250 ', b'354 '])
+            sock.sendall(b'From: anne@example.com\r\n'
+                         b'To: test@example.com\r\n'
+                         b'Message-ID: <ant>\r\n'
+                         b'\r\n'
+                         b'..A dotted line.\r\n'
+                         b'.\r\n'
+                         b'QUIT\r\n')
+            self.assertEqual(
+                [replies.readline()[:3] for i in range(3)],
+                [b'250', b'550', b'221'])
+        messages = get_queue_messages('in')
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].msg.get_payload(), '.A dotted line.')
+
+
+
+
+class TestLMTPServer(unittest.TestCase):
+    """Test the sessions of the LMTP server."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        with socket.socket() as sock:
+            sock.bind(('localhost', 0))
+            port = sock.getsockname()[1]
+        settings = configuration(
+            'mta', lmtp_port=port, lmtp_timeout='1s', lmtp_max_sessions=2)
+        settings.__enter__()
+        self.addCleanup(settings.__exit__)
+        with transaction():
+            create_list('test@example.com')
+        self._runner = LMTPRunner('lmtp')
+        thread = threading.Thread(target=self._runner.run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self._runner.stop)
+
+    def _connect(self):
+        lmtp = get_lmtp_client(quiet=True)
+        self.addCleanup(lmtp.close)
+        return lmtp
+
+    def test_timeout(self):
+        # Idle sessions are closed.
+        lmtp = self._connect()
+        self.assertEqual(lmtp.getreply(),
+                         (421, self._runner.fqdn.encode('ascii') +
+                          b' Timeout, closing connection'))
+
+    def test_max_sessions(self):
+        # Sessions beyond the limit are turned away.
+        for i in range(2):
+            self.assertEqual(self._connect().noop()[0], 250)
+        with socket.create_connection(
+                (config.mta.lmtp_host, int(config.mta.lmtp_port))) as sock:
+            self.assertEqual(sock.makefile('rb').readline()[:4], b'421 ')
+
+    def test_slow_processing(self):
+        # While a message is processed, the other sessions are served.
+        processing = threading.Event()
+        release = threading.Event()
+        process_message = self._runner.process_message
+        def slow_process_message(*args):
+            processing.set()
+            release.wait()
+            return process_message(*args)
+        slow = self._connect()
+        slow.lhlo('remote.example.org')
+        slow.mail('anne@example.com')
+        slow.rcpt('test@example.com')
+        with patch.object(self._runner, 'process_message',
+                          slow_process_message):
+            slow.putcmd('data')
+            self.assertEqual(slow.getreply()[0], 354)
+            slow.send(b'From: anne@example.com\r\n'
+                      b'Message-ID: <ant>\r\n\r\n.\r\n')
+            processing.wait()
+            self.assertEqual(self._connect().noop()[0], 250)
+            release.set()
+            self.assertEqual(slow.getreply()[0], 250)
+        self.assertEqual(len(get_queue_messages('in')), 1)
+
+    def test_back_pressure(self):
+        # While the incoming queue is backed up, mail is temporarily
+        # rejected, so that the MTA tries again later.
+        self._runner.back_pressure = BackPressure(
+            [config.switchboards['in']], 2, 0, interval=0)
+        lmtp = self._connect()
+        lmtp.lhlo('remote.example.org')
+        msg = mfs("""\
+From: anne@example.com
+Message-ID: <ant>
+
+""")
+        for i in range(2):
+            config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        code, reply = lmtp.mail('anne@example.com')
+        self.assertEqual(code, 452)
+        self.assertEqual(reply, b'4.3.1 Insufficient system storage, '
+                                b'try again later')
+        # The state of the back pressure is reported.
+        report = read_reports('backpressure', 'queue', 'lmtp')
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['depth'], 2)
+        self.assertTrue(report[0]['rejecting'])
+        # Once the queue is drained, mail is accepted again.
+        get_queue_messages('in')
+        self.assertEqual(lmtp.mail('anne@example.com')[0], 250)
+
+    def test_back_pressure_age(self):
+        self._runner.back_pressure = BackPressure(
+            [config.switchboards['in']], 0, 0, 60, 0, interval=0)
+        lmtp = self._connect()
+        lmtp.lhlo('remote.example.org')
+        msg = mfs("""\
+From: anne@example.com
+Message-ID: <ant>
+
+""")
+        switchboard = config.switchboards['in']
+        filebase = switchboard.enqueue(msg, listid='test.example.com')
+        # Make the file look like it was enqueued two minutes ago.
+        when, digest = filebase.split('+', 1)
+        path = os.path.join(switchboard.queue_directory, '{}+{}.pck')
+        os.rename(path.format(when, digest),
+                  path.format(float(when) - 120, digest))
+        self.assertEqual(lmtp.mail('anne@example.com')[0], 451)
+
+
+
+
+class TestIngressParsing(unittest.TestCase):
+    """Test how much of the incoming messages is parsed."""
+
+    layer = ConfigLayer
+
+    # The closing boundary is missing, which regenerating the body adds.
+    MESSAGE = b"""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+Content-Type: multipart/mixed; boundary="XXX"
+
+--XXX
+Content-Type: text/plain
+
+An attachment.
+"""
+
+    def setUp(self):
+        with transaction():
+            create_list('test@example.com')
+
+    def _process(self):
+        runner = LMTPRunner('lmtp')
+        return runner.process_message(
+            ('127.0.0.1', 12345), 'anne@example.com', ['test@example.com'],
+            self.MESSAGE)
+
+    @configuration('mta', lmtp_parse_body='no')
+    def test_body_is_passed_through(self):
+        # Only the headers are parsed, so the defect in the body doesn't
+        # matter, and the body is queued exactly as it was received.
+        self.assertEqual(self._process(), ['250 Ok'])
+        switchboard = config.switchboards['in']
+        filebase = switchboard.files[0]
+        path = os.path.join(switchboard.queue_directory, filebase + '.pck')
+        with open(path, 'rb') as fp:
+            msgsave, msgdata = read_entry(fp)
+        self.assertTrue(msgsave.endswith(b'\n\n--XXX\n'
+                                         b'Content-Type: text/plain\n\n'
+                                         b'An attachment.\n'))
+        self.assertEqual(msgdata['original_size'], len(self.MESSAGE))
+        items = get_queue_messages('in')
+        self.assertEqual(items[0].msg['x-mailfrom'], 'anne@example.com')
+
+    def test_parse_body(self):
+        # By default, the whole message is parsed and the defect in its body
+        # is found.
+        self.assertEqual(self._process(), ['501 Message has defects'])
+        self.assertEqual(len(get_queue_messages('in')), 0)
+
+
 
 
 class TestBugs(unittest.TestCase):
@@ -90,13 +90,14 @@ Message-Id: <first>
 
     def test_deliver_after(self):
         # When the metadata has a deliver_after key in the future, the runner
-        # will re-enqueue the message rather than delivering it.
+        # moves the message to the retry queue rather than delivering it.
         deliver_after = now() + timedelta(days=10)
         self._msgdata['deliver_after'] = deliver_after
         self._outq.enqueue(self._msg, self._msgdata,
                            tolist=True, listid='test.example.com')
         self._runner.run()
-        items = get_queue_messages('out')
+        self.assertEqual(len(get_queue_messages('out')), 0)
+        items = get_queue_messages('retry')
         self.assertEqual(len(items), 1)
         self.assertEqual(items[0].msgdata['deliver_after'], deliver_after)
         self.assertEqual(items[0].msg['message-id'], '<first>')
@@ -534,3 +535,21 @@ Message-Id: <first>
         self.assertEqual(
             line[-63:-1],
             'Discarding message with persistent temporary failures: <first>')
+
+    def test_exponential_backoff(self):
+        # Every retry of a message with temporary failures waits twice as
+        # long as the previous one, up to the maximum wait.
+        temporary_failures.append('mary@example.com')
+        msgdata = {}
+        waits = []
+        for i in range(8):
+            self._outq.enqueue(self._msg, msgdata, listid='test.example.com')
+            self._runner.run()
+            items = get_queue_messages('retry')
+            self.assertEqual(len(items), 1)
+            msgdata = items[0].msgdata
+            self.assertEqual(msgdata['retries'], i + 1)
+            waits.append(msgdata['deliver_after'] - now())
+            del msgdata['deliver_after']
+        self.assertEqual(waits, [timedelta(minutes=minutes) for minutes in
+                                 (5, 10, 20, 40, 80, 160, 240, 240)])
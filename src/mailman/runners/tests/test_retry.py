@@ -22,8 +22,10 @@ __all__ = [
     ]
 
 
+import time
 import unittest
 
+from datetime import datetime, timedelta
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.runners.retry import RetryRunner
@@ -56,3 +58,34 @@ Message-Id: <first>
         self._retryq.enqueue(self._msg, self._msgdata)
         self._runner.run()
         self.assertEqual(len(get_queue_messages('out')), 1)
+
+    def _deliver_after(self, seconds):
+        # The retry queue schedules files by the system clock.
+        return datetime.utcnow() + timedelta(seconds=seconds)
+
+    def test_message_not_yet_due(self):
+        # Messages stay in the retry queue until their deliver_after time.
+        self._retryq.enqueue(self._msg, self._msgdata,
+                             deliver_after=self._deliver_after(3600))
+        runner = make_testable_runner(
+            RetryRunner, 'retry', lambda runner: True)
+        runner.run()
+        self.assertEqual(len(get_queue_messages('out')), 0)
+        self.assertEqual(len(self._retryq.files), 1)
+
+    def test_messages_released_when_due(self):
+        # Messages are moved to the out queue in the order they are due in,
+        # as soon as they are due, and without their deliver_after time.
+        for subject, seconds in (('second', 0.4), ('first', 0.2)):
+            del self._msg['subject']
+            self._msg['Subject'] = subject
+            self._retryq.enqueue(self._msg, self._msgdata,
+                                 deliver_after=self._deliver_after(seconds))
+        start = time.time()
+        self._runner.run()
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertLess(time.time() - start, 60)
+        items = get_queue_messages('out')
+        self.assertEqual([str(item.msg['subject']) for item in items],
+                         ['first', 'second'])
+        self.assertNotIn('deliver_after', items[0].msgdata)
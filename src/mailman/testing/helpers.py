@@ -61,6 +61,7 @@ from mailman.bin.master import Loop as Master
 from mailman.config import config
 from mailman.database.transaction import transaction
 from mailman.email.message import Message
+from mailman.interfaces.listmanager import IListIndex
 from mailman.interfaces.member import MemberRole
 from mailman.interfaces.messages import IMessageStore
 from mailman.interfaces.styles import IStyleManager
@@ -271,7 +272,8 @@ def get_nntp_server(cleanups):
     class NNTPProxy:
         def get_message(self):
             args = nntpd.post.call_args
-            return specialized_message_from_string(args[0][0].read())
+            return specialized_message_from_string(
+                args[0][0].read().decode())
     return NNTPProxy()
 
 
@@ -474,6 +476,9 @@ def reset_the_world():
     """
     # Reset the database between tests.
     config.db._reset()
+    # The mailing lists vanished without any events, so tell every process to
+    # reload its list index.
+    getUtility(IListIndex).invalidate()
     # Remove any digest files and members.txt file (for the file-recips
     # handler) in the lists' data directories.
     for dirpath, dirnames, filenames in os.walk(config.LIST_DATA_DIR):
@@ -24,9 +24,9 @@ __all__ = [
 
 
 from contextlib import closing
-from flufl.i18n import registry
 from gettext import GNUTranslations, NullTranslations
-from mailman.core.i18n import initialize as core_initialize
+from mailman.core.i18n import (
+    ThreadLocalApplication, initialize as core_initialize)
 from pkg_resources import resource_stream
 
 
@@ -49,5 +49,5 @@ class TestingStrategy:
 def initialize():
     """Install a global underscore function for testing purposes."""
     strategy = TestingStrategy('mailman-testing')
-    application = registry.register(strategy)
+    application = ThreadLocalApplication(strategy)
     core_initialize(application)
@@ -19,12 +19,29 @@
 
 __all__ = [
     'makedirs',
+    'sync_directory',
     'umask',
     ]
 
 
 import os
 import errno
+import ctypes
+import ctypes.util
+
+
+
+def _load_syncfs():
+    library = ctypes.util.find_library('c')
+    if library is None:
+        return None
+    try:
+        # syncfs() only exists on Linux.
+        return ctypes.CDLL(library, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+_syncfs = _load_syncfs()
 
 
 
@@ -73,3 +90,38 @@ def makedirs(path, mode=0o2775):
             os.chmod(dirpath, mode)
         except OSError:
             pass
+
+
+
+
+def sync_directory(path, filenames):
+    """Make files in a directory, and their directory entries, durable.
+
+    Where the platform supports it, this is a single syncfs() of the file
+    system holding the directory, which is much cheaper than syncing many
+    files one by one.  Otherwise, each file is fsync()ed, followed by the
+    directory itself.
+
+    :param path: The directory containing the files.
+    :type path: string
+    :param filenames: The names of the files in the directory to sync.
+        Files which no longer exist are skipped.
+    :type filenames: sequence of strings
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs is not None and _syncfs(fd) == 0:
+            return
+        for filename in filenames:
+            try:
+                file_fd = os.open(os.path.join(path, filename), os.O_RDONLY)
+            except FileNotFoundError:
+                # It has been removed in the meantime.
+                continue
+            try:
+                os.fsync(file_fd)
+            finally:
+                os.close(file_fd)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,281 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Wait for files to appear in a directory.
+
+On Linux, the kernel's inotify facility is used so that a waiting process
+wakes up as soon as a file is renamed into the watched directory.  Everywhere
+else, the directory's modification time is polled, which is still much
+cheaper than listing the directory over and over again.
+"""
+
+__all__ = [
+    'InotifyWatcher',
+    'PollingWatcher',
+    'make_watcher',
+    ]
+
+
+import os
+import time
+import ctypes
+import select
+import struct
+import ctypes.util
+
+
+# How often the polling watcher stat()s the directory, in seconds.
+POLL_INTERVAL = 0.05
+
+# A directory modification time this recent (in nanoseconds) can't be
+# trusted, since another change could land within the same timestamp
+# granularity without changing it.
+RACY_NS = 2 * 10**9
+
+# The maximum number of unreported changes the inotify watcher remembers.
+# Beyond that, it just reports that the directory must be rescanned.
+MAX_PENDING = 100000
+
+# From <sys/inotify.h>.  Queue files are always written to a temporary file
+# and then renamed into place, so IN_MOVED_TO is the only arrival event we
+# need.  Files leave by being renamed or unlinked.
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+EVENT_HEADER = struct.Struct('iIII')
+
+
+
+def _load_libc():
+    library = ctypes.util.find_library('c')
+    if library is None:
+        return None
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+        # Probe for the inotify entry points; they only exist on Linux.
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+
+
+
+class PollingWatcher:
+    """Wait for a directory to change by polling its modification time."""
+
+    def __init__(self, path, extension='.pck'):
+        """Create a directory watcher.
+
+        :param path: The directory to watch.
+        :type path: str
+        :param extension: Only files with this extension are of interest.
+        :type extension: str
+        """
+        self.path = path
+        self.extension = extension
+        self._last_mtime = self._mtime()
+        self._scanned_mtime = None
+
+    def _mtime(self):
+        return os.stat(self.path).st_mtime_ns
+
+    def wait(self, timeout=None):
+        """Wait until the directory may contain new files.
+
+        Changes which happened since the last call to `wait()` are reported
+        immediately, so files which land between scanning the directory and
+        calling this method are never missed.  Spurious wakeups are possible.
+
+        :param timeout: The maximum number of seconds to wait, or None to
+            wait forever.
+        :type timeout: float or None
+        :return: True if the directory may have changed, False if the wait
+            timed out.
+        :rtype: bool
+        """
+        deadline = (None if timeout is None else time.time() + timeout)
+        while True:
+            mtime = self._mtime()
+            if mtime != self._last_mtime:
+                self._last_mtime = mtime
+                return True
+            if deadline is None:
+                interval = POLL_INTERVAL
+            else:
+                interval = min(POLL_INTERVAL, deadline - time.time())
+                if interval <= 0:
+                    return False
+            time.sleep(interval)
+
+    def changes(self):
+        """Return the files which arrived and left since the last call.
+
+        :return: None if the directory must be rescanned to find out, which
+            is always the case for the first call.  Otherwise, a 2-tuple of
+            the base names (without extension) of the files which arrived and
+            of the files which left the directory, according to the last
+            thing which happened to each file.
+        :rtype: None or 2-tuple of lists of str
+        """
+        mtime = self._mtime()
+        if mtime == self._scanned_mtime:
+            return [], []
+        # The caller is going to list the directory now.  If the modification
+        # time is very recent, a change could still land without altering it,
+        # so don't trust it and have the next call rescan too.
+        if time.time() * 10**9 - mtime > RACY_NS:
+            self._scanned_mtime = mtime
+        else:
+            self._scanned_mtime = None
+        return None
+
+    def close(self):
+        """Release any resources held by the watcher."""
+        pass
+
+
+
+class InotifyWatcher(PollingWatcher):
+    """Wait for files to be renamed into a directory using inotify."""
+
+    def __init__(self, path, extension='.pck'):
+        """See `PollingWatcher`."""
+        super(InotifyWatcher, self).__init__(path, extension)
+        # Map file base names to True if the file's last event was an
+        # arrival, or False if it was a departure.
+        self._pending = {}
+        # Start out needing a scan, as the polling watcher does.
+        self._overflowed = True
+        # Set when the watch goes away, e.g. because the directory was
+        # removed.  From then on, this behaves like the polling watcher.
+        self._ignored = False
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        wd = _libc.inotify_add_watch(
+            self._fd, os.fsencode(path),
+            IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, os.strerror(errno), path)
+
+    def _drain(self):
+        """Read all pending events.
+
+        :return: True if a file arrived or events were lost.
+        """
+        found = False
+        extension = os.fsencode(self.extension)
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                return found
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(
+                    data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_IGNORED:
+                    self._ignored = True
+                    self._overflowed = True
+                    found = True
+                    continue
+                if mask & IN_Q_OVERFLOW:
+                    # The kernel dropped events; the next caller of
+                    # changes() has to rescan.
+                    self._overflowed = True
+                    found = True
+                    continue
+                if not name.endswith(extension):
+                    continue
+                filebase = os.fsdecode(name[:-len(extension)])
+                arrived = bool(mask & IN_MOVED_TO)
+                self._pending[filebase] = arrived
+                found = found or arrived
+            if len(self._pending) > MAX_PENDING:
+                # Nobody is asking; stop remembering.
+                self._overflowed = True
+            if self._overflowed:
+                self._pending.clear()
+
+    def wait(self, timeout=None):
+        """See `PollingWatcher`."""
+        if self._ignored:
+            return super(InotifyWatcher, self).wait(timeout)
+        deadline = (None if timeout is None else time.time() + timeout)
+        while True:
+            remaining = (None if deadline is None
+                         else max(0, deadline - time.time()))
+            readable, writable, errors = select.select(
+                [self._fd], [], [], remaining)
+            if readable and self._drain():
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+    def changes(self):
+        """See `PollingWatcher`."""
+        self._drain()
+        if self._ignored:
+            return super(InotifyWatcher, self).changes()
+        if self._overflowed:
+            self._overflowed = False
+            return None
+        pending, self._pending = self._pending, {}
+        arrived = [filebase for filebase in pending if pending[filebase]]
+        departed = [filebase for filebase in pending if not pending[filebase]]
+        return arrived, departed
+
+    def close(self):
+        """See `PollingWatcher`."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+
+def make_watcher(path, extension='.pck'):
+    """Return the best available watcher for the directory.
+
+    :param path: The directory to watch.
+    :type path: str
+    :param extension: Only files with this extension are of interest.
+    :type extension: str
+    :return: An `InotifyWatcher` if the platform supports it, otherwise a
+        `PollingWatcher`.
+    """
+    if _libc is not None:
+        try:
+            return InotifyWatcher(path, extension)
+        except OSError:
+            # E.g. the per-user watch limit has been reached.
+            pass
+    return PollingWatcher(path, extension)
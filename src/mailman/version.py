@@ -43,6 +43,11 @@ HEX_VERSION = ((MAJOR_REV << 24) | (MINOR_REV << 16) | (MICRO_REV << 8) |
 # queue/*.pck schema version number.
 QFILE_SCHEMA_VERSION = 3
 
+# queue/*.pck file format version number.  Version 1 files are a pickled
+# message followed by the pickled metadata.  Version 2 files start with a
+# header, followed by the pickled metadata and the raw message.
+QFILE_FORMAT_VERSION = 2
+
 # Printable version string used by command line scripts.
 MAILMAN_VERSION = 'GNU Mailman ' + VERSION
 MAILMAN_VERSION_FULL = MAILMAN_VERSION + ' (' + CODENAME + ')'